@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+"""Benchmarks for the collection and write pipeline
+
+Runs entirely offline, no influxdb server is required.
+Run with -h or --help to see the available benchmarks and options.
+"""
+# pylint: disable=logging-format-interpolation
+import argparse
+import collections
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import trio
+
+import common_lib
+import system_metrics_influx as smi
+
+
+class FakePsutil:
+    """Synthetic psutil backend modelling a host of a given size"""
+    scputimes = collections.namedtuple(
+        "scputimes", "user nice system idle iowait irq softirq steal guest guest_nice"
+    )
+    scpustats = collections.namedtuple("scpustats",
+                                       "ctx_switches interrupts soft_interrupts syscalls")
+    scpufreq = collections.namedtuple("scpufreq", "current min max")
+    svmem = collections.namedtuple("svmem", "total available percent used free")
+    sdiskpart = collections.namedtuple("sdiskpart", "device mountpoint fstype opts")
+    sdiskusage = collections.namedtuple("sdiskusage", "total used free percent")
+    sdiskio = collections.namedtuple(
+        "sdiskio", "read_count write_count read_bytes write_bytes read_time write_time "
+        "read_merged_count write_merged_count busy_time"
+    )
+    snetio = collections.namedtuple(
+        "snetio", "bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout"
+    )
+    shwtemp = collections.namedtuple("shwtemp", "label current high critical")
+    Process = smi.psutil.Process
+
+    def __init__(self, cores, disks, nics, mounts):
+        self.cores = cores
+        self.disk_names = ["nvme{0}n1".format(index) for index in range(disks)]
+        self.nic_names = ["eth{0}".format(index) for index in range(nics)]
+        self.mountpoints = ["/"] + ["/mnt/volume{0}".format(index) for index in range(mounts - 1)]
+        self.calls = 0
+
+    def tick(self):
+        """Advances the synthetic counters"""
+        self.calls += 1
+        return self.calls
+
+    def cpu_times_percent(self, interval=None, percpu=False):
+        """Synthetic cpu_times_percent"""
+        return self.scputimes(12.5, 0.0, 3.1, 84.0, 0.2, 0.0, 0.4, 0.0, 0.0, 0.0)
+
+    def cpu_stats(self):
+        """Synthetic cpu_stats"""
+        tick = self.tick()
+        return self.scpustats(tick * 15000, tick * 9000, tick * 4000, 0)
+
+    def cpu_freq(self, percpu=False):
+        """Synthetic cpu_freq"""
+        freqs = [self.scpufreq(2400.0 + index % 7, 800.0, 3600.0) for index in range(self.cores)]
+        if percpu:
+            return freqs
+        return freqs[0]
+
+    def cpu_percent(self, interval=None, percpu=False):
+        """Synthetic cpu_percent"""
+        if percpu:
+            return [float(index % 100) for index in range(self.cores)]
+        return 42.0
+
+    def cpu_count(self, logical=True):
+        """Synthetic cpu_count"""
+        return self.cores
+
+    def virtual_memory(self):
+        """Synthetic virtual_memory"""
+        return self.svmem(540000000000, 420000000000, 22.2, 120000000000, 400000000000)
+
+    def disk_partitions(self, all=False): # pylint: disable=redefined-builtin
+        """Synthetic disk_partitions"""
+        return [self.sdiskpart("/dev/vol{0}".format(index), mountpoint, "ext4", "rw")
+                for index, mountpoint in enumerate(self.mountpoints)]
+
+    def disk_usage(self, path):
+        """Synthetic disk_usage"""
+        return self.sdiskusage(500107862016, 123456789012, 376651072004, 24.7)
+
+    def disk_io_counters(self, perdisk=False):
+        """Synthetic disk_io_counters"""
+        tick = self.tick()
+        return {name: self.sdiskio(tick * 12, tick * 30, tick * 1048576, tick * 524288,
+                                   tick * 3, tick * 5, tick, tick * 2, tick * 8)
+                for name in self.disk_names}
+
+    def net_io_counters(self, pernic=False):
+        """Synthetic net_io_counters"""
+        tick = self.tick()
+        counters = {name: self.snetio(tick * 123456, tick * 654321, tick * 100, tick * 250,
+                                      0, 0, 0, 0)
+                    for name in self.nic_names}
+        if pernic:
+            return counters
+        return self.snetio(*(sum(values) for values in zip(*counters.values())))
+
+    def sensors_temperatures(self):
+        """Synthetic sensors_temperatures"""
+        return {"coretemp": [self.shwtemp("Package id 0", 54.0, 80.0, 100.0)]}
+
+    def sensors_battery(self):
+        """Synthetic sensors_battery (no battery)"""
+        return None
+
+    def pids(self):
+        """Synthetic pids"""
+        return list(range(1, 1432))
+
+    def boot_time(self):
+        """Synthetic boot_time"""
+        return time.time() - 1209600
+
+
+def build_fake_procfs(root, cores, disks, nics, mounts):
+    """Writes a synthetic procfs/sysfs tree for a host of a given size under root"""
+    def write(path, lines):
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as out_file:
+            out_file.write("\n".join(lines) + "\n")
+
+    cpu_line = "{0} 4705 150 1120 16250 520 0 17 0 0 0"
+    write("proc/stat", [cpu_line.format("cpu")]
+          + [cpu_line.format("cpu{0}".format(index)) for index in range(cores)]
+          + ["intr 114930548 113199788 3 0 5 263 0 4 [...]", "ctxt 1990473",
+             "btime 1062191376", "processes 2915", "procs_running 1", "procs_blocked 0"])
+    for index in range(cores):
+        write("sys/devices/system/cpu/cpu{0}/cpufreq/scaling_cur_freq".format(index),
+              [str(2400000 + index % 7 * 1000)])
+    write("proc/meminfo", ["MemTotal:       527343750 kB", "MemFree:        390625000 kB",
+                           "MemAvailable:   410156250 kB", "Buffers:          1048576 kB",
+                           "Cached:          16777216 kB", "SwapCached:             0 kB",
+                           "SwapTotal:        8388608 kB", "SwapFree:         8388608 kB",
+                           "Dirty:               1024 kB", "Writeback:             0 kB",
+                           "AnonPages:       98304000 kB", "Shmem:             524288 kB",
+                           "Slab:             4194304 kB"])
+    write("proc/vmstat", ["nr_free_pages 97656250", "pgpgin 811054", "pgpgout 1903596",
+                          "pswpin 0", "pswpout 0", "pgfault 6770477", "pgmajfault 334",
+                          "oom_kill 0"])
+    for resource_name in ("cpu", "memory", "io"):
+        write("proc/pressure/{0}".format(resource_name),
+              ["some avg10=0.37 avg60=1.45 avg300=1.81 total=55890997",
+               "full avg10=0.00 avg60=0.00 avg300=0.00 total=1234"])
+    write("proc/diskstats",
+          ["{0:>4} {1:>7} nvme{2}n1 12 1 1048576 3 30 2 524288 5 0 8 8 0 0 0 0"
+           .format(259, index, index) for index in range(disks)])
+    write("proc/net/dev",
+          ["Inter-|   Receive                            |  Transmit",
+           " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets "
+           "errs drop fifo colls carrier compressed"]
+          + ["{0:>6}: 654321 250 0 0 0 0 0 0 123456 100 0 0 0 0 0 0".format("eth{0}".format(index))
+             for index in range(nics)])
+    write("proc/net/snmp", ["Tcp: RtoAlgorithm RtoMin RtoMax MaxConn ActiveOpens PassiveOpens "
+                            "AttemptFails EstabResets CurrEstab InSegs OutSegs RetransSegs InErrs "
+                            "OutRsts InCsumErrors",
+                            "Tcp: 1 200 120000 -1 101 24 75 12 8 15423 15422 0 0 84 0",
+                            "Udp: InDatagrams NoPorts InErrors OutDatagrams RcvbufErrors "
+                            "SndbufErrors InCsumErrors IgnoredMulti MemErrors",
+                            "Udp: 87 35 0 122 0 0 0 0 0"])
+    write("proc/net/netstat", ["TcpExt: ListenOverflows ListenDrops TCPTimeouts TCPSynRetrans",
+                               "TcpExt: 0 0 7 4"])
+    write("proc/net/sockstat", ["sockets: used 22", "TCP: inuse 80 orphan 0 tw 20 alloc 80 mem 0"])
+    write_fake_tcp_table(os.path.join(root, "proc/net/tcp"), 100)
+    write("proc/loadavg", ["0.52 0.58 0.59 1/467 12345"])
+    write("proc/filesystems", ["nodev\tsysfs", "nodev\tproc", "\text4", "\txfs"])
+    mountpoints = [os.path.join(root, "mnt", "volume{0}".format(index)) for index in range(mounts)]
+    for mountpoint in mountpoints:
+        os.makedirs(mountpoint, exist_ok=True)
+    write("proc/self/mountinfo",
+          ["{0} 1 259:{0} / {1} rw,relatime shared:1 - ext4 /dev/vol{0} rw"
+           .format(index + 30, mountpoint) for index, mountpoint in enumerate(mountpoints)]
+          + ["22 1 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:12 - proc proc rw"])
+
+
+def write_fake_process(root, pid, cpu_ticks):
+    """Writes synthetic /proc/<pid> stat and io files, with cpu_ticks of CPU time"""
+    path = os.path.join(root, "proc", str(pid))
+    with open(os.path.join(path, "stat"), "w") as out_file:
+        out_file.write("{0} (worker-{0}) S 1 {0} {0} 0 -1 4194560 1200 0 0 0 {1} {2} 0 0 20 0 1 "
+                       "0 {3} 105000000 {4} 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 3 0 "
+                       "0 0 0 0".format(pid, cpu_ticks, pid % 31, 1000 + pid, pid % 5000))
+    with open(os.path.join(path, "io"), "w") as out_file:
+        out_file.write("rchar: 4096\nwchar: 1024\nsyscr: 9\nsyscw: 2\nread_bytes: {0}\n"
+                       "write_bytes: {1}\ncancelled_write_bytes: 0\n"
+                       .format(cpu_ticks * 4096, pid % 11 * 4096))
+
+
+def build_fake_processes(root, processes):
+    """Writes a synthetic /proc/<pid> tree for a number of processes"""
+    for pid in range(1, processes + 1):
+        os.makedirs(os.path.join(root, "proc", str(pid)), exist_ok=True)
+        write_fake_process(root, pid, pid % 97)
+        with open(os.path.join(root, "proc", str(pid), "cmdline"), "w") as out_file:
+            out_file.write("/usr/bin/worker\0--id\0{0}\0".format(pid))
+    os.symlink("1", os.path.join(root, "proc", "self"))
+
+
+def build_fake_cgroups(root, cgroups):
+    """Writes a synthetic cgroup v2 tree under root with cgroups units in system.slice"""
+    def write(path, content):
+        with open(os.path.join(root, "sys/fs/cgroup", path), "w") as out_file:
+            out_file.write(content)
+
+    pressure = ("some avg10=0.00 avg60=0.00 avg300=0.00 total=1234\n"
+                "full avg10=0.00 avg60=0.00 avg300=0.00 total=567\n")
+    for index in range(cgroups + 1):
+        path = "system.slice" if not index else "system.slice/unit{0}.service".format(index)
+        os.makedirs(os.path.join(root, "sys/fs/cgroup", path))
+        write(path + "/cpu.stat", "usage_usec 7713062\nuser_usec 5381620\nsystem_usec 2331442\n"
+              "nr_periods 0\nnr_throttled 0\nthrottled_usec 0\n")
+        write(path + "/memory.current", "{0}\n".format(index * 1048576))
+        write(path + "/io.stat", "259:0 rbytes=1069056 wbytes=4096 rios=52 wios=1 dbytes=0 "
+              "dios=0\n8:0 rbytes=4096 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n")
+        for resource_name in ("cpu", "memory", "io"):
+            write(path + "/{0}.pressure".format(resource_name), pressure)
+    os.makedirs(os.path.join(root, "proc/self"), exist_ok=True)
+    with open(os.path.join(root, "proc/self/mountinfo"), "w") as out_file:
+        out_file.write("30 1 0:26 / /sys/fs/cgroup rw,nosuid,nodev,noexec,relatime shared:4 - "
+                       "cgroup2 cgroup2 rw,nsdelegate\n")
+
+
+def write_fake_tcp_table(path, sockets):
+    """Writes a synthetic /proc/net/tcp with a number of sockets, listening sockets first"""
+    line = ("{0:>4}: 0100007F:{1:04X} 0100007F:1F90 {2:02X} 00000000:00000000 00:00000000 "
+            "00000000  1000        0 {3} 1 0000000000000000 20 4 30 10 -1")
+    with open(path, "w") as out_file:
+        out_file.write("  sl  local_address rem_address   st tx_queue rx_queue tr tm->when "
+                       "retrnsmt   uid  timeout inode\n")
+        for index in range(sockets):
+            # 1% listening, then mostly established with some time wait and close wait
+            if index < sockets // 100:
+                state = 10
+            else:
+                state = (1, 1, 1, 1, 1, 1, 6, 6, 8, 4)[index % 10]
+            out_file.write(line.format(index, index % 65536, state, 100000 + index) + "\n")
+
+
+def install_fake_nvml(gpus):
+    """Installs a synthetic py3nvml module with a number of GPUs, returns the card config"""
+    if not gpus:
+        # makes the import fail, as if py3nvml was not installed
+        sys.modules["py3nvml"] = None
+        return {}
+    nvml = types.ModuleType("py3nvml.py3nvml")
+    memory = collections.namedtuple("c_nvmlMemory_t", "total free used")
+    utilisation = collections.namedtuple("c_nvmlUtilization_t", "gpu memory")
+    nvml.NVML_TEMPERATURE_GPU = 0
+    nvml.NVML_CLOCK_GRAPHICS = 0
+    nvml.NVML_CLOCK_MEM = 2
+    nvml.nvmlInit = lambda: None
+    nvml.nvmlSystemGetDriverVersion = lambda: "000.00"
+    nvml.nvmlDeviceGetCount = lambda: gpus
+    nvml.nvmlDeviceGetHandleByIndex = lambda index: index
+    nvml.nvmlDeviceGetUUID = "GPU-{0:08d}".format
+    nvml.nvmlDeviceGetMemoryInfo = lambda handle: memory(8 * 1024 ** 3, 6 * 1024 ** 3,
+                                                         2 * 1024 ** 3)
+    nvml.nvmlDeviceGetPowerUsage = lambda handle: 120000
+    nvml.nvmlDeviceGetPowerManagementLimit = lambda handle: 250000
+    nvml.nvmlDeviceGetUtilizationRates = lambda handle: utilisation(63, 20)
+    nvml.nvmlDeviceGetTemperature = lambda handle, sensor: 61
+    nvml.nvmlDeviceGetClockInfo = lambda handle, clock: 1800
+    nvml.nvmlDeviceGetMaxClockInfo = lambda handle, clock: 2100
+    nvml.nvmlDeviceGetFanSpeed = lambda handle: 45
+    package = types.ModuleType("py3nvml")
+    package.py3nvml = nvml
+    sys.modules["py3nvml"] = package
+    sys.modules["py3nvml.py3nvml"] = nvml
+    return {"GPU-{0:08d}".format(index): "Synthetic GPU {0}".format(index)
+            for index in range(gpus)}
+
+
+def percentile(ordered, fraction):
+    """Returns a percentile of a sorted list"""
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def synthetic_results(cores, disks, nics, mounts):
+    """Returns (name, result) pairs shaped like the built-in stat classes output"""
+    cpu = [{"measurement": "cpu", "ctx_switches": 152331, "interrupts": 98712, "user": 12.5,
+            "system": 3.1, "iowait": 0.2, "nice": 0.0, "irq": 0.0, "softirq": 0.4}]
+    for index in range(cores):
+        cpu.append({"measurement": "cpu", "util": 17.3 + index % 50,
+                    "freq": 2400000000 + index * 1000, "tags": {"cpu": index}})
+    disk = [{"measurement": "disk", "total": 500107862016, "used": 123456789012,
+             "percent": 24.7, "tags": {"disk": "/mnt/volume{0}".format(index)}}
+            for index in range(mounts)]
+    diskio = [{"measurement": "diskio", "read_bytes": 1048576, "write_bytes": 524288,
+               "disk_reads": 12, "disk_writes": 30, "merged_reads": 0, "merged_writes": 4,
+               "read_time": 1.2, "write_time": 3.4, "busy_time": 4.0,
+               "tags": {"disk": "nvme{0}n1".format(index)}}
+              for index in range(disks)]
+    netio = [{"measurement": "netio", "tx_bytes": 123456, "rx_bytes": 654321, "tx_packets": 100,
+              "rx_packets": 250, "tags": {"nic": "eth{0}".format(index)}}
+             for index in range(nics)]
+    return [
+        ("CPU", cpu),
+        ("Memory", {"measurement": "memory", "total": 540000000000, "used": 120000000000,
+                    "percent": 22.2}),
+        ("Disk", disk),
+        ("DiskIO", diskio),
+        ("NetIO", netio),
+        ("Sensors", {"measurement": "sensors", "cpu_temp": 54.0}),
+        ("Misc", {"measurement": "misc", "load_1": 3.2, "load_5": 2.9, "load_15": 2.5,
+                  "processes": 1432, "uptime": 1209600}),
+    ]
+
+
+def copy_results(results):
+    """Copies results so each cycle sees fresh dicts, as the stat classes return"""
+    copied = []
+    for name, result in results:
+        if isinstance(result, dict):
+            copied.append((name, dict(result)))
+        else:
+            copied.append((name, [dict(item) for item in result]))
+    return copied
+
+
+def legacy_format(results, target_time):
+    """The pre line protocol path: format_measurements dicts then client-side make_lines"""
+    from influxdb.line_protocol import make_lines # pylint: disable=import-outside-toplevel
+    current_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(target_time))
+    write_data = []
+    for _, result in results:
+        if isinstance(result, dict):
+            result = [result]
+        for dataset in result:
+            measurement = dataset.pop("measurement")
+            tags = dataset.pop("tags", {})
+            write_data.append(dict(measurement=measurement, time=current_time,
+                                   fields=dataset, tags=tags))
+    return make_lines(dict(points=write_data), precision=None).encode()
+
+
+def time_cycles(func, cycles, results):
+    """Times func over a number of cycles, returning (us per cycle, bytes per cycle)"""
+    inputs = [copy_results(results) for _ in range(cycles)]
+    target_time = int(time.time())
+    payload = b""
+    start = time.perf_counter()
+    for cycle_results in inputs:
+        payload = func(cycle_results, target_time)
+    elapsed = time.perf_counter() - start
+    return elapsed / cycles * 10 ** 6, len(payload)
+
+
+def bench_serializer(args):
+    """Line protocol serialization: legacy dict path vs LineSerializer (tagged, wide, policy)"""
+    results = synthetic_results(args.cores, args.disks, args.nics, args.mounts)
+    points = sum(1 if isinstance(result, dict) else len(result) for _, result in results)
+    serializer = smi.LineSerializer()
+    wide_serializer = smi.LineSerializer(wide=True)
+    rules = smi.EmissionPolicy.parse_rules(["memory.total=change", "disk.total=change",
+                                            "misc.uptime=keyframe", "cpu.freq=1%"])
+    policy_serializer = smi.LineSerializer(policy=smi.EmissionPolicy(rules, 60))
+    print("{0} points per cycle ({1} cores), {2} cycles".format(points, args.cores, args.cycles))
+    for name, func in (("legacy", legacy_format), ("native", serializer.serialize),
+                       ("wide", wide_serializer.serialize),
+                       ("policy", policy_serializer.serialize)):
+        micros, size = time_cycles(func, args.cycles, results)
+        print("  {0:<8} {1:>10.1f} us/cycle {2:>9} bytes/cycle".format(name, micros, size))
+
+
+def bench_aggregate(args):
+    """Aggregation over 10 cycle windows: cost per cycle and bytes written vs raw"""
+    results = synthetic_results(args.cores, args.disks, args.nics, args.mounts)
+    inputs = [copy_results(results) for _ in range(args.cycles)]
+    serializer = smi.LineSerializer()
+    raw_serializer = smi.LineSerializer()
+    aggregator = smi.Aggregator(10 * 10 ** 9, ["mean", "min", "max", "last", "p95"])
+    start_ns = int(time.time()) * 10 ** 9
+    raw_bytes = 0
+    for cycle, cycle_results in enumerate(inputs):
+        raw_bytes += len(raw_serializer.serialize(cycle_results, start_ns // 10 ** 9 + cycle))
+    inputs = [copy_results(results) for _ in range(args.cycles)]
+    aggregate_bytes = 0
+    start = time.perf_counter()
+    for cycle, cycle_results in enumerate(inputs):
+        flushed = aggregator.add(cycle_results, start_ns + cycle * 10 ** 9)
+        if flushed is not None:
+            aggregate_bytes += len(serializer.serialize(flushed[0], flushed[1] // 10 ** 9))
+    elapsed = time.perf_counter() - start
+    print("  {0:>10.1f} us/cycle, {1} bytes raw, {2} bytes aggregated ({3:.1%})".format(
+        elapsed / args.cycles * 10 ** 6, raw_bytes, aggregate_bytes,
+        aggregate_bytes / raw_bytes))
+
+
+def synthetic_points(results):
+    """Returns the synthetic results as reusable Points, as the per CPU/disk/nic stats return"""
+    converted = []
+    for name, result in results:
+        if isinstance(result, dict):
+            result = [result]
+        points = []
+        for dataset in result:
+            keys = [key for key in dataset if key not in ("measurement", "tags")]
+            point = common_lib.Point(dataset["measurement"], keys, dataset.get("tags"))
+            point.values[:] = [dataset[key] for key in keys]
+            points.append(point)
+        converted.append((name, points))
+    return converted
+
+
+def update_points(results):
+    """Updates the values of Points in place, as the stat classes do each cycle"""
+    for _, points in results:
+        for point in points:
+            point.values[:] = point.values
+    return results
+
+
+def trace_cycle(func, *args):
+    """Runs func under tracemalloc, returning (peak bytes, bytes still allocated after)"""
+    tracemalloc.start()
+    func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, current
+
+
+async def collect_cycle(stats_objects, serializer):
+    """Runs one cycle of the real collect and serialize path"""
+    # a target time of now means no phase waits, only the collection work is measured
+    target_time = time.time()
+    smi.BaseStat.set_time(target_time)
+    await smi.collect_stats(stats_objects, target_time, None)
+    for name, stat_entry in stats_objects.items():
+        if stat_entry["errors"]:
+            raise RuntimeError("{0} failed: {1}".format(name, stat_entry["errors"]))
+    return serializer.serialize(
+        ((name, stat_entry["result"]) for name, stat_entry in stats_objects.items()),
+        int(target_time)
+    )
+
+
+async def run_collect_cycles(stats_objects, cycles):
+    """Runs the real collect and serialize path, returning per-cycle (wall, cpu) times"""
+    await smi.initialise_stats(stats_objects)
+    serializer = smi.LineSerializer()
+    samples = []
+    for _ in range(cycles):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        await collect_cycle(stats_objects, serializer)
+        samples.append((time.perf_counter() - wall_start, time.process_time() - cpu_start))
+    return samples
+
+
+async def trace_collect_cycles(stats_objects, cycles):
+    """Runs the real collect and serialize path, returning per-cycle tracemalloc samples"""
+    await smi.initialise_stats(stats_objects)
+    serializer = smi.LineSerializer()
+    # the first cycles fill the caches (prefixes, points, file buffers)
+    for _ in range(2):
+        await collect_cycle(stats_objects, serializer)
+    samples = []
+    for _ in range(cycles):
+        tracemalloc.start()
+        await collect_cycle(stats_objects, serializer)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        samples.append((peak, current))
+    return samples
+
+
+def fake_host_stats(args, procfs_root):
+    """Points the stat classes at a synthetic host and returns the stat entries"""
+    smi.psutil = FakePsutil(args.cores, args.disks, args.nics, args.mounts)
+    config = dict(nvidia_cards=install_fake_nvml(args.gpus), nvidia_seen_cardnames={})
+    smi.CONFIG = types.SimpleNamespace(main=config, save_value=config.update)
+    smi.BaseStat.collect_interval = 1
+    build_fake_procfs(procfs_root, args.cores, args.disks, args.nics, args.mounts)
+    common_lib.ProcFile.root = procfs_root
+    stats_objects = smi.builtin_stats(
+        dict(mountpoint_filters=[[], "exclude"], disk_filters=[[], "exclude"],
+             nic_filters=[[], "exclude"], virtual_nics_total=False, top_processes=0,
+             cgroups=False, socket_max=100000)
+    )
+    for stat_object in stats_objects:
+        if isinstance(stat_object, smi.SocketStats):
+            # count the synthetic /proc/net/tcp rather than this host's sockets
+            stat_object.use_netlink = False
+    return smi.create_stat_entries(stats_objects)
+
+
+def bench_collect(args):
+    """Collection loop with the real stat classes against a synthetic host"""
+    with tempfile.TemporaryDirectory() as procfs_root:
+        stats_objects = fake_host_stats(args, procfs_root)
+        samples = trio.run(run_collect_cycles, stats_objects, args.cycles)
+    wall = sorted(sample[0] * 1000 for sample in samples)
+    cpu = sum(sample[1] for sample in samples) / len(samples) * 1000
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if not args.no_header:
+        print("{0:>5} {1:>5} {2:>5} {3:>6} {4:>4} | {5:>8} {6:>8} {7:>8} {8:>8} | {9:>9} | {10:>8}"
+              .format("cores", "disks", "nics", "mounts", "gpus", "p50 ms", "p90 ms", "p99 ms",
+                      "max ms", "cpu ms/cy", "rss MiB"))
+    print("{0:>5} {1:>5} {2:>5} {3:>6} {4:>4} | {5:>8.3f} {6:>8.3f} {7:>8.3f} {8:>8.3f} | "
+          "{9:>9.3f} | {10:>8.1f}"
+          .format(args.cores, args.disks, args.nics, args.mounts, args.gpus,
+                  percentile(wall, 0.5), percentile(wall, 0.9), percentile(wall, 0.99),
+                  wall[-1], cpu, peak_rss), flush=True)
+
+
+def bench_memory(args):
+    """Memory allocated per cycle (tracemalloc): collection loop, and dict vs Point results"""
+    cycles = min(args.cycles, 50)
+    with tempfile.TemporaryDirectory() as procfs_root:
+        stats_objects = fake_host_stats(args, procfs_root)
+        samples = trio.run(trace_collect_cycles, stats_objects, cycles)
+    print("  collect  {0:>8.1f} KiB peak/cycle {1:>8.1f} KiB retained/cycle".format(
+        sum(sample[0] for sample in samples) / cycles / 1024,
+        sum(sample[1] for sample in samples) / cycles / 1024))
+    results = synthetic_results(args.cores, args.disks, args.nics, args.mounts)
+    points = synthetic_points(results)
+    serializer = smi.LineSerializer()
+    target_time = int(time.time())
+    # the dict path builds new dicts each cycle, the Point path updates the same Points
+    for name, func in (("dicts", lambda: serializer.serialize(copy_results(results),
+                                                               target_time)),
+                       ("points", lambda: serializer.serialize(update_points(points),
+                                                                target_time))):
+        func()
+        samples = [trace_cycle(func) for _ in range(cycles)]
+        print("  {0:<8} {1:>8.1f} KiB peak/cycle {2:>8.1f} KiB retained/cycle".format(
+            name, sum(sample[0] for sample in samples) / cycles / 1024,
+            sum(sample[1] for sample in samples) / cycles / 1024))
+
+
+def bench_processes(args):
+    """Top processes collector against a synthetic /proc, with 1% of the processes busy"""
+    cycles = min(args.cycles, 50)
+    busy = range(1, args.processes + 1, 100)
+    with tempfile.TemporaryDirectory() as procfs_root:
+        build_fake_processes(procfs_root, args.processes)
+        common_lib.ProcFile.root = procfs_root
+        smi.BaseStat.collect_interval = 1
+        stat = smi.ProcessStats(10)
+        trio.run(stat.init_fetch)
+        samples = []
+        for cycle in range(cycles + 1):
+            for pid in busy:
+                write_fake_process(procfs_root, pid, pid % 97 + cycle * 10)
+            start = time.perf_counter()
+            points = stat.get_stats()
+            samples.append((time.perf_counter() - start) * 1000)
+    # the first collection re-reads every process
+    first = samples.pop(0)
+    samples.sort()
+    print("  {0} processes, top 10: {1:.2f} ms p50 {2:.2f} ms max per cycle ({3:.1f} ms first "
+          "cycle), {4} points".format(args.processes, percentile(samples, 0.5), samples[-1],
+                                      first, len(points)))
+
+
+def bench_cgroups(args):
+    """Cgroup collector against a synthetic cgroup v2 tree: cost per cycle"""
+    cycles = min(args.cycles, 50)
+    with tempfile.TemporaryDirectory() as procfs_root:
+        build_fake_cgroups(procfs_root, args.cgroups)
+        common_lib.ProcFile.root = procfs_root
+        smi.BaseStat.collect_interval = 1
+        stat = smi.CgroupStats([], "exclude", 2, args.cgroups + 1)
+        trio.run(stat.async_init)
+        samples = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            points = stat.get_stats()
+            samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    print("  {0} cgroups: {1:.2f} ms p50 {2:.2f} ms max per cycle, {3} points".format(
+        args.cgroups + 1, percentile(samples, 0.5), samples[-1], len(points)))
+
+
+def bench_sockets(args):
+    """Socket state counts from a synthetic /proc/net/tcp table, in full and capped by socket-max"""
+    with tempfile.TemporaryDirectory() as procfs_root:
+        os.makedirs(os.path.join(procfs_root, "proc/net"))
+        write_fake_tcp_table(os.path.join(procfs_root, "proc/net/tcp"), args.sockets)
+        with open(os.path.join(procfs_root, "proc/net/sockstat"), "w") as out_file:
+            out_file.write("TCP: inuse {0} orphan 0 tw {1} alloc {0} mem 0\n"
+                           .format(args.sockets - args.sockets * 2 // 10, args.sockets * 2 // 10))
+        common_lib.ProcFile.root = procfs_root
+        for max_sockets in (args.sockets, 100000, 10000):
+            stat = smi.SocketStats(max_sockets)
+            stat.use_netlink = False
+            samples = []
+            for _ in range(min(args.cycles, 10)):
+                start = time.perf_counter()
+                counts, sampled = stat.count_states()
+                samples.append((time.perf_counter() - start) * 1000)
+            samples.sort()
+            print("  {0} sockets, socket-max {1:>8}: {2:>8.2f} ms p50, sampled {3}, "
+                  "established {4} time_wait {5} listen {6}".format(
+                      args.sockets, max_sockets, percentile(samples, 0.5), sampled,
+                      counts[1], counts[stat.TIME_WAIT], counts[stat.LISTEN]))
+    # the netlink dump of this host's sockets, if available
+    common_lib.ProcFile.root = "/"
+    stat = smi.SocketStats(100000)
+    if stat.use_netlink:
+        samples = []
+        for _ in range(min(args.cycles, 10)):
+            start = time.perf_counter()
+            counts, sampled = stat.count_states()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        print("  netlink, this host ({0} sockets): {1:.3f} ms p50".format(
+            sum(counts), percentile(samples, 0.5)))
+
+
+def bench_scaling(args):
+    """Collection loop scaling curves, each point is run in a fresh process for peak RSS"""
+    points = [dict(cores=cores) for cores in (4, 16, 64, 128, 256, 512)]
+    points += [dict(disks=devices, nics=devices, mounts=devices)
+               for devices in (10, 100, 1000, 5000)]
+    for index, point in enumerate(points):
+        command = [sys.executable, os.path.abspath(__file__), "collect",
+                   "--cycles", str(args.cycles)]
+        for key in ("cores", "disks", "nics", "mounts", "gpus"):
+            command += ["--{0}".format(key), str(point.get(key, getattr(args, key)))]
+        if index:
+            command.append("--no-header")
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        # drop the benchmark description line
+        print("".join(output.splitlines(True)[1:]), end="", flush=True)
+
+
+def bench_startup(args):
+    """Startup of a dry run: module import, time until initialised and RSS once initialised"""
+    runs = min(args.cycles, 10)
+    import_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import system_metrics_influx"], check=True)
+        import_times.append((time.perf_counter() - start) * 1000)
+    init_times = []
+    rss = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "system_metrics_influx.py", "--dry-run",
+                                    "--log-stdout"], stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        for line in process.stdout:
+            if b"Initialised successfully" in line:
+                break
+        init_times.append((time.perf_counter() - start) * 1000)
+        with open("/proc/{0}/status".format(process.pid), "rb") as status:
+            for line in status:
+                if line.startswith(b"VmRSS:"):
+                    rss.append(int(line.split()[1]) / 1024)
+        process.send_signal(subprocess.signal.SIGINT)
+        process.communicate()
+    print("  import      {0:>8.1f} ms (median of {1})".format(percentile(sorted(import_times),
+                                                                       0.5), runs))
+    print("  initialised {0:>8.1f} ms, {1:.1f} MiB RSS".format(percentile(sorted(init_times), 0.5),
+                                                            percentile(sorted(rss), 0.5)))
+
+
+BENCHMARKS = collections.OrderedDict([
+    ["serializer", bench_serializer],
+    ["aggregate", bench_aggregate],
+    ["collect", bench_collect],
+    ["memory", bench_memory],
+    ["processes", bench_processes],
+    ["cgroups", bench_cgroups],
+    ["sockets", bench_sockets],
+    ["scaling", bench_scaling],
+    ["startup", bench_startup],
+])
+
+
+def main():
+    """Parses args and runs the selected benchmarks"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS.keys()),
+                        help="Benchmarks to run. Available: {0}"
+                        .format(", ".join(BENCHMARKS.keys())))
+    parser.add_argument("--cycles", default=200, type=int, help="Cycles to time. Default is 200")
+    parser.add_argument("--cores", default=128, type=int,
+                        help="Synthetic logical CPU count. Default is 128")
+    parser.add_argument("--disks", default=8, type=int, help="Synthetic disks. Default is 8")
+    parser.add_argument("--nics", default=4, type=int, help="Synthetic nics. Default is 4")
+    parser.add_argument("--mounts", default=8, type=int,
+                        help="Synthetic mountpoints. Default is 8")
+    parser.add_argument("--processes", default=20000, type=int,
+                        help="Synthetic processes for the processes benchmark. Default is 20000")
+    parser.add_argument("--cgroups", default=200, type=int,
+                        help="Synthetic cgroups for the cgroups benchmark. Default is 200")
+    parser.add_argument("--sockets", default=1000000, type=int,
+                        help="Synthetic TCP sockets for the sockets benchmark. Default is 1000000")
+    parser.add_argument("--gpus", default=0, type=int, help="Synthetic GPUs. Default is 0")
+    parser.add_argument("--no-header", action="store_true",
+                        help="Omits table headers, used by the scaling benchmark")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark {0}".format(name))
+    for name in args.benchmarks:
+        print("{0}: {1}".format(name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    smi.LOGGER = logging.getLogger("benchmark")
+    main()
@@ -1,11 +1,18 @@
 """Common classes and methods for sharing between installer, main program and plugins"""
 import os
+import pickle
+import re
+import struct
 import time
 import traceback
 
 import yaml
 
 
+# measurements written as a single row with the wide-rows option, and the tag they replace
+WIDE_TAGS = dict(cpu="cpu", diskio="disk", netio="nic")
+
+
 class InternalConfig:
     """Stores internal metrics config"""
     config_path = "configured/main.yaml"
@@ -32,17 +39,173 @@ class BaseStat:
     """Base stats class for shared methods"""
     collect_interval = 0
     target_time = 0
+    # seconds between collections of the stat, None is every collect interval
+    interval = None
 
     @classmethod
     def set_time(cls, target_time):
         """Sets the target time of the stats collection"""
         cls.target_time = target_time
 
+    @classmethod
+    def default_time_needed(cls):
+        """Returns the default time needed by get_stats, 0.2s scaled down for short intervals"""
+        return min(0.2, cls.collect_interval / 5)
+
+    @classmethod
+    def default_timeout(cls, time_needed):
+        """Returns the default time get_stats can run for, most of the collect interval
+
+        A stat which is slow under load still reports, while a hung stat is given up on before
+        its next collection is due
+        """
+        return max(cls.collect_interval * 3 / 4, time_needed + cls.collect_interval / 10)
+
     @staticmethod
     def current_time():
         """Returns the current time for use by plugins"""
         return time.time()
 
+
+class Point:
+    """A point with a fixed set of fields, which a stat can reuse across collections
+
+    Stats can return Points instead of dicts, updating the values of the same Point each
+    collection, which avoids allocating a dict (and tags dict) per point every cycle.
+    The serializer caches the escaped measurement, tags and field keys on the Point, so the
+    measurement, tags and keys must not be changed once it has been returned.
+    Values which are None are not written.
+    """
+    __slots__ = ("measurement", "tags", "keys", "values", "line_prefix", "line_keys")
+
+    def __init__(self, measurement, keys, tags=None):
+        self.measurement = measurement
+        self.tags = tags
+        self.keys = tuple(keys)
+        self.values = [None] * len(self.keys)
+        self.line_prefix = None
+        self.line_keys = None
+
+    def fields(self):
+        """Returns (key, value) pairs of the fields"""
+        return zip(self.keys, self.values)
+
+    def as_dict(self):
+        """Returns the point as a stat result dict"""
+        dataset = {"measurement": self.measurement, **dict(self.fields())}
+        if self.tags:
+            dataset["tags"] = self.tags
+        return dataset
+
+
+class ProcFile:
+    """A procfs/sysfs file which is kept open and re-read with pread into a reused buffer
+
+    Use ProcFile.open, which returns None when the file is unavailable (eg not on Linux)
+    so callers can fall back to psutil.
+    """
+    root = "/"
+    number = re.compile(rb"[ \t]*(-?\d+)")
+
+    def __init__(self, path, buffer_size=4096):
+        self.path = os.path.join(self.root, path.lstrip("/"))
+        self.fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        self.buffer = bytearray(buffer_size)
+        self.size = 0
+
+    @classmethod
+    def open(cls, path, buffer_size=4096):
+        """Returns a ProcFile for the path, or None if it can't be opened"""
+        try:
+            return cls(path, buffer_size)
+        except OSError:
+            return None
+
+    def read(self):
+        """Re-reads the file into the buffer, growing it if needed, and returns the size read"""
+        while True:
+            if hasattr(os, "preadv"):
+                size = os.preadv(self.fd, [self.buffer], 0)
+            else:
+                data = os.pread(self.fd, len(self.buffer), 0)
+                size = len(data)
+                self.buffer[:size] = data
+            if size < len(self.buffer):
+                self.size = size
+                return size
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def lines(self):
+        """Re-reads the file and returns its lines"""
+        self.read()
+        return self.buffer[:self.size].splitlines()
+
+    def value(self, key, reread=True):
+        """Returns the integer following key at the start of a line (eg b"MemTotal:")
+
+        Only the requested line is parsed. Returns None if the key is not present.
+        Pass reread=False to parse the data from the last read.
+        """
+        if reread:
+            self.read()
+        if self.buffer.startswith(key):
+            index = 0
+        else:
+            index = self.buffer.find(b"\n" + key, 0, self.size)
+            if index == -1:
+                return None
+            index += 1
+        match = self.number.match(self.buffer, index + len(key), self.size)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def close(self):
+        """Closes the file"""
+        os.close(self.fd)
+
+
+class FramedStream:
+    """Pickled messages framed over a pair of trio streams, used to talk to plugin workers
+
+    Each frame is a header (payload length, sequence number, message type) and the payload.
+    """
+    header = struct.Struct("<IIB")
+    CALL, RESULT, ERROR, LOG = range(4)
+
+    def __init__(self, send_stream, receive_stream):
+        self.send_stream = send_stream
+        self.receive_stream = receive_stream
+        self.buffer = bytearray()
+
+    async def send(self, seq, kind, message):
+        """Sends a message"""
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        await self.send_stream.send_all(self.header.pack(len(payload), seq, kind) + payload)
+
+    async def fill(self, size):
+        """Buffers at least size bytes, raises EOFError if the stream is closed"""
+        while len(self.buffer) < size:
+            data = await self.receive_stream.receive_some(65536)
+            if not data:
+                raise EOFError("Stream closed")
+            self.buffer += data
+
+    async def receive(self):
+        """Returns the next (seq, kind, message)
+
+        A frame is only removed from the buffer once all of it has been received, so a receive
+        cancelled part way through a frame (eg by a timeout) leaves the stream in sync
+        """
+        await self.fill(self.header.size)
+        size, seq, kind = self.header.unpack_from(self.buffer)
+        end = self.header.size + size
+        await self.fill(end)
+        payload = bytes(self.buffer[self.header.size:end])
+        del self.buffer[:end]
+        return seq, kind, pickle.loads(payload)
+
+
 def format_error(exc_info, message="", message_before=False):
     """Returns a string of formatted exception info"""
     if message:
@@ -5,6 +5,7 @@ import json
 import os
 import io
 import pwd
+import re
 import shutil
 import getpass
 import readline
@@ -98,7 +99,8 @@ def main():
     if required_deps:
         if answer_convert(input("Install python dependencies? (y/n): ")):
             print("Installing python modules")
-            if pip_install("-r requirements.txt", pip_prefix):
+            # the influxdb module is only used by the installer to set up the database
+            if pip_install("-r requirements.txt influxdb", pip_prefix):
                 print("Done")
             else:
                 print("Error installing python modules")
@@ -328,6 +330,12 @@ def setup_grafana():
     except ImportError:
         print("Psutil module not found, please install dependencies")
         return False
+    wide_rows = answer_convert(input("Configure the dashboard for wide rows? (only if the "
+                                     "wide-rows option is enabled) (y/n): "))
+    if wide_rows:
+        wide_devices = dict(cpu=list(range(psutil.cpu_count())),
+                            disk=sorted(psutil.disk_io_counters(perdisk=True).keys()),
+                            nic=sorted(psutil.net_io_counters(pernic=True).keys()))
     template = json.load(open(template_name, "r"))
     config = InternalConfig()
     out_config = copy.deepcopy(template)
@@ -348,6 +356,9 @@ def setup_grafana():
         out_config["panels"][index - index_shift]["gridPos"]["y"] = new_y - current_y_shift
         if item["title"] == "CPU (%)":
             out_config["panels"][index - index_shift]["yaxes"][0]["max"] = psutil.cpu_count() * 100
+        if wide_rows:
+            for target in out_config["panels"][index - index_shift].get("targets", []):
+                widen_target(target, wide_devices)
         if item["title"] in ("GPU utilisation", "GPU memory usage",
                              "GPU temperature / fanspeed", "GPU frequencies",
                              "GPU power usage"):
@@ -440,6 +451,33 @@ def setup_grafana():
     return True
 
 
+def widen_target(target, wide_devices):
+    """Converts a target grouped by a cpu/device tag to select the wide row field of each
+    cpu/device (eg util_17) instead"""
+    from common_lib import WIDE_TAGS
+    tags = [tag for tag in target.get("tags", [])
+            if tag["key"] == WIDE_TAGS.get(target.get("measurement"))]
+    if not tags:
+        return
+    tag = tags[0]
+    device_filter = re.compile(tag["value"].strip("/"))
+    field = target["select"][0][0]["params"][0]
+    selectors = target["select"][0][1:]
+    target["select"] = []
+    for device in wide_devices[tag["key"]]:
+        if not device_filter.search(str(device)):
+            continue
+        tag_alias = "$tag_{0}".format(tag["key"])
+        alias = target.get("alias", tag_alias).replace(tag_alias, str(device))
+        target["select"].append([{"params": ["{0}_{1}".format(field, device)], "type": "field"}]
+                                + copy.deepcopy(selectors)
+                                + [{"params": [alias], "type": "alias"}])
+    target["alias"] = "$col"
+    target["tags"] = [item for item in target["tags"] if item is not tag]
+    target["groupBy"] = [item for item in target["groupBy"]
+                         if not (item["type"] == "tag" and item["params"] == [tag["key"]])]
+
+
 def systemd_install():
     """Installs the app as a systemd service"""
     template_name = "data/systemd_template.txt"
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Runs a plugin stat class in a worker process, started by system_metrics_influx.py
+
+Usage: plugin_worker.py module | module:index [module:index ...]
+
+With a module, the worker sends a description of each class in the module's
+ACTIVATED_METRICS and exits. With module:index specs, the worker hosts those classes (the
+worker pool shares each worker between several classes): it initialises each class, sends
+a description or initialisation error for each, then runs calls (slot, method) from stdin
+until stdin is closed, where slot is the position of the class in the specs and method is
+init_fetch, poll_stats or get_stats. Messages are FramedStream frames; stdout is reserved
+for them, so anything the plugin prints goes to stderr and log records are forwarded to the
+main process.
+"""
+import importlib
+import inspect
+import logging
+import os
+import signal
+import sys
+
+import trio
+
+if sys.version_info < (3, 11):
+    # installed with trio on older versions
+    from exceptiongroup import BaseExceptionGroup # pylint: disable=redefined-builtin
+
+from common_lib import BaseStat, FramedStream, format_error
+
+
+class ForwardingHandler(logging.Handler):
+    """Buffers log records so they can be forwarded to the main process"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.name, record.levelno, self.format(record)))
+
+
+def describe(stat_class):
+    """Returns the description of a stat class used by the main process"""
+    return dict(name=stat_class.name, poll_stats=hasattr(stat_class, "poll_stats"),
+                init_fetch=hasattr(stat_class, "init_fetch"),
+                interval=getattr(stat_class, "interval", None),
+                timeout=getattr(stat_class, "timeout", None),
+                time_needed=getattr(stat_class, "time_needed", None))
+
+
+async def send(stream, handler, seq, kind, message):
+    """Sends any buffered log records, then the message"""
+    records, handler.records = handler.records, []
+    for record in records:
+        await stream.send(seq, FramedStream.LOG, record)
+    await stream.send(seq, kind, message)
+
+
+async def initialise(spec):
+    """Returns the stat object and description of a module:index spec, or None and an error"""
+    module_name, _, index = spec.rpartition(":")
+    try:
+        stat_class = importlib.import_module(module_name).ACTIVATED_METRICS[int(index)]
+        stat_object = stat_class()
+        if hasattr(stat_object, "async_init"):
+            await stat_object.async_init()
+    except Exception:
+        return None, format_error(sys.exc_info(), message="Plugin worker initialisation failed")
+    return stat_object, describe(stat_class)
+
+
+async def serve(specs, frames_fd, handler):
+    """Describes a module, or runs calls for the classes in specs"""
+    stream = FramedStream(trio.lowlevel.FdStream(frames_fd),
+                          trio.lowlevel.FdStream(os.dup(sys.stdin.fileno())))
+    if ":" not in specs[0]:
+        try:
+            module = importlib.import_module(specs[0])
+            descriptions = [describe(stat_class) for stat_class in module.ACTIVATED_METRICS]
+        except Exception:
+            await send(stream, handler, 0, FramedStream.ERROR,
+                       format_error(sys.exc_info(), message="Plugin worker failed to describe "
+                                    "{0}".format(specs[0])))
+        else:
+            await send(stream, handler, 0, FramedStream.RESULT, descriptions)
+        return
+    stat_objects = []
+    results = []
+    for spec in specs:
+        stat_object, result = await initialise(spec)
+        stat_objects.append(stat_object)
+        results.append(result)
+    # each result is a description, or the error string if the class failed to initialise
+    await send(stream, handler, 0, FramedStream.RESULT, results)
+    while True:
+        try:
+            seq, _, (slot, method, target_time, collect_interval) = await stream.receive()
+        except EOFError:
+            # the main process has exited or closed the worker
+            return
+        BaseStat.collect_interval = collect_interval
+        BaseStat.set_time(target_time)
+        try:
+            result = getattr(stat_objects[slot], method)()
+            if inspect.isawaitable(result):
+                result = await result
+            kind = FramedStream.RESULT
+        except (Exception, BaseExceptionGroup):
+            result = format_error(sys.exc_info())
+            kind = FramedStream.ERROR
+        await send(stream, handler, seq, kind, result)
+
+
+def main():
+    """Sets up stdout, signals and logging, then serves the module"""
+    # the worker exits when the main process closes its stdin, rather than on ctrl+c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # stdout is used for frames, so prints from the plugin are redirected to stderr
+    frames_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    handler = ForwardingHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(handler)
+    trio.run(serve, sys.argv[1:], frames_fd, handler)
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    main()
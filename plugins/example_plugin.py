@@ -13,18 +13,33 @@ To create a plugin:
 - Set a name as a class attribute, this is used as a human readable name in debug output and errors
 - Optional: add a time_needed class attribute if your get_stats needs more time to run
     - The poll_stats method is always started immediately regardless of this
+- Optional: add an interval class attribute (in seconds) if your stats don't need collecting every collect interval
+    - It is rounded to a multiple of the collect interval, and can be overridden with the stat-intervals option
 - Optional: create an __init__ method for any immediate initialisation
 - Optional: create an async_init method; use this if you have async initialisation to do
-    - async_init is always called immediately after object initialisation
+    - async_init is called after all stats are created, concurrently with the other stats' async_init, and before init_fetch
+    - If async_init raises, the stat is disabled and the others carry on
 - Optional: create an init_fetch method; use this to initialise a value if you are tracking how it changes over time
 - Create an async method called get_stats, this is where your plugin actually collects data
+    - If get_stats makes blocking calls (eg file/network IO or a C library), make it a regular (non async) method instead
+    - Non async get_stats methods are run on a pool of worker threads, so they can't hold up the other stats
+- Optional: add a timeout class attribute (in seconds) to change how long get_stats is allowed to run
+    - The default is three quarters of the collect interval (at least time_needed plus a tenth of it), results from a get_stats which times out are dropped
+    - If a non async get_stats times out, the attributes of the class are restored to before that call once it finishes, so deltas are from the last sample used
+    - Timeouts and overruns of the target time are logged and recorded for each plugin in the internal metrics
 - Return collected data from get_stats, all data must be returned here
+    - For many points with the same fields each collection (eg per device), return common_lib.Point objects
+      created once and update their values in place, rather than building new dicts every collection
 - Optional: add a poll_stats method; use this if you want to poll something for data (eg CPU clocks)
     - This method must return before the target time and give your get_stats enough time to run
 - Add the created class to an array called ACTIVATED_METRICS in the main scope
 
 Things to know when creating a plugin:
 - If poll_stats is present, get_stats will be run even if poll_stats errors
+- A plugin can be run in worker processes with the isolated-plugins option (eg if it is CPU heavy or could crash)
+    - The classes run in a pool of workers (isolated-workers), and the same methods are called in the same way
+    - Classes sharing a worker run one at a time, and are restarted together if one crashes or hangs
+    - Results and class attributes must be picklable, and anything printed goes to stderr
 
 If you have further questions, please do open an issue on GitHub; I'm happy to answer any queries :)
 """
@@ -2,17 +2,31 @@
 """
 Overall design:
 - Load configuration from command line options and config file
-- Create influxdb connection
+- Create influxdb client (pooled keep-alive HTTP connections, created on first write)
 - Load all .py files inside the plugins folder, and load all classes in their ACTIVATED_METRICS
-- Initialise all stat classes (including async_init)
-- Run the init_fetch methods of all stat classes (only if present)
+    - Isolated plugins are only loaded in a pool of worker processes (plugin_worker.py), with
+      the classes spread over the workers and a PluginWorker proxy for each in the main process
+- Initialise all stat classes
+- Run the async_init then init_fetch methods of all stat classes (only if present), with the
+  stat classes initialised concurrently
+    - Slow backends (eg nvml) are set up in async_init on a thread
     - This allows stats to get an initial reading for metrics which record the change in a value over time
 - Start the influx_write and stats_handler functions
+    - With relay-listen, a RelayServer also receives batches from other agents over TCP/UDP
+      and sends them through the same data channel as the local stats
+    - With relay, influx_write sends to the relay with RelayClient instead of writing to influx
+    - With the udp transport, influx_write sends datagrams with InfluxUDPClient instead
     In influx_write
-    - Read data sent by stats_handler and write it to influxdb
+    - Read line protocol sent by stats_handler and batch it
+        - A batch is written once it has batch_cycles cycles, batch_points points
+          or has been held for batch_delay seconds, whichever comes first
+    - Write each batch to influxdb
+    - If spooling is enabled, failed writes are appended to the on-disk spool
+        - spool_replay replays the spool oldest first once writes succeed again
     - Repeat until data channel closed by stats_handler
     In stats_handler
-    - Initialise the target time to the next + 1 integer second
+    - Initialise the target time to the next interval boundary at least 1s away
+        - The target time is kept in integer nanoseconds so it doesn't drift with fractional intervals
     - Set target_time on BaseStat (used by continuous stats)
     - Loop indefinitely, check exit conditions at start of loop
         - Exit conditions checked:
@@ -26,21 +40,32 @@ Overall design:
         - Wait until target_time - collect_interval
         - Call collect_stats
             In collect stats
+            - Only stats which are due this cycle are collected
+                - Stats can be collected less often using stat_intervals or an interval attribute
             - Calculates start times for each stat class, checking for a time_needed attribute
-                - Default is 0.2s (before target time) if not specified
+                - Default is 0.2s (before target time) if not specified, scaled down to
+                  collect_interval / 5 for shorter intervals
             - All continuous stats are started immediately
             - Start stats when their start time is met (respecting time_needed)
+                - Stats with a non async get_stats (blocking) are run on a pool of worker threads
+                - get_stats is cancelled (or its thread abandoned) if it exceeds its timeout
+                - Timeouts and overruns of the target time are counted for each stat
             - Return when everything has finished
         - Errors are checked for and logged
-        - Data is formatted for influx
-        - Formatted data is sent through the data channel to influx_write
+        - Data is serialized to influx line protocol (prefixes for each measurement/tag set are cached)
+            - With aggregation, results are added to per field accumulators instead and the
+              aggregates are serialized at the end of each window, the raw data can also be
+              sent to a second influx_write for the raw database
+            - Fields with an emission policy are skipped unless changed or due a keyframe
+        - Serialized data is sent through the data channel to influx_write
+            - If spooling is enabled and the channel is full, the data is spooled instead
         - Target time incremented
     - When exiting, wait for the influx data channel to empty and then close it
 
 
 Data:
 
-Data comes from psutil unless otherwise stated
+Data comes from procfs/sysfs (or psutil where unavailable) unless otherwise stated
 All values are expressed in their base units e.g bytes instead of gigabytes
 Percentages are stored as 0-100 (float)
 Database measurement names are in brackets
@@ -55,7 +80,13 @@ Nvidia (nvidia):
     gpu utilisation, memory (bandwidth) utilisation and memory usage
 Memory (memory):
     Memory usage
-    usage, total and percentage
+    usage, total, percentage, available, free, buffers, cache, dirty, writeback, shmem, slab
+    and swap usage/total
+    Paging rates (from /proc/vmstat): page faults, major faults, page in/out and swap in/out
+    (bytes/s) and OOM kills
+Pressure (pressure):
+    Pressure stall information, only recorded if the kernel supports it
+    % of time some/all tasks were stalled on cpu, memory and io
 Disk usage (disk):
     Disk usage per specified mountpoint
     used and total
@@ -65,70 +96,293 @@ Disk I/O (diskio):
     number of merged reads/writes, time spent busy,
     time spent reading/writing
 Network I/O (netio):
-    Network I/O per nic
+    Network I/O per specified nic
     sent/received bytes and sent/received packets
+    Optionally the total of all virtual nics (tagged nic=virtual_total)
+Sockets (sockets):
+    TCP sockets by state (from netlink sock_diag, or /proc/net/tcp), scaled to the totals
+    in /proc/net/sockstat past socket-max sockets, and the fraction counted (sampled)
+    TCP counters (/s): active/passive opens, attempt fails, resets, segments in/out,
+    retransmits, errors, listen overflows/drops, SYN retransmits and timeouts
+    UDP counters (/s): datagrams in/out, no ports, errors and buffer errors
 Sensors (sensors):
     CPU temperature (°C)
 Miscellaneous (misc):
     System load (1, 5, 15 minutes) (from os)
     Total processes
     System uptime
+Cgroups (cgroup):
+    Only recorded if cgroups is enabled
+    Per cgroup (tagged by its path in the cgroup v2 tree)
+    CPU usage (total, user, system, throttled), memory usage, read/write bytes and operations
+    and pressure stalls (% of time some/all tasks stalled on cpu, memory and io)
+Processes (process):
+    Only recorded if top-processes is set
+    Top processes by CPU usage, RSS and IO, tagged by the metric (top) and rank
+    pid, name, cmdline, CPU usage (% of one CPU), RSS and read/write bytes
+Internal (smi_internal):
+    Only recorded if internal-metrics is enabled
+    Per stat class (tagged by stat): poll/get wall and CPU time, time_needed, slack
+    (time left before the target time), points and bytes
+    Overall: points, bytes, loop lag, write channel depth, write latency, batch points,
+    agent CPU usage (%) and RSS
 
 Timers:
-target_time - targetted end time of the fetch - data saved to the db under this value
+target_time - targetted end time of the fetch (float seconds) - data saved to the db under this value
+    Timestamps are written with the configured precision (s, ms, u or n)
 last_end_time - precise end time stored internally in each class for delta monitors
 """
 # pylint: disable=logging-format-interpolation
 import argparse
+import array
+import base64
 import collections
 import copy
+import ctypes
+import ctypes.util
 import functools
+import gzip
+import heapq
 import importlib
+import inspect
 import logging
 import math
+import numbers
+import operator
 import os
 import re
+import resource
+import select
 import signal
-import statistics
+import socket
+import struct
+import subprocess
 import sys
+import threading
 import time
+import urllib.parse
+import zlib
 
-import influxdb
 import psutil
 import trio
 import yaml
 
-from common_lib import BaseStat, InternalConfig, format_error
+if sys.version_info < (3, 11):
+    # installed with trio on older versions
+    from exceptiongroup import BaseExceptionGroup # pylint: disable=redefined-builtin
+
+# imported by load_numpy if needed
+numpy = None
+
+from common_lib import (WIDE_TAGS, BaseStat, FramedStream, InternalConfig, Point, ProcFile,
+                        format_error)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def load_numpy():
+    """Imports numpy if it is installed, returns whether it is available
+
+    numpy is slow to import and adds to the RSS, so it is only imported where it is worthwhile
+    """
+    global numpy # pylint: disable=global-statement
+    if numpy is None:
+        try:
+            numpy = importlib.import_module("numpy")
+        except ImportError:
+            return False
+    return True
 
 #
 # stat classes
 #
 
 class CPUStats(BaseStat):
-    """All CPU related stats"""
+    """All CPU related stats
+
+    Per cpu times and frequency samples are held in preallocated arrays (numpy if available and
+    there are at least numpy_min_cpus cpus), so utilisation and mean frequencies are computed
+    for all cpus at once
+    """
     name = "CPU"
+    min_poll_interval = 0.02
+    numpy_min_cpus = 16
+    time_fields = ("user", "nice", "system", "idle", "iowait", "irq", "softirq")
     def __init__(self):
-        self.cpu_time_fields = psutil.cpu_times_percent(interval=None)._fields
-        self.cpu_stats_fields = psutil.cpu_stats()._fields
-        self.poll_data = dict(freq=[])
+        self.freq_samples = 0
         self.poll_success = False
-        self.cpu_persistent = []
+        self.cpu_persistent = {}
         self.last_end_time = 0
+        self.proc_stat = ProcFile.open("/proc/stat", 65536)
+        self.freq_files = None
+        if self.proc_stat is not None:
+            self.proc_stat.read()
+            if (self.proc_stat.buffer.count(b"\ncpu", 0, self.proc_stat.size)
+                    >= self.numpy_min_cpus):
+                load_numpy()
+            self.times_persistent = self.read_total_times()
+            self.cpu_ids, self.percpu_persistent = self.read_percpu_times()
+            freq_files = [
+                ProcFile.open("/sys/devices/system/cpu/cpu{0}/cpufreq/scaling_cur_freq"
+                              .format(cpu_id), 64)
+                for cpu_id in self.cpu_ids
+            ]
+            if None not in freq_files:
+                self.freq_files = freq_files
+        else:
+            self.cpu_ids = list(range(psutil.cpu_count()))
+            # prime the psutil percentages
+            psutil.cpu_times_percent(interval=None)
+            psutil.cpu_percent(percpu=True)
+        self.cpu_points = self.create_points(self.cpu_ids)
+        self.freq_sum = self.zeros(len(self.cpu_ids))
+
+    @staticmethod
+    def create_points(cpu_ids):
+        """Returns the per cpu Points, which are reused each collection"""
+        return [Point("cpu", ("util", "freq"), {"cpu": cpu_id}) for cpu_id in cpu_ids]
+
+    @staticmethod
+    def zeros(size):
+        """Returns a preallocated float array"""
+        if numpy is None:
+            return array.array("d", bytes(8 * size))
+        return numpy.zeros(size)
+
+    def read_counters(self):
+        """Returns the context switch and interrupt counters"""
+        if self.proc_stat is None:
+            cpu_stats = psutil.cpu_stats()
+            return dict(ctx_switches=cpu_stats.ctx_switches, interrupts=cpu_stats.interrupts)
+        # parses the last read of /proc/stat
+        return dict(ctx_switches=self.proc_stat.value(b"ctxt", reread=False),
+                    interrupts=self.proc_stat.value(b"intr", reread=False))
+
+    def read_total_times(self):
+        """Returns the aggregate time counters from the last read of /proc/stat"""
+        end = self.proc_stat.buffer.find(b"\n", 0, self.proc_stat.size)
+        return [int(item) for item in self.proc_stat.buffer[4:end].split()]
+
+    def read_percpu_times(self):
+        """Returns the cpu ids and per cpu (total, idle) time arrays from the last /proc/stat read
+
+        Total time excludes guest time, which is already included in user and nice
+        """
+        buffer = self.proc_stat.buffer
+        start = buffer.find(b"\n") + 1
+        end = buffer.find(b"\n", buffer.rfind(b"\ncpu", 0, self.proc_stat.size) + 1)
+        # stripping the cpu prefix leaves the cpu id as the first column
+        block = bytes(buffer[start:end]).translate(None, b"cpu")
+        rows = block.count(b"\n") + 1
+        if numpy is not None:
+            values = numpy.array(block.split(), dtype=numpy.int64).reshape(rows, -1)
+            totals = values[:, 1:9].sum(axis=1)
+            idles = values[:, 4] + values[:, 5]
+            return values[:, 0].tolist(), (totals, idles)
+        values = array.array("q", map(int, block.split()))
+        width = len(values) // rows
+        totals = array.array("q", (sum(values[index + 1:index + 9])
+                                   for index in range(0, len(values), width)))
+        idles = array.array("q", (values[index + 4] + values[index + 5]
+                                  for index in range(0, len(values), width)))
+        return values[::width].tolist(), (totals, idles)
+
+    def read_times(self):
+        """Re-reads /proc/stat, returning the time percentages and per cpu utilisation since
+        the last call"""
+        self.proc_stat.read()
+        total = self.read_total_times()
+        old_total = self.times_persistent
+        self.times_persistent = total
+        total_delta = (sum(total) - sum(total[8:10])) - (sum(old_total) - sum(old_total[8:10]))
+        times = {}
+        for index, field in enumerate(self.time_fields):
+            if total_delta > 0:
+                percent = (total[index] - old_total[index]) / total_delta * 100
+                times[field] = round(min(max(percent, 0.0), 100.0), 1)
+            else:
+                times[field] = 0.0
+        cpu_ids, (totals, idles) = self.read_percpu_times()
+        old_totals, old_idles = self.percpu_persistent
+        self.percpu_persistent = (totals, idles)
+        if cpu_ids != self.cpu_ids:
+            LOGGER.info("CPUs changed from {0} to {1}, hotplugged?".format(len(self.cpu_ids),
+                                                                          len(cpu_ids)))
+            self.cpu_ids = cpu_ids
+            self.cpu_points = self.create_points(cpu_ids)
+            self.freq_files = None
+            return times, [0.0] * len(cpu_ids)
+        if numpy is not None:
+            deltas = totals - old_totals
+            busy = deltas - (idles - old_idles)
+            utilisation = numpy.divide(busy * 100.0, deltas, out=numpy.zeros(len(deltas)),
+                                       where=deltas > 0)
+            return times, numpy.clip(utilisation, 0.0, 100.0).round(1).tolist()
+        utilisation = []
+        for new, old, new_idle, old_idle in zip(totals, old_totals, idles, old_idles):
+            delta = new - old
+            if delta > 0:
+                percent = (delta - new_idle + old_idle) / delta * 100
+                utilisation.append(round(min(max(percent, 0.0), 100.0), 1))
+            else:
+                utilisation.append(0.0)
+        return times, utilisation
+
+    def read_utilisation(self):
+        """Returns the time percentages and per cpu utilisation since the last call"""
+        if self.proc_stat is None:
+            times = psutil.cpu_times_percent(interval=None)._asdict()
+            return times, psutil.cpu_percent(percpu=True)
+        return self.read_times()
+
+    def sample_frequencies(self):
+        """Adds the current frequency of each cpu (in kHz) to the running sums"""
+        if self.freq_files is None:
+            sample = [item.current * 1000 for item in psutil.cpu_freq(percpu=True)]
+        elif numpy is not None:
+            sample = numpy.fromiter((freq_file.value(b"") for freq_file in self.freq_files),
+                                    numpy.float64, len(self.freq_files))
+        else:
+            sample = [freq_file.value(b"") for freq_file in self.freq_files]
+        if len(sample) != len(self.freq_sum):
+            self.freq_sum = self.zeros(len(sample))
+            self.freq_samples = 0
+        if numpy is not None:
+            self.freq_sum += sample
+        else:
+            for index, value in enumerate(sample):
+                self.freq_sum[index] += value
+        self.freq_samples += 1
+
+    def mean_frequencies(self):
+        """Returns the mean frequency of each cpu in Hz since the last call"""
+        scale = 1000 / self.freq_samples
+        if numpy is not None:
+            frequencies = numpy.rint(self.freq_sum * scale).astype(numpy.int64).tolist()
+            self.freq_sum.fill(0)
+        else:
+            frequencies = [round(value * scale) for value in self.freq_sum]
+            self.freq_sum = self.zeros(len(self.freq_sum))
+        self.freq_samples = 0
+        return frequencies
 
     async def init_fetch(self):
         """Fetches stats for post-initialisation"""
-        self.cpu_persistent = psutil.cpu_stats()
+        if self.proc_stat is not None:
+            self.proc_stat.read()
+            self.times_persistent = self.read_total_times()
+            self.cpu_ids, self.percpu_persistent = self.read_percpu_times()
+        self.cpu_persistent = self.read_counters()
         self.last_end_time = self.current_time()
 
     async def poll_stats(self):
         """Fetches the polling stats"""
-        self.poll_data = dict(freq=[])
         self.poll_success = False
         initial = True
-        while (self.current_time() < self.target_time - 0.2) or initial:
+        while (self.current_time() < self.target_time - self.default_time_needed()) or initial:
             initial = False
-            self.poll_data["freq"].append(psutil.cpu_freq(percpu=True))
-            next_poll_time = self.current_time() + self.collect_interval / 10
+            self.sample_frequencies()
+            next_poll_time = self.current_time() + max(self.collect_interval / 10,
+                                                       self.min_poll_interval)
             if next_poll_time > self.target_time:
                 break
             await sleep_until(next_poll_time)
@@ -136,29 +390,30 @@ class CPUStats(BaseStat):
 
     async def get_stats(self):
         """Fetches the point stats and pushes to out_data"""
-        current_stats = psutil.cpu_stats()
-        times = psutil.cpu_times_percent(interval=None)
-        utilisation = psutil.cpu_percent(percpu=True)
+        times, utilisation = self.read_utilisation()
+        current_stats = self.read_counters()
         time_delta = self.current_time() - self.last_end_time
         self.last_end_time = self.current_time()
-        stats_delta = [round((current_stats[i] - self.cpu_persistent[i]) / time_delta)
-                       for i in range(len(current_stats))]
-        self.cpu_persistent = current_stats
-        if self.poll_success:
-            frequencies = [round(statistics.mean([y.current * 1000000 for y in x]))
-                           for x in zip(*self.poll_data["freq"])]
         out_data = [{"measurement": "cpu"}]
-        for item in ["ctx_switches", "interrupts"]:
-            out_data[0][item] = stats_delta[self.cpu_stats_fields.index(item)]
-        for index, item in enumerate(utilisation):
-            data_point = {"measurement": "cpu", "util": item, "tags": {"cpu": index}}
-            if self.poll_success:
-                data_point["freq"] = frequencies[index]
-            out_data.append(data_point)
-        for index, item in enumerate(times):
-            field = self.cpu_time_fields[index]
-            if field in ("user", "system", "iowait", "nice", "irq", "softirq"):
-                out_data[0][field] = item
+        for item, value in current_stats.items():
+            out_data[0][item] = round((value - self.cpu_persistent[item]) / time_delta)
+        self.cpu_persistent = current_stats
+        for field in ("user", "system", "iowait", "nice", "irq", "softirq"):
+            out_data[0][field] = times[field]
+        frequencies = None
+        if self.poll_success and self.freq_samples:
+            frequencies = self.mean_frequencies()
+            if len(frequencies) != len(utilisation):
+                frequencies = None
+        if frequencies is None:
+            for point, util in zip(self.cpu_points, utilisation):
+                point.values[0] = util
+                point.values[1] = None
+        else:
+            for point, util, freq in zip(self.cpu_points, utilisation, frequencies):
+                point.values[0] = util
+                point.values[1] = freq
+        out_data.extend(self.cpu_points)
         return out_data
 
 
@@ -167,18 +422,32 @@ class GPUStats(BaseStat):
     name = "GPU"
     def __init__(self):
         self.nvidia_devices = {}
+        self.device_support = {}
+        self.py3nvml = None
+
+    async def async_init(self):
+        """Sets up the nvidia backend on a thread, as importing py3nvml and nvmlInit are slow"""
+        await trio.to_thread.run_sync(self.load_nvidia)
+
+    def load_nvidia(self):
+        """Imports py3nvml and sets up the nvidia backend if it is installed"""
         try:
             import py3nvml.py3nvml as py3nvml # pylint: disable=import-outside-toplevel
             self.py3nvml = py3nvml
-            self.setup_nvidia()
         except ImportError:
             LOGGER.info("Py3nvml not found, disabling nvidia backend")
+            return
+        self.setup_nvidia()
 
     def setup_nvidia(self):
-        """Sets up nvidia backend"""
+        """Sets up nvidia backend
+
+        Which metrics each card supports is cached in the internal config for the driver
+        version, so the metrics are only probed when the cards or driver change
+        """
         self.py3nvml.nvmlInit()
-        LOGGER.debug("Detected nvidia driver: {0}"
-                     .format(self.py3nvml.nvmlSystemGetDriverVersion()))
+        driver_version = str(self.py3nvml.nvmlSystemGetDriverVersion())
+        LOGGER.debug("Detected nvidia driver: {0}".format(driver_version))
         device_count = self.py3nvml.nvmlDeviceGetCount()
         if device_count == 0:
             LOGGER.warning("Nvidia driver loaded but no devices found")
@@ -203,13 +472,22 @@ class GPUStats(BaseStat):
             max_mem_clock=[self.py3nvml.nvmlDeviceGetMaxClockInfo, self.py3nvml.NVML_CLOCK_MEM],
             fanspeed_percent=[self.py3nvml.nvmlDeviceGetFanSpeed],
         )
-        self.device_support = {}
+        capabilities = CONFIG.main.get("nvidia_capabilities")
+        if not capabilities or capabilities.get("driver_version") != driver_version:
+            capabilities = dict(driver_version=driver_version, cards={})
         for uuid, handle in self.nvidia_devices.items():
-            self.device_support[uuid] = {}
-            for test, args in self.nvidia_metrics.items():
-                self.device_support[uuid][test] = self.test_metric(args[0], handle, *args[1:])
+            support = capabilities["cards"].get(uuid)
+            if support is None or set(support) != set(self.nvidia_metrics):
+                support = {test: self.test_metric(args[0], handle, *args[1:])
+                           for test, args in self.nvidia_metrics.items()}
+                capabilities["cards"][uuid] = support
+            else:
+                LOGGER.debug("Using cached capabilities for GPU {0}"
+                             .format(CONFIG.main["nvidia_cards"][uuid]))
+            self.device_support[uuid] = support
             LOGGER.debug("GPU {0} supports {1}".format(CONFIG.main["nvidia_cards"][uuid],
                                                        self.device_support[uuid]))
+        CONFIG.save_value(dict(nvidia_capabilities=capabilities))
 
     def test_metric(self, func, *args):
         """Tests a metric to see whether it is supported"""
@@ -221,8 +499,8 @@ class GPUStats(BaseStat):
             return False
         return True
 
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, NVML calls)"""
         out_data = []
         nvidia_results = {}
         for uuid, handle in self.nvidia_devices.items():
@@ -291,8 +569,8 @@ class BatteryStats(BaseStat):
             LOGGER.info("Battery detected")
 
 
-    async def get_stats(self):
-        """Fetched the point stats and pushes to out_data"""
+    def get_stats(self):
+        """Fetched the point stats and pushes to out_data (blocking)"""
         if not self.battery_available:
             return None
         battery = psutil.sensors_battery()
@@ -313,234 +591,2798 @@ class BatteryStats(BaseStat):
         return out_data
 
 
-class MemoryStats(BaseStat):
-    """All memory related stats"""
-    name = "Memory"
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        mem_data = psutil.virtual_memory()
-        out_data = {"measurement": "memory", "total": mem_data.total,
-                    "used": mem_data.total - mem_data.available, "percent": mem_data.percent}
-        return out_data
+class MemoryStats(BaseStat):
+    """All memory related stats
+
+    /proc/meminfo and /proc/vmstat are each read once per collection, with only the needed
+    lines parsed. The vmstat counters are written as rates.
+    """
+    name = "Memory"
+    # (field, meminfo key), in kB
+    meminfo_fields = (("free", b"MemFree:"), ("buffers", b"Buffers:"), ("cached", b"Cached:"),
+                      ("dirty", b"Dirty:"), ("writeback", b"Writeback:"), ("shmem", b"Shmem:"),
+                      ("slab", b"Slab:"))
+    # (field, vmstat counter, multiplier), written as rates multiplied by the multiplier, or as
+    # the change since the last collection with a multiplier of None
+    vmstat_fields = (("page_faults", b"pgfault", 1), ("major_faults", b"pgmajfault", 1),
+                     ("page_in", b"pgpgin", 1024), ("page_out", b"pgpgout", 1024),
+                     ("swap_in", b"pswpin", PAGE_SIZE), ("swap_out", b"pswpout", PAGE_SIZE),
+                     ("oom_kills", b"oom_kill", None))
+    def __init__(self):
+        self.meminfo = ProcFile.open("/proc/meminfo")
+        self.vmstat = ProcFile.open("/proc/vmstat", 8192)
+        self.vmstat_persistent = None
+        self.last_end_time = 0
+
+    def read_vmstat(self):
+        """Returns the vmstat counters (in vmstat_fields order)"""
+        self.vmstat.read()
+        return [self.vmstat.value(counter, reread=False) for _, counter, _ in self.vmstat_fields]
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation"""
+        if self.vmstat is not None:
+            self.vmstat_persistent = self.read_vmstat()
+        self.last_end_time = self.current_time()
+
+    async def get_stats(self):
+        """Fetches the point stats and pushes to out_data"""
+        if self.meminfo is not None:
+            total = self.meminfo.value(b"MemTotal:") * 1024
+            available = self.meminfo.value(b"MemAvailable:", reread=False)
+        if self.meminfo is None or available is None:
+            mem_data = psutil.virtual_memory()
+            total = mem_data.total
+            available = mem_data.available
+            out_data = {"measurement": "memory", "total": total, "used": total - available,
+                        "percent": round((total - available) / total * 100, 1),
+                        "available": available, "free": mem_data.free}
+            swap_data = psutil.swap_memory()
+            out_data["swap_total"] = swap_data.total
+            out_data["swap_used"] = swap_data.used
+        else:
+            available *= 1024
+            out_data = {"measurement": "memory", "total": total, "used": total - available,
+                        "percent": round((total - available) / total * 100, 1),
+                        "available": available}
+            for field, key in self.meminfo_fields:
+                value = self.meminfo.value(key, reread=False)
+                out_data[field] = value * 1024 if value is not None else None
+            swap_total = self.meminfo.value(b"SwapTotal:", reread=False)
+            swap_free = self.meminfo.value(b"SwapFree:", reread=False)
+            if swap_total is not None and swap_free is not None:
+                out_data["swap_total"] = swap_total * 1024
+                out_data["swap_used"] = (swap_total - swap_free) * 1024
+        if self.vmstat is not None:
+            current_stats = self.read_vmstat()
+            time_delta = self.current_time() - self.last_end_time
+            self.last_end_time = self.current_time()
+            for index, (field, _, multiplier) in enumerate(self.vmstat_fields):
+                previous = self.vmstat_persistent[index]
+                if current_stats[index] is None or previous is None:
+                    continue
+                if multiplier is None:
+                    out_data[field] = current_stats[index] - previous
+                else:
+                    out_data[field] = round((current_stats[index] - previous) / time_delta
+                                            * multiplier)
+            self.vmstat_persistent = current_stats
+        return out_data
+
+
+class PressureStats(BaseStat):
+    """Pressure stall information (PSI) for CPU, memory and IO
+
+    The stall time totals are written as the percentage of time stalled since the last
+    collection, which is more precise than the kernel's averages. Not recorded on kernels
+    without PSI (before 4.20, or with it disabled).
+    """
+    name = "Pressure"
+    total = re.compile(rb"total=(\d+)")
+    # (file, fields), the fields are for the some then full lines
+    files = (("cpu", ("cpu_some",)), ("memory", ("memory_some", "memory_full")),
+             ("io", ("io_some", "io_full")))
+    def __init__(self):
+        self.pressure = [(ProcFile.open("/proc/pressure/{0}".format(name), 256), fields)
+                         for name, fields in self.files]
+        self.pressure = [(pressure, fields) for pressure, fields in self.pressure
+                         if pressure is not None]
+        self.totals_persistent = None
+        self.last_end_time = 0
+
+    @classmethod
+    def read_totals(cls, pressure, count):
+        """Returns the first count stall time totals (in usec) of a pressure file
+
+        The some line is first, then the full line (not present for cpu on older kernels)
+        """
+        pressure.read()
+        totals = []
+        for match in cls.total.finditer(pressure.buffer, 0, pressure.size):
+            if len(totals) == count:
+                break
+            totals.append(int(match.group(1)))
+        return totals
+
+    def read_all(self):
+        """Returns the totals of each pressure file"""
+        return [self.read_totals(pressure, len(fields)) for pressure, fields in self.pressure]
+
+    async def async_init(self):
+        """Logs if PSI is unavailable"""
+        if not self.pressure:
+            LOGGER.info("Pressure stall information not available")
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation"""
+        self.totals_persistent = self.read_all()
+        self.last_end_time = self.current_time()
+
+    async def get_stats(self):
+        """Fetches the point stats and pushes to out_data"""
+        if not self.pressure:
+            return None
+        current_stats = self.read_all()
+        time_delta = self.current_time() - self.last_end_time
+        self.last_end_time = self.current_time()
+        out_data = {"measurement": "pressure"}
+        for (_, fields), totals, previous in zip(self.pressure, current_stats,
+                                                 self.totals_persistent):
+            for field, total, previous_total in zip(fields, totals, previous):
+                # usec stalled per second, as a percentage
+                out_data[field] = round((total - previous_total) / time_delta / 10 ** 4, 2)
+        self.totals_persistent = current_stats
+        return out_data
+
+
+class DiskBase(BaseStat):
+    """Shared methods between the two disk classes, also used for filtering cgroups and nics
+
+    The filter results are cached, least recently used first, and the oldest are evicted past
+    filter_cache_size so names which come and go (eg veth nics) don't grow the cache forever.
+    """
+    filter_name = "Disk"
+    filter_cache_size = 1024
+    def __init__(self, disk_filters, filter_mode):
+        self.filter_mode = filter_mode
+        self.regex_matches = []
+        self.filed_disks = collections.OrderedDict()
+        self.regex_compile_list(disk_filters)
+
+    def regex_compile_list(self, list_to_check):
+        """Compiles all regex entries"""
+        for item in list_to_check:
+            try:
+                expr = re.compile(item)
+                self.regex_matches.append(expr)
+            except re.error:
+                raise ValueError("{0} filter specified is not valid regex"
+                                 .format(self.filter_name))
+
+    def check_disk_valid(self, disk):
+        """Checks if a disk is valid"""
+        if disk in self.filed_disks:
+            self.filed_disks.move_to_end(disk)
+            return self.filed_disks[disk]
+        if len(self.filed_disks) >= self.filter_cache_size:
+            self.filed_disks.popitem(last=False)
+        return_mode = False
+        if self.filter_mode == "include":
+            return_mode = True
+        for item in self.regex_matches:
+            if item.fullmatch(disk):
+                self.filed_disks[disk] = return_mode
+                return return_mode
+        self.filed_disks[disk] = not return_mode
+        return not return_mode
+
+
+class DiskStorageStats(DiskBase):
+    """All stats related to storage space on disks
+
+    The mount table is cached and only re-read when /proc/self/mountinfo signals a change.
+    statvfs runs in chunks on a bounded pool of worker threads, so a hung (eg network) mount
+    can't block the event loop. A mount which stalls for longer than statvfs_timeout is
+    abandoned and quarantined, with exponential backoff before it is retried.
+    """
+    name = "Disk"
+    statvfs_threads = 8
+    statvfs_chunk_size = 64
+    statvfs_timeout = 0.5
+    quarantine_backoff = (5, 300)
+    mount_escape = re.compile(r"\\([0-7]{3})")
+    def __init__(self, disk_filters, filter_mode):
+        self.limiter = trio.CapacityLimiter(self.statvfs_threads)
+        self.mountpoints = None
+        # mountpoint: [consecutive stalls, time it can be retried]
+        self.quarantined = {}
+        # mountpoints with a statvfs which is still running in an abandoned thread
+        self.stalled = set()
+        self.mountinfo = ProcFile.open("/proc/self/mountinfo", 65536)
+        self.mount_poller = None
+        self.fstypes = set()
+        if self.mountinfo is not None:
+            filesystems = ProcFile.open("/proc/filesystems")
+            if filesystems is None:
+                self.mountinfo = None
+            else:
+                # same as psutil, only physical filesystems (and zfs) are included
+                for line in filesystems.lines():
+                    fstype = line.split()[-1].decode()
+                    if not line.startswith(b"nodev") or fstype == "zfs":
+                        self.fstypes.add(fstype)
+                filesystems.close()
+                self.mount_poller = select.poll()
+                # mountinfo is flagged with POLLPRI/POLLERR when the mount table changes
+                self.mount_poller.register(self.mountinfo.fd, select.POLLPRI)
+        super().__init__(disk_filters, filter_mode)
+
+    def read_mountpoints(self):
+        """Returns the valid mountpoints, re-reading the mount table only if it changed"""
+        if self.mountinfo is None:
+            return [device.mountpoint for device in psutil.disk_partitions()
+                    if self.check_disk_valid(device.mountpoint)]
+        if self.mountpoints is not None and not self.mount_poller.poll(0):
+            return self.mountpoints
+        mountpoints = []
+        for line in self.mountinfo.lines():
+            fields = line.decode(errors="surrogateescape").split()
+            separator = fields.index("-")
+            fstype, device = fields[separator + 1:separator + 3]
+            if device == "none" or fstype not in self.fstypes:
+                continue
+            mountpoint = self.mount_escape.sub(lambda match: chr(int(match.group(1), 8)),
+                                               fields[4])
+            if self.check_disk_valid(mountpoint) and mountpoint not in mountpoints:
+                mountpoints.append(mountpoint)
+        if self.mountpoints is not None:
+            LOGGER.debug("Mount table changed, {0} mountpoints".format(len(mountpoints)))
+        self.mountpoints = mountpoints
+        for mountpoint in list(self.quarantined):
+            if mountpoint not in mountpoints:
+                del self.quarantined[mountpoint]
+        return mountpoints
+
+    def statvfs_thread(self, mountpoints, results, progress):
+        """Runs statvfs on each mountpoint in a worker thread, recording the progress
+
+        The index, mountpoint and start time of the current statvfs are set together, so the
+        watchdog never sees the start time of one mountpoint with another mountpoint
+        """
+        for index, mountpoint in enumerate(mountpoints):
+            if progress["abandoned"]:
+                return
+            progress["current"] = (index, mountpoint, time.monotonic())
+            try:
+                results[mountpoint] = os.statvfs(mountpoint)
+            except OSError:
+                results[mountpoint] = None
+            self.stalled.discard(mountpoint)
+        progress["current"] = None
+
+    async def run_statvfs_thread(self, mountpoints, results, progress, cancel_scope):
+        """Runs statvfs_thread on the worker pool, then cancels the stall watchdog"""
+        await trio.to_thread.run_sync(self.statvfs_thread, mountpoints, results, progress,
+                                      limiter=self.limiter, cancellable=True)
+        cancel_scope.cancel()
+
+    async def statvfs_chunk(self, mountpoints, results):
+        """Runs statvfs on a chunk of mountpoints, abandoning the thread and quarantining the
+        mountpoint if a call stalls, then continuing with the rest of the chunk"""
+        while mountpoints:
+            progress = dict(current=None, abandoned=False)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self.run_statvfs_thread, mountpoints, results, progress,
+                                   nursery.cancel_scope)
+                while True:
+                    await trio.sleep(self.statvfs_timeout / 4)
+                    current = progress["current"]
+                    if (current is not None
+                            and time.monotonic() - current[2] > self.statvfs_timeout):
+                        progress["abandoned"] = True
+                        nursery.cancel_scope.cancel()
+                        break
+            if not progress["abandoned"]:
+                return
+            index, mountpoint, _ = current
+            self.quarantine(mountpoint)
+            mountpoints = mountpoints[index + 1:]
+
+    def quarantine(self, mountpoint):
+        """Quarantines a stalled mountpoint"""
+        self.stalled.add(mountpoint)
+        stalls = self.quarantined.get(mountpoint, [0])[0] + 1
+        backoff = min(self.quarantine_backoff[0] * 2 ** (stalls - 1), self.quarantine_backoff[1])
+        self.quarantined[mountpoint] = [stalls, time.monotonic() + backoff]
+        LOGGER.warning("Mountpoint {0} stalled (statvfs took over {1}s), skipping it for {2}s"
+                       .format(mountpoint, self.statvfs_timeout, backoff))
+
+    def time_cap(self):
+        """Returns the cap on the time get_stats waits for statvfs, in case every worker thread
+        is stuck on stalled mounts"""
+        return max(self.collect_interval / 2, self.statvfs_timeout * 2)
+
+    @property
+    def timeout(self):
+        """Stalled mounts are abandoned within time_cap, so get_stats is given longer than that
+        (rather than the default timeout) to report the other mounts and quarantine them"""
+        return self.time_cap() + self.collect_interval / 10
+
+    async def get_stats(self):
+        """Fetches the point stats and pushes to out_data"""
+        now = time.monotonic()
+        mountpoints = [mountpoint for mountpoint in self.read_mountpoints()
+                       if mountpoint not in self.stalled and
+                       self.quarantined.get(mountpoint, (0, 0))[1] <= now]
+        results = {}
+        with trio.move_on_after(self.time_cap()):
+            async with trio.open_nursery() as nursery:
+                for index in range(0, len(mountpoints), self.statvfs_chunk_size):
+                    nursery.start_soon(self.statvfs_chunk,
+                                       mountpoints[index:index + self.statvfs_chunk_size],
+                                       results)
+        out_data = []
+        for mountpoint in mountpoints:
+            disk_data = results.get(mountpoint)
+            if disk_data is None:
+                continue
+            if mountpoint in self.quarantined and mountpoint not in self.stalled:
+                LOGGER.info("Mountpoint {0} recovered".format(mountpoint))
+                del self.quarantined[mountpoint]
+            # same calculations as psutil.disk_usage
+            total = disk_data.f_blocks * disk_data.f_frsize
+            free = disk_data.f_bavail * disk_data.f_frsize
+            used = (disk_data.f_blocks - disk_data.f_bfree) * disk_data.f_frsize
+            percent = round(used / (used + free) * 100, 1) if used + free else 0.0
+            out_data.append({"measurement": "disk", "total": total, "used": used,
+                             "percent": percent, "tags": {"disk": mountpoint}})
+        return out_data
+
+
+class DiskIOStats(DiskBase):
+    """All stats related to IO on disks"""
+    name = "DiskIO"
+    sector_size = 512
+    # (field, counter, multiplier), times are in ms and written in units of 10ms
+    fields = (("read_bytes", "read_bytes", None), ("write_bytes", "write_bytes", None),
+              ("read_time", "read_time", 10 ** -1), ("write_time", "write_time", 10 ** -1),
+              ("busy_time", "busy_time", 10 ** -1), ("disk_reads", "read_count", None),
+              ("disk_writes", "write_count", None), ("merged_reads", "read_merged_count", None),
+              ("merged_writes", "write_merged_count", None))
+    def __init__(self, disk_filters, filter_mode):
+        self.diskio_persistent = []
+        self.last_end_time = 0
+        self.points = {}
+        self.diskstats = ProcFile.open("/proc/diskstats", 16384)
+        super().__init__(disk_filters, filter_mode)
+
+    def read_counters(self):
+        """Returns the IO counters of each valid disk"""
+        if self.diskstats is None:
+            return {k: v._asdict() for k, v in psutil.disk_io_counters(perdisk=True).items()
+                    if self.check_disk_valid(k)}
+        counters = {}
+        for line in self.diskstats.lines():
+            fields = line.split()
+            if len(fields) == 14 or len(fields) >= 18:
+                (reads, reads_merged, read_sectors, read_time, writes, writes_merged,
+                 write_sectors, write_time, _, busy_time) = fields[3:13]
+            elif len(fields) == 7:
+                # partitions on old kernels
+                reads, read_sectors, writes, write_sectors = fields[3:7]
+                reads_merged = writes_merged = read_time = write_time = busy_time = 0
+            else:
+                continue
+            disk = fields[2].decode()
+            if not self.check_disk_valid(disk):
+                continue
+            counters[disk] = dict(
+                read_count=int(reads), write_count=int(writes),
+                read_bytes=int(read_sectors) * self.sector_size,
+                write_bytes=int(write_sectors) * self.sector_size,
+                read_time=int(read_time), write_time=int(write_time),
+                read_merged_count=int(reads_merged), write_merged_count=int(writes_merged),
+                busy_time=int(busy_time)
+            )
+        return counters
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation"""
+        self.diskio_persistent = self.read_counters()
+        self.last_end_time = self.current_time()
+
+    async def get_stats(self):
+        """Fetches the point stats and pushes to out_data"""
+        current_stats = self.read_counters()
+        time_delta = self.current_time() - self.last_end_time
+        self.last_end_time = self.current_time()
+        out_data = []
+        for disk, previous_value in self.diskio_persistent.items():
+            if disk not in current_stats:
+                LOGGER.info("Disk {0} no longer found. Unplugged?"
+                            .format(disk))
+                self.points.pop(disk, None)
+                continue
+            new_value = current_stats[disk]
+            point = self.points.get(disk)
+            if point is None:
+                point = self.points[disk] = Point(
+                    "diskio", [field for field, _, _ in self.fields], {"disk": disk})
+            values = point.values
+            for index, (_, counter, multiplier) in enumerate(self.fields):
+                values[index] = round((new_value[counter] - previous_value[counter]) / time_delta)
+                if multiplier is not None:
+                    values[index] *= multiplier
+            out_data.append(point)
+        self.diskio_persistent = current_stats
+        return out_data
+
+
+class NetIOStats(DiskBase):
+    """All network related stats
+
+    Nics are filtered in the same way as disks. Virtual nics (those under
+    /sys/devices/virtual, other than lo) can also be summed into a virtual_total nic, whether
+    or not they are filtered, so the per nic series of eg container veth nics can be excluded.
+    """
+    name = "NetIO"
+    filter_name = "Nic"
+    fields = ("tx_bytes", "rx_bytes", "tx_packets", "rx_packets")
+    def __init__(self, nic_filters, filter_mode, virtual_total=False):
+        super().__init__(nic_filters, filter_mode)
+        self.netio_persistent = {}
+        self.last_end_time = 0
+        self.net_dev = ProcFile.open("/proc/net/dev", 16384)
+        self.points = {}
+        # whether each present nic is virtual
+        self.virtual_nics = {}
+        self.total_point = None
+        if virtual_total:
+            self.total_point = Point("netio", self.fields, {"nic": "virtual_total"})
+
+    def is_virtual(self, nic):
+        """Checks if a nic is virtual (other than lo)"""
+        virtual = self.virtual_nics.get(nic)
+        if virtual is None:
+            try:
+                device = os.readlink(os.path.join(ProcFile.root, "sys/class/net", nic))
+            except OSError:
+                device = ""
+            virtual = self.virtual_nics[nic] = nic != "lo" and "/devices/virtual/" in device
+        return virtual
+
+    def read_counters(self):
+        """Returns the sent/received byte and packet counters of each nic (in fields order)"""
+        if self.net_dev is None:
+            return {nic: (value.bytes_sent, value.bytes_recv, value.packets_sent,
+                          value.packets_recv)
+                    for nic, value in psutil.net_io_counters(pernic=True).items()}
+        counters = {}
+        # first two lines are headers
+        for line in self.net_dev.lines()[2:]:
+            nic, _, data = line.rpartition(b":")
+            if not nic:
+                continue
+            values = data.split()
+            counters[nic.strip().decode()] = (int(values[8]), int(values[0]),
+                                              int(values[9]), int(values[1]))
+        return counters
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation"""
+        self.netio_persistent = self.read_counters()
+        self.last_end_time = self.current_time()
+
+    async def get_stats(self):
+        """Fetches the point stats and pushes to out_data"""
+        current_stats = self.read_counters()
+        time_delta = self.current_time() - self.last_end_time
+        self.last_end_time = self.current_time()
+        out_data = []
+        totals = None
+        if self.total_point is not None:
+            totals = [0] * len(self.fields)
+        for nic, new_value in current_stats.items():
+            # nics which have just appeared are recorded from the next collection
+            previous_value = self.netio_persistent.get(nic)
+            if previous_value is None:
+                continue
+            if totals is not None and self.is_virtual(nic):
+                for index, previous in enumerate(previous_value):
+                    totals[index] += new_value[index] - previous
+            if not self.check_disk_valid(nic):
+                continue
+            point = self.points.get(nic)
+            if point is None:
+                point = self.points[nic] = Point("netio", self.fields, {"nic": nic})
+            values = point.values
+            for index, previous in enumerate(previous_value):
+                values[index] = round((new_value[index] - previous) / time_delta)
+            out_data.append(point)
+        if totals is not None:
+            self.total_point.values[:] = [round(total / time_delta) for total in totals]
+            out_data.append(self.total_point)
+        for nic in self.netio_persistent:
+            if nic not in current_stats:
+                # nics come and go frequently on container hosts, so their state is dropped
+                LOGGER.debug("Network interface {0} removed".format(nic))
+                self.points.pop(nic, None)
+                self.virtual_nics.pop(nic, None)
+        self.netio_persistent = current_stats
+        return out_data
+
+
+class SocketStats(BaseStat):
+    """TCP socket state counts and TCP/UDP protocol counters
+
+    Socket states are counted from a netlink sock_diag dump, walking the messages in a reused
+    buffer so nothing is parsed or allocated per socket, falling back to counting the state
+    columns of /proc/net/tcp and tcp6 where netlink is unavailable. At most max_sockets are
+    counted each collection (a fifth of that from /proc). Past that the dump is cut short, and
+    the counts are scaled up to the totals in /proc/net/sockstat. Listening sockets are dumped
+    first, and only the listening sockets of the address families after the cut are counted,
+    so their count stays exact. TIME_WAIT comes from sockstat. sampled is the fraction of
+    sockets counted.
+    The /proc/net/snmp and netstat counters are written as rates.
+    """
+    name = "Sockets"
+    # tcp_states.h, TCP_ESTABLISHED is 1
+    states = ("established", "syn_sent", "syn_recv", "fin_wait1", "fin_wait2", "time_wait",
+              "close", "close_wait", "last_ack", "listen", "closing")
+    LISTEN = 10
+    TIME_WAIT = 6
+    # (field, section, counter)
+    counters = (("active_opens", b"Tcp:", b"ActiveOpens"),
+                ("passive_opens", b"Tcp:", b"PassiveOpens"),
+                ("attempt_fails", b"Tcp:", b"AttemptFails"),
+                ("estab_resets", b"Tcp:", b"EstabResets"),
+                ("in_segs", b"Tcp:", b"InSegs"), ("out_segs", b"Tcp:", b"OutSegs"),
+                ("retrans_segs", b"Tcp:", b"RetransSegs"), ("in_errs", b"Tcp:", b"InErrs"),
+                ("out_rsts", b"Tcp:", b"OutRsts"),
+                ("listen_overflows", b"TcpExt:", b"ListenOverflows"),
+                ("listen_drops", b"TcpExt:", b"ListenDrops"),
+                ("syn_retrans", b"TcpExt:", b"TCPSynRetrans"),
+                ("timeouts", b"TcpExt:", b"TCPTimeouts"),
+                ("udp_in", b"Udp:", b"InDatagrams"), ("udp_out", b"Udp:", b"OutDatagrams"),
+                ("udp_no_ports", b"Udp:", b"NoPorts"), ("udp_in_errors", b"Udp:", b"InErrors"),
+                ("udp_rcvbuf_errors", b"Udp:", b"RcvbufErrors"),
+                ("udp_sndbuf_errors", b"Udp:", b"SndbufErrors"))
+    NETLINK_SOCK_DIAG = 4
+    SOCK_DIAG_BY_FAMILY = 20
+    NLM_F_DUMP_REQUEST = 0x301
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    # nlmsghdr then inet_diag_req_v2 (family, protocol, ext, pad, states, zeroed inet_diag_sockid)
+    request = struct.Struct("=IHHIIBBBBI48x")
+    proc_chunk_size = 262144
+    # counting from /proc/net/tcp costs around 5 times as much per socket as netlink, so the
+    # fallback counts fewer sockets to keep to a similar cost
+    proc_cost = 5
+
+    def __init__(self, max_sockets):
+        self.max_sockets = max_sockets
+        self.buffer = bytearray(65536)
+        # native endian views for the message lengths and types
+        self.lengths = memoryview(self.buffer).cast("I")
+        self.kinds = memoryview(self.buffer).cast("H")
+        self.use_netlink = hasattr(socket, "AF_NETLINK")
+        self.sockstat = ProcFile.open("/proc/net/sockstat")
+        self.sockstat6 = ProcFile.open("/proc/net/sockstat6")
+        self.snmp = [ProcFile.open("/proc/net/snmp", 8192), ProcFile.open("/proc/net/netstat",
+                                                                          16384)]
+        self.snmp = [snmp for snmp in self.snmp if snmp is not None]
+        # (field, file index, line index, column)
+        self.columns = []
+        self.counters_persistent = None
+        self.last_end_time = 0
+        self.find_columns()
+
+    def find_columns(self):
+        """Finds the positions of the counters in the snmp and netstat files"""
+        for field, section, counter in self.counters:
+            for file_index, snmp in enumerate(self.snmp):
+                lines = snmp.lines()
+                for line_index, line in enumerate(lines[:-1]):
+                    names = line.split()
+                    # the header line is followed by the values line of the same section
+                    if (names[0] == section and counter in names
+                            and lines[line_index + 1].startswith(section)):
+                        self.columns.append((field, file_index, line_index + 1,
+                                             names.index(counter)))
+                        break
+                else:
+                    continue
+                break
+
+    def read_counters(self):
+        """Returns the snmp and netstat counters (in columns order)"""
+        lines = [snmp.lines() for snmp in self.snmp]
+        return [int(lines[file_index][line_index].split()[column])
+                for _, file_index, line_index, column in self.columns]
+
+    def open_sock_diag(self):
+        """Returns a netlink sock_diag socket"""
+        return socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_SOCK_DIAG)
+
+    def count_netlink(self, counts, family, limit, listen_only=False):
+        """Counts the TCP sockets of an address family by state, up to limit sockets
+
+        With listen_only, only listening sockets are dumped (without a limit). Returns the
+        number counted, or None if the dump was cut short at the limit
+        """
+        buffer = self.buffer
+        lengths = self.lengths
+        kinds = self.kinds
+        counted = 0
+        states = 1 << self.LISTEN if listen_only else 0xfff
+        with self.open_sock_diag() as sock:
+            sock.sendto(self.request.pack(self.request.size, self.SOCK_DIAG_BY_FAMILY,
+                                          self.NLM_F_DUMP_REQUEST, 1, 0, family,
+                                          socket.IPPROTO_TCP, 0, 0, states), (0, 0))
+            while True:
+                size = sock.recv_into(buffer)
+                offset = 0
+                while offset < size:
+                    kind = kinds[(offset >> 1) + 2]
+                    if kind == self.NLMSG_DONE:
+                        return counted
+                    if kind == self.NLMSG_ERROR:
+                        errno = -struct.unpack_from("=i", buffer, offset + 16)[0]
+                        raise OSError(errno, os.strerror(errno))
+                    # idiag_state, after the 16 byte header and idiag_family
+                    counts[buffer[offset + 17]] += 1
+                    counted += 1
+                    if counted == limit and not listen_only:
+                        return None
+                    offset += (lengths[offset >> 2] + 3) & ~3
+
+    def count_proc(self, counts, path, limit, listen_only=False):
+        """Counts the TCP sockets in a /proc/net/tcp file by state, up to limit sockets
+
+        The state is the only space separated pair of hex digits on each line, so each
+        state is counted with bytes.count rather than parsing the lines. With listen_only,
+        only the listening sockets are counted (without a limit), which are at the start of
+        the file. Returns the number counted, or None if the file was cut short at the limit
+        """
+        listen_state = b" %02X " % self.LISTEN
+        listening = 0
+        try:
+            proc_file = open(os.path.join(ProcFile.root, path.lstrip("/")), "rb")
+        except OSError:
+            return 0
+        counted = -1
+        remainder = b""
+        with proc_file:
+            while True:
+                data = proc_file.read(self.proc_chunk_size)
+                if not data:
+                    break
+                # only whole lines are counted
+                end = data.rfind(b"\n") + 1
+                data, remainder = remainder + data[:end], data[end:]
+                counted += data.count(b"\n")
+                if listen_only:
+                    listening += data.count(listen_state)
+                    if listening < counted:
+                        # past the listening sockets
+                        break
+                    continue
+                for state in range(1, len(self.states) + 1):
+                    counts[state] += data.count(b" %02X " % state)
+                if counted >= limit:
+                    return None
+        if listen_only:
+            counts[self.LISTEN] += listening
+            return listening
+        return max(counted, 0)
+
+    def read_sockstat(self):
+        """Returns the (in use, TIME_WAIT) TCP socket totals from sockstat, or None"""
+        if self.sockstat is None:
+            return None
+        self.sockstat.read()
+        index = self.sockstat.buffer.find(b"TCP: inuse ", 0, self.sockstat.size)
+        if index == -1:
+            return None
+        fields = self.sockstat.buffer[index:self.sockstat.buffer.find(b"\n", index)].split()
+        inuse = int(fields[2])
+        time_wait = int(fields[fields.index(b"tw") + 1])
+        if self.sockstat6 is not None:
+            inuse += self.sockstat6.value(b"TCP6: inuse") or 0
+        return inuse, time_wait
+
+    def count_states(self):
+        """Returns the TCP socket counts by state (indexed by state) and the fraction counted"""
+        counts = [0] * (len(self.states) + 2)
+        if self.use_netlink:
+            limit = self.max_sockets
+        else:
+            limit = max(self.max_sockets // self.proc_cost, 1)
+        for family, path in ((socket.AF_INET, "/proc/net/tcp"),
+                             (socket.AF_INET6, "/proc/net/tcp6")):
+            # once the limit is used up, only the listening sockets of the other families are
+            # counted, so the listening count stays exact
+            listen_only = limit == 0
+            if self.use_netlink:
+                try:
+                    counted = self.count_netlink(counts, family, limit, listen_only)
+                except OSError as exc:
+                    LOGGER.info("Netlink sock_diag unavailable ({0}), counting socket states "
+                                "from /proc/net/tcp".format(exc))
+                    self.use_netlink = False
+                    return self.count_states()
+            else:
+                counted = self.count_proc(counts, path, limit, listen_only)
+            if listen_only:
+                continue
+            if counted is None or counted >= limit:
+                limit = 0
+            else:
+                limit -= counted
+        if limit:
+            return counts, 1.0
+        totals = self.read_sockstat()
+        if totals is None:
+            return counts, None
+        inuse, time_wait = totals
+        # listening sockets are first, so only the other states are scaled
+        others = sum(counts) - counts[self.LISTEN] - counts[self.TIME_WAIT]
+        total_others = max(inuse - counts[self.LISTEN], 0)
+        sampled = others / total_others if total_others else 1.0
+        if others:
+            scale = total_others / others
+            for state in range(1, len(self.states) + 1):
+                if state not in (self.LISTEN, self.TIME_WAIT):
+                    counts[state] = round(counts[state] * scale)
+        counts[self.TIME_WAIT] = time_wait
+        return counts, round(min(sampled, 1.0), 4)
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation"""
+        self.counters_persistent = self.read_counters()
+        self.last_end_time = self.current_time()
+
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, dumps the socket table)"""
+        out_data = {"measurement": "sockets"}
+        if self.max_sockets:
+            counts, sampled = self.count_states()
+            for state, name in enumerate(self.states, 1):
+                out_data[name] = counts[state]
+            out_data["sampled"] = sampled
+        current_stats = self.read_counters()
+        time_delta = self.current_time() - self.last_end_time
+        self.last_end_time = self.current_time()
+        for (field, _, _, _), value, previous in zip(self.columns, current_stats,
+                                                     self.counters_persistent):
+            out_data[field] = round((value - previous) / time_delta)
+        self.counters_persistent = current_stats
+        return out_data
+
+
+class SensorStats(BaseStat):
+    """All sensor related stats"""
+    name = "Sensors"
+    async def async_init(self):
+        """Checks for the sensor on a thread, as reading the sensors is slow"""
+        if await trio.to_thread.run_sync(self.get_stats) is None:
+            LOGGER.info("CPU thermal sensor not found")
+
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, reads many sysfs files)"""
+        temperature_data = psutil.sensors_temperatures()
+        cpu_temperature = None
+        for item in temperature_data.get("coretemp", []):
+            if item.label == "Package id 0":
+                cpu_temperature = item.current
+                break
+        else:
+            for item in temperature_data.get("k10temp", []):
+                if item.label == "Tdie":
+                    cpu_temperature = item.current
+                    break
+            else:
+                if "armada_thermal" in temperature_data:
+                    cpu_temperature = temperature_data["armada_thermal"][0].current
+        if cpu_temperature is not None:
+            return {"measurement": "sensors", "cpu_temp": cpu_temperature}
+
+
+
+class MiscStats(BaseStat):
+    """Any other miscellaneous stats"""
+    name = "Misc"
+    def __init__(self):
+        # boot time doesn't change, so only needs reading once
+        self.boot_time = int(psutil.boot_time())
+        self.loadavg = ProcFile.open("/proc/loadavg", 256)
+
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, lists /proc)"""
+        if self.loadavg is not None:
+            self.loadavg.read()
+            sys_load = [float(item) for item in self.loadavg.buffer.split(None, 3)[:3]]
+        else:
+            sys_load = os.getloadavg()
+        processes = len(psutil.pids())
+        uptime = int(self.target_time) - self.boot_time
+        out_data = {"measurement": "misc"}
+        for index, item in enumerate(("load_1", "load_5", "load_15")):
+            out_data[item] = sys_load[index]
+        out_data["processes"] = processes
+        out_data["uptime"] = uptime
+        return out_data
+
+
+class ProcessStats(BaseStat):
+    """Top processes by CPU usage, RSS and IO
+
+    Re-reading /proc/<pid>/stat and io for every process each collection is too slow on hosts
+    with many processes, so the scan is incremental. Processes which used CPU or did IO when
+    last read (hot processes) are re-read every collection, and the rest are re-read in turn,
+    scan_reads each collection. /proc is listed every collection (a cheap directory read), so
+    new processes are read and exited processes dropped as soon as they are seen.
+    The name and start time of each process are cached by pid (a changed start time means the
+    pid was reused, a changed name that the process exec'd another program), and the cmdline
+    is only read once a process makes the top. Rates are over
+    the time since each process was last read. New processes are hot, so the first collection
+    re-reads every process.
+    The top processes are picked with a heap. Points are tagged by the metric and rank rather
+    than the process, so the number of series is bounded by top_processes however many
+    processes come and go.
+    """
+    name = "Processes"
+    metrics = ("cpu", "rss", "io")
+    fields = ("pid", "name", "cmdline", "cpu", "rss", "read_bytes", "write_bytes")
+    cmdline_length = 256
+    # processes which aren't hot re-read each collection
+    scan_reads = 250
+    # indexes of the process entry lists
+    (PID, START, NAME, CMDLINE, TIME, TICKS, READ, WRITE, HAS_IO, CPU, RSS, READ_RATE,
+     WRITE_RATE, IO, COMM) = range(15)
+    def __init__(self, top):
+        self.top = top
+        self.proc = os.path.join(ProcFile.root, "proc")
+        if not os.path.exists(os.path.join(self.proc, "self", "stat")):
+            self.proc = None
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        # pid: entry list (indexed by PID, START, ...)
+        self.processes = {}
+        self.hot = set()
+        # processes left to re-read in this pass
+        self.queue = collections.deque()
+        self.points = {metric: [Point("process", self.fields, {"top": metric, "rank": rank})
+                                for rank in range(1, top + 1)] for metric in self.metrics}
+
+    def read_file(self, pid, name):
+        """Returns the contents of /proc/<pid>/<name>, or None if it can't be read"""
+        try:
+            fd = os.open("{0}/{1}/{2}".format(self.proc, pid, name), os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            return os.read(fd, 4096)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+    def read_cmdline(self, entry):
+        """Reads the cmdline of a process into its entry, if it hasn't been read already"""
+        if entry[self.CMDLINE] is not None:
+            return
+        if self.proc is None:
+            try:
+                cmdline = " ".join(psutil.Process(entry[self.PID]).cmdline())
+            except psutil.Error:
+                cmdline = ""
+        else:
+            cmdline = self.read_file(entry[self.PID], "cmdline") or b""
+            cmdline = cmdline.rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+        # kernel threads have no cmdline
+        entry[self.CMDLINE] = cmdline[:self.cmdline_length] or entry[self.NAME]
+
+    def update_entry(self, pid, start, ticks, rss, io_bytes, now):
+        """Updates the cached entry of a process with its current counters and returns it
+
+        io_bytes is (read bytes, write bytes), or None if they can't be read. A new entry
+        (including for a reused pid) has no name set, and is hot so it is re-read next
+        collection for its rates.
+        """
+        entry = self.processes.get(pid)
+        if entry is None or entry[self.START] != start:
+            entry = self.processes[pid] = [int(pid), start, None, None, now, ticks, None, None,
+                                           True, 0.0, 0, 0, 0, 0, None]
+            self.hot.add(pid)
+        else:
+            time_delta = now - entry[self.TIME]
+            if time_delta <= 0:
+                return entry
+            entry[self.CPU] = (ticks - entry[self.TICKS]) * 100 / self.ticks / time_delta
+            entry[self.TIME] = now
+            entry[self.TICKS] = ticks
+            if io_bytes is not None and entry[self.READ] is not None:
+                entry[self.READ_RATE] = round((io_bytes[0] - entry[self.READ]) / time_delta)
+                entry[self.WRITE_RATE] = round((io_bytes[1] - entry[self.WRITE]) / time_delta)
+                entry[self.IO] = entry[self.READ_RATE] + entry[self.WRITE_RATE]
+            if entry[self.CPU] or entry[self.IO]:
+                self.hot.add(pid)
+            else:
+                self.hot.discard(pid)
+        entry[self.RSS] = rss * PAGE_SIZE
+        entry[self.HAS_IO] = io_bytes is not None
+        if io_bytes is not None:
+            entry[self.READ], entry[self.WRITE] = io_bytes
+        return entry
+
+    def remove(self, pid):
+        """Removes a process which has exited from the cache"""
+        del self.processes[pid]
+        self.hot.discard(pid)
+
+    def read_process(self, pid, now):
+        """Re-reads /proc/<pid>/stat and io into the cache, removing the process if it exited"""
+        data = self.read_file(pid, "stat")
+        entry = self.processes.get(pid)
+        if data is None:
+            if entry is not None:
+                self.remove(pid)
+            return
+        end = data.rfind(b")")
+        # the fields after the name, from state to rss
+        values = data[end + 2:].split(None, 22)
+        start = values[19]
+        ticks = int(values[11]) + int(values[12])
+        if (entry is not None and entry[self.START] == start and pid not in self.hot
+                and (ticks == entry[self.TICKS] or not entry[self.HAS_IO])):
+            # a process can't do IO without using CPU time, so the IO of idle processes (or
+            # processes whose IO can't be read) isn't re-read
+            io_bytes = (entry[self.READ], entry[self.WRITE]) if entry[self.HAS_IO] else None
+        else:
+            io_bytes = None
+            data_io = self.read_file(pid, "io")
+            # None if not permitted, in which case it isn't tried again for this process
+            if data_io is not None:
+                index = data_io.find(b"read_bytes:")
+                read = int(data_io[index + 11:data_io.find(b"\n", index)])
+                index = data_io.find(b"write_bytes:")
+                io_bytes = (read, int(data_io[index + 12:data_io.find(b"\n", index)]))
+        entry = self.update_entry(pid, start, ticks, int(values[21]), io_bytes, now)
+        comm = data[data.find(b"(") + 1:end]
+        if entry[self.COMM] != comm:
+            # a new process, or it exec'd another program
+            entry[self.COMM] = comm
+            entry[self.NAME] = comm.decode(errors="replace")
+            entry[self.CMDLINE] = None
+
+    def psutil_scan(self, now):
+        """Updates the cache from psutil, used where /proc is unavailable"""
+        seen = set()
+        for process in psutil.process_iter(["create_time", "name", "cpu_times", "memory_info",
+                                            "io_counters"]):
+            info = process.info
+            if info["cpu_times"] is None or info["memory_info"] is None:
+                continue
+            io_counters = info["io_counters"]
+            if io_counters is not None:
+                io_counters = (io_counters.read_bytes, io_counters.write_bytes)
+            entry = self.update_entry(
+                process.pid, info["create_time"],
+                round((info["cpu_times"].user + info["cpu_times"].system) * self.ticks),
+                info["memory_info"].rss // PAGE_SIZE, io_counters, now
+            )
+            if entry[self.NAME] != info["name"]:
+                entry[self.NAME] = info["name"]
+                entry[self.CMDLINE] = None
+            seen.add(process.pid)
+        for pid in self.processes.keys() - seen:
+            self.remove(pid)
+
+    def scan(self, now):
+        """Reads new processes, re-reads the hot processes and the next scan_reads of the
+        others"""
+        if self.proc is None:
+            self.psutil_scan(now)
+            return
+        listing = os.listdir(self.proc)
+        processes = self.processes
+        new = [pid for pid in listing if pid not in processes]
+        # only look for exited processes when some of the cached ones weren't listed
+        if len(listing) - len(new) < len(processes):
+            for pid in processes.keys() - set(listing):
+                self.remove(pid)
+        if not self.queue:
+            self.queue.extend(processes.keys() - self.hot)
+        pids = list(self.hot)
+        pids += [pid for pid in new if pid.isdigit()]
+        for pid in pids:
+            self.read_process(pid, now)
+        for _ in range(min(self.scan_reads, len(self.queue))):
+            pid = self.queue.popleft()
+            entry = self.processes.get(pid)
+            if entry is not None and entry[self.TIME] != now:
+                self.read_process(pid, now)
+
+    async def init_fetch(self):
+        """Fetches stats for post-initialisation, on a thread as it reads every process"""
+        await trio.to_thread.run_sync(self.scan, self.current_time())
+
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, reads /proc)"""
+        self.scan(self.current_time())
+        out_data = []
+        # processes which aren't hot have no CPU usage or IO, so only the RSS needs them all
+        hot = [self.processes[pid] for pid in self.hot]
+        for metric, index, entries in (("cpu", self.CPU, hot),
+                                       ("rss", self.RSS, self.processes.values()),
+                                       ("io", self.IO, hot)):
+            top = heapq.nlargest(self.top, entries, key=operator.itemgetter(index))
+            for point, entry in zip(self.points[metric], top):
+                if not entry[index]:
+                    # the rest are idle
+                    break
+                self.read_cmdline(entry)
+                point.values[:] = (entry[self.PID], entry[self.NAME], entry[self.CMDLINE],
+                                   round(entry[self.CPU], 1), entry[self.RSS],
+                                   entry[self.READ_RATE], entry[self.WRITE_RATE])
+                out_data.append(point)
+        return out_data
+
+
+class DirectoryWatcher:
+    """Watches directories for subdirectories being created or removed, using inotify
+
+    Use DirectoryWatcher.open, which returns None where inotify is unavailable (eg not on
+    Linux) so callers can fall back to rescanning.
+    """
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    event = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor: path
+        self.watches = {}
+
+    @classmethod
+    def open(cls):
+        """Returns a DirectoryWatcher, or None if inotify is unavailable"""
+        try:
+            return cls()
+        except (OSError, AttributeError):
+            return None
+
+    def add(self, path, name):
+        """Watches the directory at path, events are returned with name as the directory"""
+        watch = self.inotify_add_watch(self.fd, os.fsencode(path),
+                                       self.IN_CREATE | self.IN_DELETE | self.IN_ONLYDIR)
+        if watch < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {0}".format(path))
+        self.watches[watch] = name
+
+    def read(self):
+        """Returns the (directory name, subdirectory, created) events since the last read
+
+        Returns None if events were lost (the queue overflowed), so everything must be rescanned
+        """
+        events = []
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, size = self.event.unpack_from(data, offset)
+                offset += self.event.size
+                name = data[offset:offset + size].rstrip(b"\0")
+                offset += size
+                if mask & self.IN_Q_OVERFLOW:
+                    overflowed = True
+                elif mask & self.IN_IGNORED:
+                    # the watched directory was removed
+                    self.watches.pop(watch, None)
+                elif mask & self.IN_ISDIR and watch in self.watches:
+                    events.append((self.watches[watch], os.fsdecode(name),
+                                   bool(mask & self.IN_CREATE)))
+        return None if overflowed else events
+
+    def close(self):
+        """Closes the inotify instance, removing all watches"""
+        os.close(self.fd)
+
+
+class CgroupStats(DiskBase):
+    """Per cgroup (eg container or systemd unit) CPU, memory, IO and pressure stats
+
+    The cgroup v2 tree is scanned once, down to max_depth, and then the directories are watched
+    with inotify so cgroups are added and removed as they come and go, rather than the tree
+    being rescanned each collection (it is rescanned every rescan_interval seconds if inotify
+    is unavailable). The stat files of each cgroup are kept open and re-read with pread.
+    Cgroups are filtered by their path in the tree (eg system.slice/docker-.*\\.scope), and at
+    most max_cgroups are recorded so the number of series is bounded.
+    """
+    name = "Cgroups"
+    filter_name = "Cgroup"
+    rescan_interval = 30
+    stat_files = ("cpu.stat", "memory.current", "io.stat", "cpu.pressure", "memory.pressure",
+                  "io.pressure")
+    # (field, counter, multiplier), counters are written as rates multiplied by the multiplier
+    # or as they are with a multiplier of None. usec counters are written as percentages
+    fields = (("cpu", "usage_usec", 10 ** -4), ("cpu_user", "user_usec", 10 ** -4),
+              ("cpu_system", "system_usec", 10 ** -4), ("throttled", "throttled_usec", 10 ** -4),
+              ("memory", "memory", None), ("read_bytes", "rbytes", 1),
+              ("write_bytes", "wbytes", 1), ("read_ops", "rios", 1), ("write_ops", "wios", 1),
+              ("cpu_some", "cpu_some", 10 ** -4), ("memory_some", "memory_some", 10 ** -4),
+              ("memory_full", "memory_full", 10 ** -4), ("io_some", "io_some", 10 ** -4),
+              ("io_full", "io_full", 10 ** -4))
+    io_counter = re.compile(rb"(rbytes|wbytes|rios|wios)=(\d+)")
+    io_indexes = {b"rbytes": 5, b"wbytes": 6, b"rios": 7, b"wios": 8}
+    # pressure files and the number of totals recorded from each (some, full)
+    pressure_files = (("cpu.pressure", 1), ("memory.pressure", 2), ("io.pressure", 2))
+    def __init__(self, cgroup_filters, filter_mode, max_depth, max_cgroups):
+        self.max_depth = max_depth
+        self.max_cgroups = max_cgroups
+        self.root = None
+        self.watcher = None
+        self.last_scan = 0
+        # path: dict(files, counters, time, point)
+        self.cgroups = {}
+        # cgroups over the max_cgroups limit
+        self.skipped = set()
+        super().__init__(cgroup_filters, filter_mode)
+
+    @staticmethod
+    def find_root():
+        """Returns the path of the cgroup v2 hierarchy, or None if it isn't mounted"""
+        mountinfo = ProcFile.open("/proc/self/mountinfo", 65536)
+        if mountinfo is None:
+            return None
+        try:
+            for line in mountinfo.lines():
+                fields = line.decode(errors="surrogateescape").split()
+                if fields[fields.index("-") + 1] == "cgroup2":
+                    return fields[4]
+        finally:
+            mountinfo.close()
+        return None
+
+    async def async_init(self):
+        """Finds the cgroup v2 tree and scans it"""
+        self.root = self.find_root()
+        if self.root is None:
+            raise FileNotFoundError("No cgroup v2 hierarchy is mounted")
+        # the stat files of each cgroup are kept open
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = self.max_cgroups * len(self.stat_files) + 1024
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard != resource.RLIM_INFINITY:
+                needed = min(needed, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        self.watcher = DirectoryWatcher.open()
+        if self.watcher is None:
+            LOGGER.info("inotify unavailable, the cgroup tree is rescanned every {0}s"
+                        .format(self.rescan_interval))
+        await trio.to_thread.run_sync(self.scan)
+        LOGGER.debug("Found {0} cgroups".format(len(self.cgroups)))
+
+    def tree_path(self, path):
+        """Returns the path of a cgroup directory, relative to ProcFile.root like its files"""
+        return os.path.join(ProcFile.root, self.root.lstrip("/"), path)
+
+    def watch(self, path):
+        """Watches a cgroup directory for children, falling back to rescans if it fails"""
+        if self.watcher is None:
+            return
+        try:
+            self.watcher.add(self.tree_path(path), path)
+        except OSError as exc:
+            # eg the cgroup was just removed, or the inotify watch limit was reached
+            if os.path.isdir(self.tree_path(path)):
+                LOGGER.warning("Failed to watch cgroup {0} ({1}), the cgroup tree is rescanned "
+                               "every {2}s instead".format(path, exc, self.rescan_interval))
+                self.watcher.close()
+                self.watcher = None
+
+    def walk(self, path, depth, found):
+        """Adds the paths of the cgroups under path (down to max_depth) to found, watching
+        the directories which can have children to record"""
+        if depth < self.max_depth:
+            self.watch(path)
+        try:
+            entries = list(os.scandir(self.tree_path(path)))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                child = entry.name if not path else "{0}/{1}".format(path, entry.name)
+                found.append(child)
+                if depth + 1 < self.max_depth:
+                    self.walk(child, depth + 1, found)
+
+    def scan(self):
+        """Scans the tree, adding new cgroups and removing those which no longer exist"""
+        found = []
+        self.walk("", 0, found)
+        self.last_scan = time.monotonic()
+        for path in self.cgroups.keys() - set(found):
+            self.remove(path)
+        self.skipped.intersection_update(found)
+        for path in found:
+            self.add(path)
+
+    def update_tree(self):
+        """Adds and removes cgroups from the watcher's events, or rescans if needed"""
+        if self.watcher is None:
+            if time.monotonic() - self.last_scan >= self.rescan_interval:
+                self.scan()
+            return
+        events = self.watcher.read()
+        if events is None:
+            LOGGER.info("Cgroup events were lost, rescanning the tree")
+            self.scan()
+            return
+        for parent, name, created in events:
+            path = name if not parent else "{0}/{1}".format(parent, name)
+            if not created:
+                self.remove(path)
+                continue
+            found = [path]
+            depth = path.count("/") + 1
+            if depth < self.max_depth:
+                # children may have been created before the watch was added
+                self.walk(path, depth, found)
+            for child in found:
+                self.add(child)
+
+    def add(self, path):
+        """Starts recording a cgroup, if it is valid and under the limit"""
+        if path in self.cgroups or not self.check_disk_valid(path):
+            return
+        if len(self.cgroups) >= self.max_cgroups:
+            if not self.skipped:
+                LOGGER.warning("Reached the limit of {0} cgroups, further cgroups are skipped"
+                               .format(self.max_cgroups))
+            self.skipped.add(path)
+            return
+        files = {name: ProcFile.open(os.path.join(self.root, path, name))
+                 for name in self.stat_files}
+        if files["cpu.stat"] is None:
+            # removed already
+            for stat_file in files.values():
+                if stat_file is not None:
+                    stat_file.close()
+            return
+        cgroup = self.cgroups[path] = dict(
+            files=files, counters=None, time=0,
+            point=Point("cgroup", [field for field, _, _ in self.fields], {"cgroup": path})
+        )
+        try:
+            cgroup["counters"] = self.read_counters(files)
+            cgroup["time"] = self.current_time()
+        except OSError:
+            self.remove(path)
+
+    def remove(self, path):
+        """Stops recording a cgroup and its descendants"""
+        prefix = path + "/"
+        for cgroup_path in [path] + [key for key in self.cgroups if key.startswith(prefix)]:
+            cgroup = self.cgroups.pop(cgroup_path, None)
+            if cgroup is None:
+                continue
+            for stat_file in cgroup["files"].values():
+                if stat_file is not None:
+                    stat_file.close()
+        self.skipped = {key for key in self.skipped if key != path and not key.startswith(prefix)}
+        while self.skipped and len(self.cgroups) < self.max_cgroups:
+            self.add(self.skipped.pop())
+
+    def read_counters(self, files):
+        """Returns the counters of a cgroup (in fields order), raises OSError if it was removed"""
+        cpu_stat = files["cpu.stat"]
+        counters = [cpu_stat.value(b"usage_usec"), cpu_stat.value(b"user_usec", reread=False),
+                    cpu_stat.value(b"system_usec", reread=False),
+                    cpu_stat.value(b"throttled_usec", reread=False)]
+        memory = files["memory.current"]
+        counters.append(int(memory.buffer[:memory.read()]) if memory is not None else None)
+        io_stat = files["io.stat"]
+        if io_stat is None:
+            counters += (None, None, None, None)
+        else:
+            io_stat.read()
+            counters += (0, 0, 0, 0)
+            # summed over devices
+            for match in self.io_counter.finditer(io_stat.buffer, 0, io_stat.size):
+                counters[self.io_indexes[match.group(1)]] += int(match.group(2))
+        for name, kinds in self.pressure_files:
+            pressure = files[name]
+            totals = PressureStats.read_totals(pressure, kinds) if pressure is not None else []
+            counters += totals
+            counters += (None,) * (kinds - len(totals))
+        return counters
+
+    def get_stats(self):
+        """Fetches the point stats and pushes to out_data (blocking, reads many cgroup files)"""
+        self.update_tree()
+        out_data = []
+        for path, cgroup in list(self.cgroups.items()):
+            try:
+                counters = self.read_counters(cgroup["files"])
+            except OSError:
+                # removed since the last events were read
+                self.remove(path)
+                continue
+            current_time = self.current_time()
+            time_delta = current_time - cgroup["time"]
+            previous = cgroup["counters"]
+            cgroup["counters"] = counters
+            cgroup["time"] = current_time
+            if time_delta <= 0:
+                continue
+            values = cgroup["point"].values
+            for index, (_, _, multiplier) in enumerate(self.fields):
+                value = counters[index]
+                if value is None or multiplier is None:
+                    values[index] = value
+                elif previous[index] is None:
+                    values[index] = None
+                elif multiplier == 1:
+                    values[index] = round((value - previous[index]) / time_delta)
+                else:
+                    values[index] = round((value - previous[index]) / time_delta * multiplier, 2)
+            out_data.append(cgroup["point"])
+        return out_data
+
+
+class PluginWorkerError(Exception):
+    """Error from a plugin worker, or the worker exited"""
+
+
+class PluginWorkerProcess:
+    """A worker process of the isolated plugin pool, hosting one or more plugin stat classes
+
+    Calls are sent to the worker as FramedStream frames over its stdin/stdout, one at a time.
+    If the worker exits, or calls time out max_timeouts times in a row (eg a hung plugin), the
+    worker is killed and restarted (re-running init_fetch) on a later call, with exponential
+    backoff which is reset once a worker has run for the maximum backoff. Responses to calls
+    which were cancelled (eg timed out) are discarded.
+    """
+    worker_path = "plugin_worker.py"
+    restart_backoff = (1, 60)
+    max_timeouts = 3
+    def __init__(self, number):
+        self.name = "isolated plugin worker {0}".format(number)
+        # (module, index) of each hosted class, the slot of a class is its position
+        self.specs = []
+        self.has_init_fetch = []
+        # the description or initialisation error (str) of each class, from the last start
+        self.results = None
+        self.process = None
+        self.stream = None
+        self.seq = 0
+        self.restarts = 0
+        self.restart_time = 0
+        self.start_time = 0
+        self.timeout_streak = 0
+        self.lock = trio.Lock()
+
+    @classmethod
+    async def spawn(cls, *args):
+        """Starts a worker process, returns the process and its FramedStream"""
+        process = await trio.lowlevel.open_process([sys.executable, cls.worker_path, *args],
+                                                   stdin=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE)
+        return process, FramedStream(process.stdin, process.stdout)
+
+    @classmethod
+    async def describe(cls, module):
+        """Returns descriptions of the activated stat classes of a plugin module, which is
+        only imported in a worker process"""
+        process, stream = await cls.spawn(module)
+        try:
+            return await cls.receive_response(stream, 0, module)
+        finally:
+            with trio.CancelScope(shield=True):
+                process.kill()
+                await process.wait()
+
+    @staticmethod
+    async def receive_response(stream, seq, name):
+        """Returns the response to call seq, forwarding log records from the worker"""
+        while True:
+            response_seq, kind, message = await stream.receive()
+            if kind == FramedStream.LOG:
+                logger_name, level, text = message
+                logging.getLogger(logger_name).log(level, "[{0}] {1}".format(name, text))
+            elif response_seq != seq:
+                LOGGER.debug("Discarded a stale response from the {0}".format(name))
+            elif kind == FramedStream.ERROR:
+                raise PluginWorkerError(message)
+            else:
+                return message
+
+    def add(self, module, index, description):
+        """Adds a class to the worker (before it is started), returns its slot"""
+        self.specs.append((module, index))
+        self.has_init_fetch.append(description["init_fetch"])
+        return len(self.specs) - 1
+
+    async def request(self, slot, method):
+        """Sends a call to the worker and returns the result"""
+        self.seq += 1
+        # a partially sent frame would corrupt the stream
+        with trio.CancelScope(shield=True):
+            await self.stream.send(self.seq, FramedStream.CALL,
+                                   (slot, method, BaseStat.target_time,
+                                    BaseStat.collect_interval))
+        return await self.receive_response(self.stream, self.seq, self.name)
+
+    async def start(self):
+        """Starts the worker, waiting for the stat classes to initialise"""
+        self.process, self.stream = await self.spawn(
+            *("{0}:{1}".format(module, index) for module, index in self.specs)
+        )
+        self.seq = 0
+        self.timeout_streak = 0
+        self.start_time = time.monotonic()
+        try:
+            self.results = await self.receive_response(self.stream, 0, self.name)
+        except BaseException:
+            # don't leak the process if the worker fails to start
+            await self.kill()
+            raise
+
+    async def kill(self):
+        """Kills the worker process and waits for it to exit"""
+        with trio.CancelScope(shield=True):
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def stop(self, reason):
+        """Kills the worker (if it is still running) and schedules a restart"""
+        returncode = None
+        if self.process is not None:
+            process = self.process
+            await self.kill()
+            returncode = process.returncode
+        backoff = min(self.restart_backoff[0] * 2 ** self.restarts, self.restart_backoff[1])
+        self.restarts += 1
+        self.restart_time = time.monotonic() + backoff
+        LOGGER.warning("The {0} {1} (code {2}), restarting in {3}s"
+                       .format(self.name, reason, returncode, backoff))
+
+    async def ensure_started(self):
+        """Starts the worker if it isn't running, returns False while waiting to restart it"""
+        if self.process is not None:
+            return True
+        if time.monotonic() < self.restart_time:
+            return False
+        try:
+            await self.start()
+        except (EOFError, trio.BrokenResourceError):
+            await self.stop("failed to start")
+            raise PluginWorkerError("The {0} failed to start".format(self.name))
+        return True
+
+    async def call(self, slot, method):
+        """Calls a method of a class in the worker, restarting the worker if needed
+
+        Returns None while waiting to restart the worker
+        """
+        async with self.lock:
+            try:
+                restart = self.results is not None and self.process is None
+                if not await self.ensure_started():
+                    return None
+                if restart:
+                    LOGGER.info("Restarted the {0}".format(self.name))
+                    for init_slot, has_init_fetch in enumerate(self.has_init_fetch):
+                        if has_init_fetch and not isinstance(self.results[init_slot], str):
+                            try:
+                                await self.request(init_slot, "init_fetch")
+                            except PluginWorkerError:
+                                exc = sys.exc_info()
+                                LOGGER.error(format_error(exc, message="init_fetch failed "
+                                                          "after restarting the {0}"
+                                                          .format(self.name)))
+                    if method == "init_fetch":
+                        return None
+                result = await self.request(slot, method)
+            except (EOFError, trio.BrokenResourceError):
+                await self.stop("exited")
+                raise PluginWorkerError("The {0} exited".format(self.name))
+            except trio.Cancelled:
+                self.timeout_streak += 1
+                if self.timeout_streak >= self.max_timeouts:
+                    await self.stop("timed out {0} times in a row and was killed"
+                                    .format(self.timeout_streak))
+                raise
+            self.timeout_streak = 0
+            if time.monotonic() - self.start_time > self.restart_backoff[1]:
+                self.restarts = 0
+            return result
+
+
+class PluginWorker(BaseStat):
+    """Proxy for a plugin stat class run in the isolated plugin worker pool (isolated-plugins)
+
+    The classes are spread over the workers of the pool (isolated-workers), so a plugin which
+    crashes or hangs only affects the classes sharing its worker, while the number of worker
+    processes stays bounded however many classes there are.
+    """
+    def __init__(self, worker, module, index, description):
+        self.worker = worker
+        self.slot = worker.add(module, index, description)
+        self.name = description["name"]
+        for attribute in ("interval", "timeout", "time_needed"):
+            if description[attribute] is not None:
+                setattr(self, attribute, description[attribute])
+        if description["init_fetch"]:
+            self.init_fetch = self.remote_init_fetch
+        if description["poll_stats"]:
+            self.poll_stats = self.remote_poll_stats
+
+    async def async_init(self):
+        """Starts the worker (if another class hasn't already), raising if the class failed
+        to initialise"""
+        async with self.worker.lock:
+            if self.worker.results is None:
+                await self.worker.start()
+        result = self.worker.results[self.slot]
+        if isinstance(result, str):
+            raise PluginWorkerError(result)
+
+    async def remote_init_fetch(self):
+        """Runs init_fetch in the worker"""
+        return await self.worker.call(self.slot, "init_fetch")
+
+    async def remote_poll_stats(self):
+        """Runs poll_stats in the worker"""
+        return await self.worker.call(self.slot, "poll_stats")
+
+    async def get_stats(self):
+        """Runs get_stats in the worker"""
+        return await self.worker.call(self.slot, "get_stats")
+
+#
+# helpers
+#
+
+def critical_exit(exc, message=""):
+    """Exits with a critical error"""
+    LOGGER.critical(format_error(exc, message=message))
+    sys.exit(1)
+
+def delta_current_time(time_, clamp_to_zero=False):
+    """Calculate the time until a given time"""
+    delta = time_ - BaseStat.current_time()
+    if clamp_to_zero:
+        delta = max(delta, 0)
+    return delta
+
+def next_target_ns(interval_ns):
+    """Returns the next interval boundary at least 1s from now, in integer nanoseconds"""
+    return -(-(round(time.time() * 10 ** 9) + 10 ** 9) // interval_ns) * interval_ns
+
+async def sleep_until(time_):
+    """Sleep until a given time"""
+    await trio.sleep(delta_current_time(time_, clamp_to_zero=True))
+
+def create_sublogger(level, path=None):
+    """Sets up a sublogger"""
+    formatter = logging.Formatter("%(asctime)s %(name)s %(process)d %(levelname)s %(message)s")
+    if path is None:
+        logger_handler = logging.StreamHandler(sys.stdout)
+    else:
+        logger_handler = logging.FileHandler(path)
+    logger_handler.setLevel(level)
+    logger_handler.setFormatter(formatter)
+    return logger_handler
+
+def point_parts(dataset):
+    """Returns the measurement, tags and (key, value) field pairs of a stat result dict or Point"""
+    if type(dataset) is Point:
+        return dataset.measurement, dataset.tags, dataset.fields()
+    return (dataset.get("measurement"), dataset.get("tags"),
+            [(key, value) for key, value in dataset.items()
+             if key != "measurement" and key != "tags"])
+
+#
+# aggregation
+#
+
+class QuantileEstimator:
+    """Streaming quantile estimate in constant memory (the P-squared algorithm)
+
+    Up to exact_limit values are kept and the quantile is exact, the P-squared estimate is
+    poor for small samples. After that, 5 markers initialised from the kept values are moved
+    towards the quantile as values are added
+    """
+    exact_limit = 64
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.values = []
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def start_markers(self):
+        """Switches from the kept values to the markers"""
+        values = sorted(self.values)
+        last = len(values) - 1
+        self.desired = [last * increment for increment in self.increments]
+        self.positions = [0]
+        for index in (1, 2, 3):
+            self.positions.append(min(max(round(self.desired[index]), self.positions[-1] + 1),
+                                      last - 4 + index))
+        self.positions.append(last)
+        self.heights = [values[position] for position in self.positions]
+        self.values = None
+
+    def add(self, value):
+        """Adds a value"""
+        if self.values is not None:
+            self.values.append(value)
+            if len(self.values) > self.exact_limit:
+                self.start_markers()
+            return
+        heights = self.heights
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        positions = self.positions
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+        for index in (1, 2, 3):
+            offset = self.desired[index] - positions[index]
+            if ((offset >= 1 and positions[index + 1] - positions[index] > 1)
+                    or (offset <= -1 and positions[index - 1] - positions[index] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = (heights[index] + step * (heights[index + step] - heights[index])
+                              / (positions[index + step] - positions[index]))
+                heights[index] = height
+                positions[index] += step
+
+    def parabolic(self, index, step):
+        """Returns the piecewise parabolic prediction of a marker height"""
+        heights = self.heights
+        positions = self.positions
+        return heights[index] + step / (positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step)
+            * (heights[index + 1] - heights[index]) / (positions[index + 1] - positions[index])
+            + (positions[index + 1] - positions[index] - step)
+            * (heights[index] - heights[index - 1]) / (positions[index] - positions[index - 1]))
+
+    def value(self):
+        """Returns the estimate, None if no values have been added"""
+        if self.values is None:
+            return self.heights[2]
+        if not self.values:
+            return None
+        # nearest rank
+        values = sorted(self.values)
+        return values[max(math.ceil(self.quantile * len(values)) - 1, 0)]
+
+
+class FieldAggregate:
+    """Accumulates a numeric field over an aggregation window in constant memory"""
+    def __init__(self, value, quantiles):
+        self.minimum = self.maximum = self.last = value
+        self.total = value
+        self.count = 1
+        self.is_int = isinstance(value, numbers.Integral)
+        self.estimators = [QuantileEstimator(quantile) for quantile in quantiles]
+        for estimator in self.estimators:
+            estimator.add(value)
+
+    def add(self, value):
+        """Adds a value"""
+        if value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.last = value
+        self.total += value
+        self.count += 1
+        if self.is_int and type(value) is not int:
+            self.is_int = isinstance(value, numbers.Integral)
+        for estimator in self.estimators:
+            estimator.add(value)
+
+    def results(self, key, functions):
+        """Returns the aggregated fields, the mean is written under the original key
+
+        Integer fields stay integers, so the field types in influx don't change
+        """
+        out_data = {}
+        estimators = iter(self.estimators)
+        for function in functions:
+            if function == "mean":
+                value = self.total / self.count
+            elif function == "min":
+                value = self.minimum
+            elif function == "max":
+                value = self.maximum
+            elif function == "last":
+                value = self.last
+            else:
+                value = next(estimators).value()
+            if self.is_int:
+                value = round(value)
+            out_data[key if function == "mean" else "{0}_{1}".format(key, function)] = value
+        return out_data
+
+
+class Aggregator:
+    """Aggregates stat results over fixed windows, aligned to the epoch, before they are written
+
+    Numeric fields are written as the functions given (mean, min, max, last and pNN
+    percentiles), other fields (eg strings and booleans) are written as their last value.
+    Each series only holds constant size accumulators for the current window.
+    """
+    basic_functions = ("mean", "min", "max", "last")
+
+    def __init__(self, window_ns, functions):
+        self.window_ns = window_ns
+        self.functions = functions
+        self.quantiles = [float(function[1:]) / 100 for function in functions
+                          if function not in self.basic_functions]
+        self.window = None
+        self.series = {}
+
+    @classmethod
+    def valid_function(cls, function):
+        """Returns whether a function name is valid"""
+        if function in cls.basic_functions:
+            return True
+        try:
+            return function.startswith("p") and 0 < float(function[1:]) < 100
+        except ValueError:
+            return False
+
+    def add(self, results, time_ns):
+        """Adds (name, result) pairs collected at time_ns
+
+        If time_ns is in a new window, returns (results, window start ns) of the previous
+        window, otherwise None
+        """
+        window = time_ns // self.window_ns
+        flushed = None
+        if window != self.window:
+            flushed = self.flush()
+            self.window = window
+        for name, result in results:
+            if result is None:
+                continue
+            if isinstance(result, (dict, Point)):
+                result = (result,)
+            for dataset in result:
+                measurement, tags, dataset_fields = point_parts(dataset)
+                if measurement is None:
+                    continue
+                series_key = (name, measurement, tuple(sorted(tags.items())) if tags else ())
+                fields = self.series.get(series_key)
+                if fields is None:
+                    fields = self.series[series_key] = {}
+                for key, value in dataset_fields:
+                    if value is None:
+                        continue
+                    value_type = type(value)
+                    if value_type is not float and value_type is not int and (
+                            value_type is bool or not isinstance(value, numbers.Real)):
+                        fields[key] = value
+                        continue
+                    aggregate = fields.get(key)
+                    if type(aggregate) is FieldAggregate:
+                        aggregate.add(value)
+                    else:
+                        fields[key] = FieldAggregate(value, self.quantiles)
+        return flushed
+
+    def flush(self):
+        """Returns (results, window start ns) of the current window and starts a new one
+
+        Returns None if nothing has been added
+        """
+        if not self.series:
+            return None
+        results = {}
+        for (name, measurement, tags), fields in self.series.items():
+            dataset = {"measurement": measurement}
+            for key, aggregate in fields.items():
+                if isinstance(aggregate, FieldAggregate):
+                    dataset.update(aggregate.results(key, self.functions))
+                else:
+                    dataset[key] = aggregate
+            if tags:
+                dataset["tags"] = dict(tags)
+            results.setdefault(name, []).append(dataset)
+        self.series = {}
+        return list(results.items()), self.window * self.window_ns
+
+#
+# line protocol
+#
+
+class EmissionPolicy:
+    """Decides which fields to write, so fields which rarely change aren't written every cycle
+
+    Rules are per measurement and field (or * for every field of a measurement):
+        change      written only when the value changes
+        keyframe    written only on keyframes
+        <number>    absolute deadband, written when the value differs from the last written
+                    value by more than the number
+        <number>%   relative deadband, as a percentage of the last written value
+    Every field with a rule is also written when it hasn't been written for the keyframe
+    interval, so the latest value is always within the interval of any time.
+    The last written value of at most max_series fields is kept, the least recently seen are
+    evicted (and written again when they are next seen).
+    """
+    max_series = 65536
+
+    def __init__(self, rules, keyframe_interval):
+        # keyframe_interval is in the timestamp precision of the serializer
+        self.rules = rules
+        self.keyframe_interval = keyframe_interval
+        self.last = collections.OrderedDict()
+
+    @staticmethod
+    def parse_rules(specs):
+        """Returns {measurement: {field: (mode, threshold)}} from measurement.field=rule specs
+
+        Raises ValueError for an invalid spec
+        """
+        rules = {}
+        for spec in specs:
+            series, _, rule = spec.partition("=")
+            measurement, _, field = series.partition(".")
+            if not measurement or not field or not rule:
+                raise ValueError("Invalid emission policy {0}".format(spec))
+            if rule in ("change", "keyframe"):
+                mode, threshold = rule, None
+            elif rule.endswith("%"):
+                mode, threshold = "relative", float(rule[:-1]) / 100
+            else:
+                mode, threshold = "absolute", float(rule)
+            if threshold is not None and threshold < 0:
+                raise ValueError("Invalid emission policy {0}".format(spec))
+            rules.setdefault(measurement, {})[field] = (mode, threshold)
+        return rules
+
+    def measurement_rules(self, measurement):
+        """Returns the rules for a measurement, or None if it has none"""
+        return self.rules.get(measurement)
+
+    def should_write(self, rules, series, key, value, timestamp):
+        """Returns whether a field should be written, and records it as written if so
+
+        series identifies the measurement and tag set, timestamp is in the serializer precision
+        """
+        rule = rules.get(key) or rules.get("*")
+        if rule is None:
+            return True
+        state_key = (series, key)
+        last = self.last.get(state_key)
+        if last is not None:
+            self.last.move_to_end(state_key)
+        if last is not None and timestamp - last[1] < self.keyframe_interval:
+            mode, threshold = rule
+            last_value = last[0]
+            if mode == "keyframe":
+                return False
+            if (mode == "change" or not isinstance(value, numbers.Real)
+                    or not isinstance(last_value, numbers.Real)):
+                if value == last_value:
+                    return False
+            elif mode == "absolute":
+                if abs(value - last_value) <= threshold:
+                    return False
+            elif abs(value - last_value) <= abs(last_value) * threshold:
+                return False
+        elif last is None and len(self.last) >= self.max_series:
+            self.last.popitem(last=False)
+        self.last[state_key] = (value, timestamp)
+        return True
+
+
+class LineSerializer:
+    """Serializes stat results directly to influx line protocol
+
+    With wide rows, the per cpu/device points of the measurements in wide_tags are collapsed
+    into one row per measurement, with the tag value appended to the field keys (eg util_17).
+    An EmissionPolicy can be given to skip writing fields which haven't changed.
+    """
+    divisors = dict(s=10 ** 9, ms=10 ** 6, u=10 ** 3, n=1)
+    wide_tags = WIDE_TAGS
+    max_cache_size = 65536
+    # line protocol has no escape for newlines in names, tags and keys, so they are dropped
+    escapes = str.maketrans({"\\": "\\\\", " ": "\\ ", ",": "\\,", "=": "\\=", "\n": None})
+    string_escapes = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n"})
+
+    def __init__(self, precision="s", wide=False, policy=None):
+        self.precision = precision
+        self.wide = wide
+        self.policy = policy
+        self.divisor = self.divisors[precision]
+        self.prefix_cache = {}
+        self.key_cache = {}
+        self.counts = {}
+
+    def timestamp(self, time_ns):
+        """Converts an integer nanosecond time to a timestamp in the serializer precision"""
+        return time_ns // self.divisor
+
+    def escape(self, value):
+        """Escapes a measurement name, tag key/value or field key"""
+        return str(value).translate(self.escapes)
+
+    def prefix(self, measurement, tags):
+        """Returns the escaped measurement and tag set (eg cpu,cpu=17), cached across cycles"""
+        if tags:
+            cache_key = (measurement,) + tuple(sorted(tags.items()))
+        else:
+            cache_key = measurement
+        try:
+            return self.prefix_cache[cache_key]
+        except KeyError:
+            pass
+        if len(self.prefix_cache) >= self.max_cache_size:
+            self.prefix_cache.clear()
+        prefix = self.escape(measurement)
+        if tags:
+            for key, value in sorted(tags.items()):
+                key = self.escape(key)
+                value = self.escape(value)
+                if key and value:
+                    prefix += ",{0}={1}".format(key, value)
+        self.prefix_cache[cache_key] = prefix
+        return prefix
+
+    def field_key(self, key):
+        """Returns an escaped field key, cached across cycles"""
+        try:
+            return self.key_cache[key]
+        except KeyError:
+            pass
+        if len(self.key_cache) >= self.max_cache_size:
+            self.key_cache.clear()
+        escaped = self.escape(key)
+        self.key_cache[key] = escaped
+        return escaped
+
+    def field_value(self, value):
+        """Formats a field value, returns None for unsupported values
+
+        Returns an empty string for NaN and infinity, which line protocol can't represent
+        (influx would reject the whole write), so the field is skipped
+        """
+        value_type = type(value)
+        if value_type is float:
+            return repr(value) if math.isfinite(value) else ""
+        if value_type is int:
+            return "{0}i".format(value)
+        if value_type is bool:
+            return "true" if value else "false"
+        if value_type is str:
+            return "\"{0}\"".format(value.translate(self.string_escapes))
+        if isinstance(value, numbers.Integral):
+            return "{0}i".format(int(value))
+        if isinstance(value, numbers.Real):
+            return self.field_value(float(value))
+        return None
+
+    def widen(self, result, timestamp=0):
+        """Collapses the points of wide measurements into a single row per measurement
+
+        The emission policy is applied to the fields of each point before they are collapsed,
+        so the rules match the field keys (eg util) rather than the wide keys (eg util_17)
+        """
+        rows = {}
+        out_data = []
+        for dataset in result:
+            measurement, tags, fields = point_parts(dataset)
+            tag = self.wide_tags.get(measurement)
+            if tag is None or (tags and (len(tags) != 1 or tag not in tags)):
+                out_data.append(dataset)
+                continue
+            if measurement not in rows:
+                rows[measurement] = {"measurement": measurement}
+                out_data.append(rows[measurement])
+            row = rows[measurement]
+            suffix = "_{0}".format(tags[tag]) if tags else ""
+            rules = None
+            if self.policy is not None:
+                rules = self.policy.measurement_rules(measurement)
+                series = self.prefix(measurement, tags)
+            for key, value in fields:
+                if (rules is not None and value is not None
+                        and not self.policy.should_write(rules, series, key, value, timestamp)):
+                    continue
+                row[key + suffix] = value
+        return out_data
+
+    def format_point(self, dataset, name, timestamp=0):
+        """Formats a single measurement dict or Point as a line (without timestamp)"""
+        if type(dataset) is Point:
+            if (self.policy is not None
+                    and self.policy.measurement_rules(dataset.measurement) is not None):
+                # the emission policy works on the field keys before escaping
+                return self.format_dict(dataset.as_dict(), name, timestamp)
+            if dataset.line_prefix is None:
+                if dataset.measurement is None:
+                    return None
+                dataset.line_prefix = self.prefix(dataset.measurement, dataset.tags) + " "
+                dataset.line_keys = tuple(self.field_key(key) + "=" for key in dataset.keys)
+            fields = []
+            for key, value in zip(dataset.line_keys, dataset.values):
+                if value is not None:
+                    value_type = type(value)
+                    if value_type is int:
+                        fields.append("{0}{1}i".format(key, value))
+                    elif value_type is float:
+                        if math.isfinite(value):
+                            fields.append(key + repr(value))
+                    else:
+                        value = self.field_value(value)
+                        if value is None:
+                            LOGGER.error("Unsupported value type for field {0} in {1}"
+                                         .format(key, name))
+                            continue
+                        if value:
+                            fields.append(key + value)
+            if not fields:
+                return None
+            return dataset.line_prefix + ",".join(fields)
+        return self.format_dict(dataset, name, timestamp)
+
+    def format_dict(self, dataset, name, timestamp=0):
+        """Formats a single measurement dict as a line (without timestamp)"""
+        if "measurement" not in dataset:
+            LOGGER.error("No measurement found for {0}".format(name))
+            return None
+        measurement = dataset["measurement"]
+        if measurement is None:
+            return None
+        prefix = self.prefix(measurement, dataset.get("tags"))
+        rules = None
+        # the policy has already been applied to the fields of wide rows (which have no tags)
+        if self.policy is not None and not (self.wide and measurement in self.wide_tags
+                                            and not dataset.get("tags")):
+            rules = self.policy.measurement_rules(measurement)
+        fields = []
+        for key, value in dataset.items():
+            if key == "measurement" or key == "tags" or value is None:
+                continue
+            if rules is not None and not self.policy.should_write(rules, prefix, key, value,
+                                                                  timestamp):
+                continue
+            value = self.field_value(value)
+            if value is None:
+                LOGGER.error("Unsupported value type for field {0} in {1}".format(key, name))
+                continue
+            if not value:
+                continue
+            fields.append("{0}={1}".format(self.field_key(key), value))
+        if not fields:
+            return None
+        return "{0} {1}".format(prefix, ",".join(fields))
+
+    def serialize(self, results, timestamp):
+        """Serializes (name, result) pairs into a line protocol payload (bytes)
+
+        The number of points and bytes for each name are stored in counts
+        """
+        suffix = " {0}\n".format(timestamp)
+        lines = []
+        for name, result in results:
+            if result is None:
+                self.counts[name] = (0, 0)
+                continue
+            if isinstance(result, (dict, Point)):
+                result = (result,)
+            if self.wide:
+                result = self.widen(result, timestamp)
+            start = len(lines)
+            for dataset in result:
+                line = self.format_point(dataset, name, timestamp)
+                if line is not None:
+                    lines.append(line)
+            points = len(lines) - start
+            self.counts[name] = (points, sum(map(len, lines[start:])) + points * len(suffix))
+        if not lines:
+            return b""
+        return (suffix.join(lines) + suffix).encode()
+
+#
+# spool
+#
+
+class Spool:
+    """Append-only, segment rotated on-disk spool for batches which could not be written
+
+    Records are framed as length, crc32, flags, precision followed by the payload.
+    Replayed records may be written twice if the program exits mid-segment, this is harmless
+    as influx overwrites points with an identical series and timestamp.
+    """
+    record_header = struct.Struct("<IIBB")
+    precisions = ("n", "u", "ms", "s")
+    suffix = ".spool"
+    flag_compressed = 1
+
+    def __init__(self, path, max_size, compress=False, fsync_interval=5):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = max(min(4 * 1024 ** 2, max_size // 8), 64 * 1024)
+        self.compress = compress
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+        self.segments = collections.OrderedDict()
+        existing = sorted(int(item[:-len(self.suffix)]) for item in os.listdir(path)
+                          if item.endswith(self.suffix) and item[:-len(self.suffix)].isdigit())
+        for seq in existing:
+            self.segments[seq] = os.path.getsize(self.segment_path(seq))
+        # always start a new segment, the last one may have been truncated by a crash
+        self.write_seq = max(existing, default=-1) + 1
+        self.write_file = None
+        self.read_file = None
+        self.read_seq = None
+        self.read_offset = 0
+        self.next_offset = 0
+        self.dirty = False
+        self.last_fsync = time.monotonic()
+        if self.segments:
+            LOGGER.info("Spool contains {0} bytes of unsent data".format(self.size()))
+
+    def segment_path(self, seq):
+        """Returns the path of a segment file"""
+        return os.path.join(self.path, "{0:016d}{1}".format(seq, self.suffix))
+
+    def size(self):
+        """Returns the total size of all segments in bytes"""
+        return sum(self.segments.values())
+
+    def append(self, data, precision):
+        """Appends a payload to the spool, returns whether it was spooled successfully"""
+        flags = 0
+        if self.compress:
+            data = zlib.compress(data)
+            flags |= self.flag_compressed
+        record = self.record_header.pack(len(data), zlib.crc32(data), flags,
+                                         self.precisions.index(precision)) + data
+        try:
+            if self.write_file is None or self.segments[self.write_seq] >= self.segment_size:
+                self.rotate()
+            self.write_file.write(record)
+            self.write_file.flush()
+        except OSError:
+            exc = sys.exc_info()
+            LOGGER.error(format_error(exc, message="Failed to spool data", message_before=True))
+            return False
+        self.segments[self.write_seq] += len(record)
+        self.dirty = True
+        self.enforce_budget()
+        return True
+
+    def rotate(self):
+        """Closes the current write segment and opens the next one"""
+        if self.write_file is not None:
+            os.fsync(self.write_file.fileno())
+            self.write_file.close()
+            self.write_seq += 1
+        self.write_file = open(self.segment_path(self.write_seq), "ab")
+        self.segments[self.write_seq] = 0
+
+    def enforce_budget(self):
+        """Drops the oldest segments while the spool is over its disk budget"""
+        dropped = 0
+        while self.size() > self.max_size and len(self.segments) > 1:
+            seq = next(iter(self.segments))
+            dropped += self.segments[seq]
+            self.remove_segment(seq)
+        if dropped:
+            LOGGER.warning("Spool over size limit, dropped {0} bytes of the oldest data"
+                           .format(dropped))
+
+    def remove_segment(self, seq):
+        """Deletes a segment, closing any open handles to it"""
+        if seq == self.read_seq:
+            self.read_file.close()
+            self.read_file = None
+            self.read_seq = None
+        if seq == self.write_seq and self.write_file is not None:
+            self.write_file.close()
+            self.write_file = None
+            self.write_seq += 1
+        del self.segments[seq]
+        try:
+            os.remove(self.segment_path(seq))
+        except FileNotFoundError:
+            pass
+
+    def read(self):
+        """Returns the oldest unsent (payload, precision) or None if the spool is empty
+
+        The record is only consumed once commit is called.
+        """
+        while self.segments:
+            seq = next(iter(self.segments))
+            if self.read_seq != seq:
+                self.read_file = open(self.segment_path(seq), "rb")
+                self.read_seq = seq
+                self.read_offset = 0
+            self.read_file.seek(self.read_offset)
+            header = self.read_file.read(self.record_header.size)
+            if len(header) == self.record_header.size:
+                length, crc, flags, precision = self.record_header.unpack(header)
+                data = self.read_file.read(length)
+                if len(data) == length and zlib.crc32(data) == crc:
+                    self.next_offset = self.read_offset + len(header) + length
+                    if flags & self.flag_compressed:
+                        data = zlib.decompress(data)
+                    return data, self.precisions[precision]
+                LOGGER.warning("Corrupt record in spool segment {0}, discarding the rest of it"
+                               .format(seq))
+            elif header:
+                LOGGER.warning("Truncated record in spool segment {0}, discarding it"
+                               .format(seq))
+            # segment fully replayed (or unreadable)
+            self.remove_segment(seq)
+        return None
+
+    def commit(self):
+        """Marks the last read record as sent"""
+        self.read_offset = self.next_offset
+
+    async def sync(self, force=False):
+        """Fsyncs the write segment if dirty, batched to once per fsync_interval"""
+        if not self.dirty or self.write_file is None:
+            return
+        if not force and time.monotonic() - self.last_fsync < self.fsync_interval:
+            return
+        self.dirty = False
+        self.last_fsync = time.monotonic()
+        await trio.to_thread.run_sync(os.fsync, self.write_file.fileno())
+
+    def close(self):
+        """Flushes and closes all segments"""
+        if self.write_file is not None:
+            os.fsync(self.write_file.fileno())
+            self.write_file.close()
+            self.write_file = None
+        if self.read_file is not None:
+            self.read_file.close()
+            self.read_file = None
+            self.read_seq = None
+        if self.segments:
+            LOGGER.info("{0} bytes left in spool, will be replayed on next start"
+                        .format(self.size()))
+
+#
+# influx transport
+#
+
+class InfluxWriteError(Exception):
+    """Influx rejected a write or sent an invalid response"""
+
+
+class HTTPConnection:
+    """A single keep-alive HTTP/1.1 connection"""
+    max_header_size = 65536
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = bytearray()
+
+    async def fill(self):
+        """Reads more data from the stream into the buffer"""
+        data = await self.stream.receive_some(65536)
+        if not data:
+            raise trio.BrokenResourceError("Connection closed by server")
+        self.buffer += data
+
+    async def receive_until(self, delimiter):
+        """Returns everything up to (and consumes) the delimiter"""
+        while True:
+            index = self.buffer.find(delimiter)
+            if index != -1:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            if len(self.buffer) > self.max_header_size:
+                raise InfluxWriteError("Response header too large")
+            await self.fill()
+
+    async def receive_exactly(self, size):
+        """Returns exactly size bytes"""
+        while len(self.buffer) < size:
+            await self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def receive_head(self):
+        """Returns the (version, status, headers) of a response"""
+        status_line, *header_lines = (
+            (await self.receive_until(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        )
+        version, status = status_line.split(" ", 2)[:2]
+        headers = {}
+        for line in header_lines:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return version, int(status), headers
+
+    async def request(self, head, body):
+        """Sends a request and returns (status, body, keep_alive) of the response"""
+        await self.stream.send_all(head + body)
+        version, status, headers = await self.receive_head()
+        # skip interim responses (eg 100 Continue)
+        while 100 <= status < 200 and status != 101:
+            version, status, headers = await self.receive_head()
+        keep_alive = (version == "HTTP/1.1"
+                      and headers.get("connection", "").lower() != "close")
+        if head.startswith(b"HEAD ") or 100 <= status < 200 or status in (204, 304):
+            # these responses never have a body, whatever their headers (RFC 9112 6.3)
+            response_body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            response_body = bytearray()
+            while True:
+                size = int((await self.receive_until(b"\r\n")).split(b";")[0], 16)
+                if not size:
+                    # skip any trailers
+                    while await self.receive_until(b"\r\n"):
+                        pass
+                    break
+                response_body += await self.receive_exactly(size)
+                await self.receive_exactly(2)
+            response_body = bytes(response_body)
+        elif "content-length" in headers:
+            response_body = await self.receive_exactly(int(headers["content-length"]))
+        else:
+            # no framing, the body (if any) can't be delimited so don't reuse the connection
+            response_body = bytes(self.buffer)
+            keep_alive = False
+        return status, response_body, keep_alive
+
+
+class InfluxHTTPClient:
+    """Writes line protocol to influx over pooled keep-alive connections
+
+    All network activity happens on the trio loop, the whole write (including connecting and
+    any retry on a stale pooled connection) is bounded by timeout.
+    """
+    max_connections = 4
+    gzip_level = 1
+
+    def __init__(self, host, port, username, password, use_gzip=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.use_gzip = use_gzip
+        self.timeout = timeout
+        self.idle = []
+        self.limiter = trio.CapacityLimiter(self.max_connections)
+        credentials = base64.b64encode("{0}:{1}".format(username, password).encode()).decode()
+        self.headers = ("Host: {0}:{1}\r\nAuthorization: Basic {2}\r\n"
+                        "Content-Type: application/octet-stream\r\n"
+                        .format(host, port, credentials))
+        if use_gzip:
+            self.headers += "Content-Encoding: gzip\r\n"
+
+    async def write(self, database, data, precision):
+        """Writes a line protocol payload, raising on failure"""
+        if self.use_gzip:
+            data = gzip.compress(data, self.gzip_level)
+        head = ("POST /write?{0} HTTP/1.1\r\n{1}Content-Length: {2}\r\n\r\n"
+                .format(urllib.parse.urlencode(dict(db=database, precision=precision)),
+                        self.headers, len(data))).encode()
+        with trio.fail_after(self.timeout):
+            async with self.limiter:
+                status, body = await self.request(head, data)
+        if status != 204:
+            raise InfluxWriteError("Influx returned HTTP {0}: {1}"
+                                   .format(status, body.decode(errors="replace").strip()))
 
+    async def request(self, head, body):
+        """Sends a request, reusing an idle connection where possible"""
+        while self.idle:
+            connection = self.idle.pop()
+            try:
+                return await self.send_request(connection, head, body)
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                # the server most likely closed the idle connection, try the next one
+                LOGGER.debug("Pooled influx connection closed, reconnecting")
+        stream = await trio.open_tcp_stream(self.host, self.port)
+        return await self.send_request(HTTPConnection(stream), head, body)
 
-class DiskBase(BaseStat):
-    """Shared methods between the two disk classes"""
-    def __init__(self, disk_filters, filter_mode):
-        self.filter_mode = filter_mode
-        self.regex_matches = []
-        self.filed_disks = {}
-        self.regex_compile_list(disk_filters)
+    async def send_request(self, connection, head, body):
+        """Sends a request on a connection, returning it to the pool if it can be reused"""
+        try:
+            status, response_body, keep_alive = await connection.request(head, body)
+        except BaseException:
+            await trio.aclose_forcefully(connection.stream)
+            raise
+        if keep_alive:
+            self.idle.append(connection)
+        else:
+            await trio.aclose_forcefully(connection.stream)
+        return status, response_body
 
-    def regex_compile_list(self, list_to_check):
-        """Compiles all regex entries"""
-        for item in list_to_check:
+    async def aclose(self):
+        """Closes all pooled connections"""
+        while self.idle:
+            await trio.aclose_forcefully(self.idle.pop().stream)
+
+
+class InfluxUDPClient:
+    """Writes line protocol to the influx UDP listener, never blocking and without threads
+
+    Points are packed into datagrams of whole lines which fit in the MTU. Datagrams which
+    can't be sent immediately (eg the socket buffer is full) are dropped and counted.
+    The database and precision are set in the influx UDP listener config.
+    """
+    header_sizes = {socket.AF_INET: 28, socket.AF_INET6: 48}
+
+    def __init__(self, host, port, mtu=1500):
+        self.host = host
+        self.port = port
+        self.mtu = mtu
+        self.socket = None
+        self.payload_size = None
+        self.totals = dict(packets=0, bytes=0, dropped=0)
+
+    async def write(self, database, data, precision):
+        """Sends a line protocol payload, raising only if the socket can't be set up"""
+        if self.socket is None:
+            family, kind, proto, _, address = (await trio.socket.getaddrinfo(
+                self.host, self.port, type=socket.SOCK_DGRAM))[0]
+            self.socket = socket.socket(family, kind, proto)
+            self.socket.setblocking(False)
+            self.socket.connect(address)
+            self.payload_size = self.mtu - self.header_sizes.get(family, 48)
+        for datagram in split_lines(data, self.payload_size):
             try:
-                expr = re.compile(item)
-                self.regex_matches.append(expr)
-            except re.error:
-                raise ValueError("Disk filter specified is not valid regex")
+                self.socket.send(datagram)
+            except OSError:
+                # BlockingIOError, or an ICMP error (eg nothing listening) from an earlier send
+                self.totals["dropped"] += 1
+            else:
+                self.totals["packets"] += 1
+                self.totals["bytes"] += len(datagram)
 
-    def check_disk_valid(self, disk):
-        """Checks if a disk is valid"""
-        if disk in self.filed_disks:
-            return self.filed_disks[disk]
-        return_mode = False
-        if self.filter_mode == "include":
-            return_mode = True
-        for item in self.regex_matches:
-            if item.fullmatch(disk):
-                self.filed_disks[disk] = return_mode
-                return return_mode
-        self.filed_disks[disk] = not return_mode
-        return not return_mode
+    async def aclose(self):
+        """Closes the socket"""
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
+#
+# relay
+#
 
-class DiskStorageStats(DiskBase):
-    """All stats related to storage space on disks"""
-    name = "Disk"
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        out_data = []
-        for item in [device.mountpoint for device in psutil.disk_partitions()]:
-            if not self.check_disk_valid(item):
-                continue
-            disk_data = psutil.disk_usage(item)
-            results = {}
-            results["total"] = disk_data.total
-            results["used"] = disk_data.used
-            results["percent"] = disk_data.percent
-            out_data.append({"measurement": "disk", **results, "tags": {"disk": item}})
-        return out_data
+def split_lines(data, limit):
+    """Splits a line protocol payload into chunks of whole lines of at most limit bytes
 
+    A single line longer than limit is yielded on its own
+    """
+    start = 0
+    while len(data) - start > limit:
+        end = data.rfind(b"\n", start, start + limit) + 1
+        if end <= start:
+            end = data.find(b"\n", start) + 1 or len(data)
+        yield data[start:end]
+        start = end
+    if start < len(data):
+        yield data[start:]
 
-class DiskIOStats(DiskBase):
-    """All stats related to IO on disks"""
-    name = "DiskIO"
-    def __init__(self, disk_filters, filter_mode):
-        self.diskio_persistent = []
-        self.last_end_time = 0
-        self.remap = dict(read_time=dict(mult=10 ** -1), write_time=dict(mult=10 ** -1),
-                          busy_time=dict(mult=10 ** -1), read_count=dict(name="disk_reads"),
-                          write_count=dict(name="disk_writes"),
-                          read_merged_count=dict(name="merged_reads"),
-                          write_merged_count=dict(name="merged_writes"))
-        super().__init__(disk_filters, filter_mode)
 
-    async def init_fetch(self):
-        """Fetches stats for post-initialisation"""
-        self.diskio_persistent = {k: v._asdict()
-                                  for k, v in psutil.disk_io_counters(perdisk=True).items()}
-        self.last_end_time = self.current_time()
+class RelayProtocol:
+    """Frames line protocol batches between agents and a relay
 
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        current_stats = {k: v._asdict() for k, v in psutil.disk_io_counters(perdisk=True).items()}
+    Each frame is a header (payload length, precision, flags) and the payload. Over TCP the
+    relay acknowledges each frame with a status byte once the data is queued or spooled, over
+    UDP each datagram is one frame and isn't acknowledged.
+    """
+    header = struct.Struct("<IBB")
+    precisions = ("n", "u", "ms", "s")
+    flag_compressed = 1
+    max_payload_size = 64 * 1024 ** 2
+    max_datagram_size = 65000
+    ack_ok = b"\x00"
+    ack_error = b"\x01"
 
-        time_delta = self.current_time() - self.last_end_time
-        self.last_end_time = self.current_time()
-        stats_delta = {}
-        for disk, previous_value in self.diskio_persistent.items():
-            if not self.check_disk_valid(disk):
-                continue
-            if disk in current_stats:
-                new_value = current_stats[disk]
-                stats_delta[disk] = {key: round((new_value[key] - previous_value[key]) / time_delta)
-                                     for key in new_value}
-            else:
-                LOGGER.info("Disk {0} no longer found. Unplugged?"
-                            .format(disk))
-        self.diskio_persistent = current_stats
-        out_data = []
-        for disk, data in stats_delta.items():
-            # iterate over what the keys are now - they may be changed during iterations
-            for key in list(data.keys()):
-                if key in self.remap:
-                    if "mult" in self.remap[key]:
-                        data[key] *= self.remap[key]["mult"]
-                    if "name" in self.remap[key]:
-                        new_name = self.remap[key]["name"]
-                        data[new_name] = data.pop(key)
-                        key = new_name
-            out_data.append({"measurement": "diskio", **data, "tags": {"disk": disk}})
-        return out_data
+    @classmethod
+    def encode(cls, data, precision, compress=False):
+        """Returns a frame for a payload"""
+        flags = 0
+        if compress:
+            data = zlib.compress(data, 1)
+            flags |= cls.flag_compressed
+        return cls.header.pack(len(data), cls.precisions.index(precision), flags) + data
 
+    @classmethod
+    def decode_header(cls, header):
+        """Returns (payload length, precision, flags) of a header, raising ValueError if invalid"""
+        size, precision, flags = cls.header.unpack(header)
+        if size > cls.max_payload_size or precision >= len(cls.precisions):
+            raise ValueError("Invalid relay frame header")
+        return size, cls.precisions[precision], flags
 
-class NetIOStats(BaseStat):
-    """All network related stats"""
-    name = "NetIO"
-    def __init__(self):
-        self.netio_persistent = {}
-        self.last_end_time = 0
-        self.netio_fields = psutil.net_io_counters()._fields
-        self.remap = dict(bytes_sent="tx_bytes", bytes_recv="rx_bytes",
-                          packets_sent="tx_packets", packets_recv="rx_packets")
+    @classmethod
+    def decode_payload(cls, payload, flags):
+        """Returns the line protocol of a payload"""
+        if flags & cls.flag_compressed:
+            payload = zlib.decompressobj().decompress(payload, cls.max_payload_size)
+        return payload
 
-    async def init_fetch(self):
-        """Fetches stats for post-initialisation"""
-        self.netio_persistent = psutil.net_io_counters(pernic=True)
-        self.last_end_time = self.current_time()
 
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        current_stats = psutil.net_io_counters(pernic=True)
-        time_delta = self.current_time() - self.last_end_time
-        self.last_end_time = self.current_time()
-        stats_delta = {}
-        for nic, previous_value in self.netio_persistent.items():
-            if nic in current_stats:
-                new_value = current_stats[nic]
-                stats_delta[nic] = [round((new_value[i] - previous_value[i]) / time_delta)
-                                    for i in range(len(new_value))]
-            else:
-                LOGGER.info("Network interface {0} no longer found. Unplugged/disabled?"
-                            .format(nic))
-        self.netio_persistent = current_stats
-        out_data = []
-        for nic, value in stats_delta.items():
-            results = {}
-            for item in ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv"):
-                results[self.remap[item]] = value[self.netio_fields.index(item)]
-            out_data.append({"measurement": "netio", **results, "tags": {"nic": nic}})
-        return out_data
+class RelayClient:
+    """Sends writes to a relay instead of influx, with the same interface as InfluxHTTPClient
 
+    Over TCP a write is complete once the relay acknowledges it, so failed writes can be
+    spooled. Over UDP writes are fire and forget, split into datagrams of whole lines.
+    """
+    def __init__(self, host, port, protocol="tcp", compress=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.compress = compress
+        self.timeout = timeout
+        self.stream = None
+        self.socket = None
+        self.lock = trio.Lock()
 
-class SensorStats(BaseStat):
-    """All sensor related stats"""
-    name = "Sensors"
-    async def async_init(self):
-        """Async stat initialisation"""
-        if "cpu_temp" not in await self.get_stats():
-            LOGGER.info("CPU thermal sensor not found")
+    async def write(self, database, data, precision):
+        """Sends a line protocol payload to the relay, raising on failure
 
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        temperature_data = psutil.sensors_temperatures()
-        cpu_temperature = None
-        for item in temperature_data.get("coretemp", []):
-            if item.label == "Package id 0":
-                cpu_temperature = item.current
-                break
-        else:
-            for item in temperature_data.get("k10temp", []):
-                if item.label == "Tdie":
-                    cpu_temperature = item.current
-                    break
-            else:
-                if "armada_thermal" in temperature_data:
-                    cpu_temperature = temperature_data["armada_thermal"][0].current
-        if cpu_temperature is not None:
-            return {"measurement": "sensors", "cpu_temp": cpu_temperature}
+        The database is chosen by the relay
+        """
+        if self.protocol == "udp":
+            await self.send_datagrams(data, precision)
+            return
+        frame = RelayProtocol.encode(data, precision, self.compress)
+        with trio.fail_after(self.timeout):
+            async with self.lock:
+                if self.stream is None:
+                    self.stream = await trio.open_tcp_stream(self.host, self.port)
+                try:
+                    await self.stream.send_all(frame)
+                    ack = await self.stream.receive_some(1)
+                except BaseException:
+                    await self.close_stream()
+                    raise
+                if ack != RelayProtocol.ack_ok:
+                    await self.close_stream()
+                    raise InfluxWriteError("Relay rejected the write" if ack else
+                                           "Relay closed the connection")
 
+    async def send_datagrams(self, data, precision):
+        """Sends a payload as datagrams of whole lines"""
+        if self.socket is None:
+            family, kind, proto, _, address = (await trio.socket.getaddrinfo(
+                self.host, self.port, type=trio.socket.SOCK_DGRAM))[0]
+            self.socket = trio.socket.socket(family, kind, proto)
+            await self.socket.connect(address)
+        for chunk in split_lines(data, RelayProtocol.max_datagram_size
+                                 - RelayProtocol.header.size):
+            await self.socket.send(RelayProtocol.encode(chunk, precision, self.compress))
 
+    async def close_stream(self):
+        """Closes the TCP connection, a new one is opened by the next write"""
+        if self.stream is not None:
+            await trio.aclose_forcefully(self.stream)
+            self.stream = None
 
-class MiscStats(BaseStat):
-    """Any other miscellaneous stats"""
-    name = "Misc"
+    async def aclose(self):
+        """Closes the connection / socket"""
+        await self.close_stream()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
-    async def get_stats(self):
-        """Fetches the point stats and pushes to out_data"""
-        sys_load = os.getloadavg()
-        processes = len(psutil.pids())
-        uptime = self.target_time - int(psutil.boot_time())
-        out_data = {"measurement": "misc"}
-        for index, item in enumerate(("load_1", "load_5", "load_15")):
-            out_data[item] = sys_load[index]
-        out_data["processes"] = processes
-        out_data["uptime"] = uptime
-        return out_data
+
+class RelayServer:
+    """Receives batches from agents over TCP and UDP and passes them to influx_write
+
+    The batches share the write channel, batching and spool of the local stats. When the
+    channel is full and spooling is disabled, TCP connections stop being read, so agents are
+    slowed down by TCP flow control rather than data being dropped. Timestamps are converted
+    to the relay's precision if an agent uses another precision.
+    """
+    def __init__(self, args, metrics_send_channel, spool):
+        self.args = args
+        self.metrics_send_channel = metrics_send_channel
+        self.spool = spool
+        self.precision = args["precision"]
+        self.totals = dict(connections=0, frames=0, bytes=0, errors=0)
+        self.warned_precisions = set()
+
+    async def serve(self, host, port, exit_event):
+        """Serves TCP and UDP until the exit event is set"""
+        async with self.metrics_send_channel:
+            async with trio.open_nursery() as nursery:
+                await nursery.start(functools.partial(trio.serve_tcp, self.handle_connection, port,
+                                                      host=host or None))
+                nursery.start_soon(self.serve_udp, host, port)
+                LOGGER.info("Relay listening on {0}:{1}".format(host or "*", port))
+                await exit_event.wait()
+                nursery.cancel_scope.cancel()
+        LOGGER.info("Relay received {frames} frames ({bytes} bytes) over {connections} "
+                    "connections, {errors} invalid".format(**self.totals))
+
+    async def handle_connection(self, stream):
+        """Receives frames from an agent's TCP connection"""
+        self.totals["connections"] += 1
+        # only used for its buffered reads, which raise BrokenResourceError once the agent
+        # closes the connection
+        connection = HTTPConnection(stream)
+        try:
+            while True:
+                try:
+                    size, precision, flags = RelayProtocol.decode_header(
+                        await connection.receive_exactly(RelayProtocol.header.size))
+                    data = RelayProtocol.decode_payload(await connection.receive_exactly(size),
+                                                        flags)
+                except (ValueError, zlib.error):
+                    self.totals["errors"] += 1
+                    LOGGER.warning("Invalid frame from relay agent, closing connection")
+                    await stream.send_all(RelayProtocol.ack_error)
+                    return
+                await self.forward(data, precision)
+                await stream.send_all(RelayProtocol.ack_ok)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        finally:
+            await trio.aclose_forcefully(stream)
+
+    async def serve_udp(self, host, port):
+        """Receives frames from agents as datagrams"""
+        family = trio.socket.AF_INET6 if ":" in host else trio.socket.AF_INET
+        with trio.socket.socket(family, trio.socket.SOCK_DGRAM) as udp_socket:
+            await udp_socket.bind((host, port))
+            while True:
+                datagram = await udp_socket.recv(65536)
+                try:
+                    size, precision, flags = RelayProtocol.decode_header(
+                        datagram[:RelayProtocol.header.size])
+                    if size != len(datagram) - RelayProtocol.header.size:
+                        raise ValueError("Truncated relay datagram")
+                    data = RelayProtocol.decode_payload(datagram[RelayProtocol.header.size:],
+                                                        flags)
+                except (ValueError, struct.error, zlib.error):
+                    self.totals["errors"] += 1
+                    LOGGER.debug("Invalid datagram from relay agent")
+                    continue
+                await self.forward(data, precision)
+
+    async def forward(self, data, precision):
+        """Converts the timestamps to the relay precision and queues the data for writing"""
+        if not data:
+            return
+        if precision != self.precision:
+            data = self.convert_precision(data, precision)
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        self.totals["frames"] += 1
+        self.totals["bytes"] += len(data)
+        await send_write_data(self.args, self.metrics_send_channel, self.spool, data,
+                              self.precision)
+
+    def convert_precision(self, data, precision):
+        """Returns the payload with its timestamps converted to the relay precision"""
+        from_divisor = LineSerializer.divisors[precision]
+        to_divisor = LineSerializer.divisors[self.precision]
+        if from_divisor < to_divisor and precision not in self.warned_precisions:
+            self.warned_precisions.add(precision)
+            LOGGER.warning("Relay agent precision {0} is finer than the relay precision {1}, "
+                           "timestamps are truncated".format(precision, self.precision))
+        lines = []
+        for line in data.splitlines():
+            head, _, timestamp = line.rpartition(b" ")
+            if not head:
+                continue
+            lines.append(b"%s %d" % (head, int(timestamp) * from_divisor // to_divisor))
+        return b"\n".join(lines)
 
 #
-# helpers
+# internal metrics
 #
 
-def critical_exit(exc, message=""):
-    """Exits with a critical error"""
-    LOGGER.critical(format_error(exc, message=message))
-    sys.exit(1)
+class InternalStats(trio.abc.Instrument):
+    """Agent self-metrics (smi_internal)
 
-def delta_current_time(time_, clamp_to_zero=False):
-    """Calculate the time until a given time"""
-    delta = time_ - BaseStat.current_time()
-    if clamp_to_zero:
-        delta = max(delta, 0)
-    return delta
+    Also a trio instrument which tracks the CPU time used by each task, so each stat class
+    is only charged for its own task steps.
+    """
+    def __init__(self):
+        self.task_cpu = {}
+        self.step_start = 0
+        self.loop_lag = None
+        self.write_latency = None
+        self.batch_points = None
+        # packet counters of the UDP writer
+        self.write_totals = None
+        self.last_process_time = time.process_time()
+        self.last_wall_time = time.monotonic()
+        self.process = psutil.Process()
 
-async def sleep_until(time_):
-    """Sleep until a given time"""
-    await trio.sleep(delta_current_time(time_, clamp_to_zero=True))
+    def before_task_step(self, task):
+        self.step_start = time.thread_time()
 
-def create_sublogger(level, path=None):
-    """Sets up a sublogger"""
-    formatter = logging.Formatter("%(asctime)s %(name)s %(process)d %(levelname)s %(message)s")
-    if path is None:
-        logger_handler = logging.StreamHandler(sys.stdout)
-    else:
-        logger_handler = logging.FileHandler(path)
-    logger_handler.setLevel(level)
-    logger_handler.setFormatter(formatter)
-    return logger_handler
+    def after_task_step(self, task):
+        if task in self.task_cpu:
+            self.task_cpu[task] += time.thread_time() - self.step_start
+
+    def task_exited(self, task):
+        self.task_cpu.pop(task, None)
+
+    def cpu_time(self):
+        """Returns the CPU time used by the current task since it was first queried"""
+        task = trio.lowlevel.current_task()
+        if task not in self.task_cpu:
+            self.task_cpu[task] = 0.0
+        return self.task_cpu[task] + time.thread_time() - self.step_start
 
+    def phase_start(self):
+        """Returns the start (wall, cpu) time of a collect phase"""
+        return time.perf_counter(), self.cpu_time()
+
+    def phase_end(self, stat_entry, mode, start):
+        """Records the wall and CPU time of a collect phase"""
+        stat_entry["timing"]["{0}_wall".format(mode)] = time.perf_counter() - start[0]
+        stat_entry["timing"]["{0}_cpu".format(mode)] = self.cpu_time() - start[1]
+
+    def measurements(self, stats_objects, serializer, channel_depth):
+        """Returns the smi_internal measurements for the cycle just serialized"""
+        process_time = time.process_time()
+        wall_time = time.monotonic()
+        cpu_percent = ((process_time - self.last_process_time)
+                       / max(wall_time - self.last_wall_time, 1e-9) * 100)
+        self.last_process_time = process_time
+        self.last_wall_time = wall_time
+        out_data = [{"measurement": "smi_internal", "loop_lag": self.loop_lag,
+                     "channel_depth": channel_depth, "write_latency": self.write_latency,
+                     "batch_points": self.batch_points, "cpu_percent": cpu_percent,
+                     "rss": self.process.memory_info().rss}]
+        if self.write_totals is not None:
+            out_data[0].update(("udp_{0}".format(key), value)
+                               for key, value in self.write_totals.items())
+        total_points = total_bytes = 0
+        for name, stat_entry in stats_objects.items():
+            if not stat_entry["due"]:
+                continue
+            points, size = serializer.counts.get(name, (0, 0))
+            total_points += points
+            total_bytes += size
+            out_data.append({"measurement": "smi_internal", **stat_entry["timing"],
+                             "points": points, "bytes": size,
+                             "overruns": stat_entry["overruns"],
+                             "timeouts": stat_entry["timeouts"], "tags": {"stat": name}})
+        out_data[0]["points"] = total_points
+        out_data[0]["bytes"] = total_bytes
+        return out_data
 
 #
 # maih
@@ -552,70 +3394,197 @@ async def initialise(args):
     plugins_dir = "plugins"
     collect_interval = args["collect_interval"]
     pidfile = args["pidfile"]
-    influx_args = {x: args[x]
-                   for x in ["host", "port", "username", "password", "database"]}
+    spool = None
     if not args["dry_run"]:
-        client = influxdb.InfluxDBClient(**influx_args)
+        if args["relay"] is not None:
+            client = RelayClient(*args["relay"], protocol=args["relay_protocol"],
+                                 compress=args["gzip"], timeout=args["write_timeout"])
+        elif args["transport"] == "udp":
+            client = InfluxUDPClient(args["host"], args["port"], args["udp_mtu"])
+        else:
+            client = InfluxHTTPClient(args["host"], args["port"], args["username"],
+                                      args["password"], use_gzip=args["gzip"],
+                                      timeout=args["write_timeout"])
+        if args["spool_dir"] is not None:
+            spool = Spool(args["spool_dir"], args["spool_max_size"] * 1024 ** 2,
+                          compress=args["spool_compress"],
+                          fsync_interval=args["spool_fsync_interval"])
     try:
-        stats_objects = [CPUStats(), MemoryStats(), DiskStorageStats(*args["mountpoint_filters"]),
-                         DiskIOStats(*args["disk_filters"]), NetIOStats(), SensorStats(),
-                         MiscStats(), GPUStats()]
+        stats_objects = builtin_stats(args)
+        workers = [PluginWorkerProcess(number) for number in range(args["isolated_workers"])]
+        isolated_classes = 0
         modules = os.listdir(plugins_dir)
         for item in modules:
             if not item.endswith(".py"):
                 continue
             item = item[:-3]
             try:
+                if item in args["isolated_plugins"]:
+                    module_name = "{0}.{1}".format(plugins_dir, item)
+                    descriptions = await PluginWorkerProcess.describe(module_name)
+                    for index, description in enumerate(descriptions):
+                        # the classes are spread over the worker pool
+                        worker = workers[isolated_classes % len(workers)]
+                        isolated_classes += 1
+                        stats_objects.append(PluginWorker(worker, module_name, index,
+                                                          description))
+                        LOGGER.debug("Loaded class {0} from {1} (isolated, {2})"
+                                     .format(description["name"], item, worker.name))
+                    LOGGER.info("Loaded plugin {0} successfully (isolated)".format(item))
+                    continue
                 module = importlib.import_module("{0}.{1}".format(plugins_dir, item))
                 if not hasattr(module, "ACTIVATED_METRICS"):
                     LOGGER.warning("Plugin {0} appears to have no ACTIVATED_METRICS array"
                                    ", skipping".format(item))
                     continue
                 for stat_class in module.ACTIVATED_METRICS:
-                    class_instance = stat_class()
-                    if hasattr(class_instance, "async_init"):
-                        await class_instance.async_init()
-                    stats_objects.append(class_instance)
+                    stats_objects.append(stat_class())
                     LOGGER.debug("Loaded class {0} from {1}".format(stat_class.name, item))
                 if module.ACTIVATED_METRICS:
                     LOGGER.info("Loaded plugin {0} successfully".format(item))
                 else:
                     LOGGER.debug("Loaded plugin {0} with no activated metrics".format(item))
-            except (Exception, trio.MultiError):
+            except (Exception, BaseExceptionGroup) as error:
+                if contains_cancelled(error):
+                    raise
                 exc = sys.exc_info()
                 LOGGER.error(format_error(exc, message="Failed to import plugin {0}".format(item),
                                           message_before=True))
-        stats_objects = {x.name:
-                         dict(obj=x, errors={}, result=None, continuous=hasattr(x, "poll_stats"))
-                         for x in stats_objects}
+        for item in args["isolated_plugins"]:
+            if "{0}.py".format(item) not in modules:
+                LOGGER.warning("Isolated plugin {0} not found in {1}".format(item, plugins_dir))
+        stats_objects = create_stat_entries(stats_objects, collect_interval,
+                                            args["stat_intervals"], args["collector_threads"])
+        for name, stat_entry in stats_objects.items():
+            if stat_entry["every"] > 1:
+                LOGGER.debug("{0} is collected every {1} cycles".format(name, stat_entry["every"]))
+        for name in args["stat_intervals"]:
+            if name not in stats_objects:
+                LOGGER.warning("Stat interval specified for {0}, which is not loaded".format(name))
         BaseStat.collect_interval = collect_interval
-        for item in stats_objects.values():
-            if hasattr(item["obj"], "init_fetch"):
-                await item["obj"].init_fetch()
-    except (Exception, trio.MultiError):
+        await initialise_stats(stats_objects)
+    except (Exception, BaseExceptionGroup) as error:
+        if contains_cancelled(error):
+            raise
         exc = sys.exc_info()
         critical_exit(exc, message="Initialisation failed")
     LOGGER.info("Initialised successfully")
     # ~5 mins of history
     metrics_send_channel, metrics_receive_channel = (
-        trio.open_memory_channel(max(300 // collect_interval, 1))
+        trio.open_memory_channel(max(int(300 // collect_interval), 1))
     )
     cumulative_errors = dict(stats=0, influx=0)
+    internal_stats = None
+    if args["internal_metrics"]:
+        internal_stats = InternalStats()
+        trio.lowlevel.add_instrument(internal_stats)
+    raw_send_channel = None
+    if args["raw_database"] is not None and args["aggregate_window"] is not None:
+        if args["dry_run"]:
+            LOGGER.info("Dry run, raw data is not forwarded")
+        else:
+            raw_send_channel, raw_receive_channel = (
+                trio.open_memory_channel(max(int(300 // collect_interval), 1))
+            )
     exit_event = trio.Event()
     # current behaviour is to only catch one signal
     # switch to weak/strong nursery for continued signals
     async with trio.open_nursery() as nursery:
         nursery.start_soon(handle_signals, exit_event)
+        if args["relay_listen"] is not None:
+            relay_server = RelayServer(args, metrics_send_channel.clone(), spool)
+            nursery.start_soon(relay_server.serve, *args["relay_listen"], exit_event)
         nursery.start_soon(stats_handler, args, exit_event, stats_objects,
-                           metrics_send_channel, cumulative_errors)
+                           metrics_send_channel, cumulative_errors, spool, internal_stats,
+                           raw_send_channel)
         if not args["dry_run"]:
-            nursery.start_soon(influx_write, client, influx_args["database"],
-                               metrics_receive_channel, cumulative_errors)
+            nursery.start_soon(influx_write, client, args, metrics_receive_channel,
+                               cumulative_errors, spool, internal_stats)
+        if raw_send_channel is not None:
+            # raw data is only kept briefly, so it isn't spooled
+            nursery.start_soon(influx_write, client, args, raw_receive_channel,
+                               cumulative_errors, None, None, args["raw_database"])
     if pidfile is not None:
         LOGGER.debug("Removing pidfile")
         os.remove(pidfile)
     LOGGER.info("Exiting")
 
+def contains_cancelled(exc):
+    """Checks if an exception is trio.Cancelled, or an exception group containing it
+
+    Handlers which catch exception groups (for errors from nurseries) must re-raise these, so the
+    enclosing cancel scope (eg a timeout) sees the cancellation
+    """
+    if isinstance(exc, trio.Cancelled):
+        return True
+    return any(contains_cancelled(inner) for inner in getattr(exc, "exceptions", ()))
+
+
+async def initialise_stats(stats_objects):
+    """Runs the async_init then init_fetch of each stat, with the stats initialised concurrently
+
+    Stats whose async_init fails are removed, a failed init_fetch is raised
+    """
+    failed = []
+    async with trio.open_nursery() as nursery:
+        for name, stat_entry in stats_objects.items():
+            nursery.start_soon(initialise_stat, name, stat_entry["obj"], failed)
+    for name in failed:
+        del stats_objects[name]
+
+
+async def initialise_stat(name, stat_object, failed):
+    """Runs the async_init then init_fetch of a stat"""
+    if hasattr(stat_object, "async_init"):
+        try:
+            await stat_object.async_init()
+        except (Exception, BaseExceptionGroup) as error:
+            if contains_cancelled(error):
+                raise
+            exc = sys.exc_info()
+            LOGGER.error(format_error(exc, message="Failed to initialise {0}".format(name),
+                                      message_before=True))
+            failed.append(name)
+            return
+    if hasattr(stat_object, "init_fetch"):
+        await stat_object.init_fetch()
+
+
+def builtin_stats(args):
+    """Creates the built-in stat objects"""
+    stats_objects = [CPUStats(), MemoryStats(), PressureStats(),
+                     DiskStorageStats(*args["mountpoint_filters"]),
+                     DiskIOStats(*args["disk_filters"]),
+                     NetIOStats(*args["nic_filters"], args["virtual_nics_total"]),
+                     SocketStats(args["socket_max"]), SensorStats(), MiscStats(), GPUStats()]
+    if args["top_processes"]:
+        stats_objects.append(ProcessStats(args["top_processes"]))
+    if args["cgroups"]:
+        stats_objects.append(CgroupStats(*args["cgroup_filters"], args["cgroup_max_depth"],
+                                         args["cgroup_max"]))
+    return stats_objects
+
+def create_stat_entries(stats_objects, collect_interval=1, stat_intervals=None,
+                        collector_threads=4):
+    """Wraps stat objects in the entries used by stats_handler, keyed by name
+
+    every is the number of collect cycles between collections of the stat, from stat_intervals
+    (keyed by name) or the stat's interval attribute, rounded to a multiple of collect_interval.
+    Stats with a non async get_stats are blocking, and share a pool of collector_threads threads
+    """
+    stat_intervals = stat_intervals or {}
+    limiter = trio.CapacityLimiter(collector_threads)
+    entries = {}
+    for x in stats_objects:
+        interval = stat_intervals.get(x.name, getattr(x, "interval", None))
+        every = 1 if interval is None else max(round(interval / collect_interval), 1)
+        entries[x.name] = dict(obj=x, errors={}, result=None, timing={},
+                               continuous=hasattr(x, "poll_stats"), every=every, due=True,
+                               blocking=not inspect.iscoroutinefunction(x.get_stats),
+                               limiter=limiter, busy=False, lock=threading.Lock(),
+                               overruns=0, timeouts=0, timeout_streak=0)
+    return entries
+
 async def handle_signals(exit_event):
     """Handle SIGINT / SIGTERM, setting the exit event"""
     with trio.open_signal_receiver(signal.SIGINT, signal.SIGTERM) as signal_handler:
@@ -625,32 +3594,139 @@ async def handle_signals(exit_event):
             return
 
 
-async def influx_write(client, database, metrics_receive_channel, cumulative_errors):
-    """Writes stats from the metrics_receive_channel to influx"""
-    async with metrics_receive_channel:
-        async for data in metrics_receive_channel:
-            LOGGER.debug("Beginning write to influx")
+async def influx_write(client, args, metrics_receive_channel, cumulative_errors, spool,
+                       internal_stats, database=None):
+    """Writes batches of stats from the metrics_receive_channel to influx, spooling failed writes
+
+    Writes to the database in args unless another database is given
+    """
+    if database is None:
+        database = args["database"]
+    batch_totals = dict(batches=0, cycles=0, points=0)
+    async with trio.open_nursery() as nursery:
+        if spool is not None:
+            nursery.start_soon(spool_replay, client, database, spool)
+        async with metrics_receive_channel:
+            while True:
+                payloads, points = await receive_batch(metrics_receive_channel, args)
+                if not payloads:
+                    break
+                data = b"".join(payloads)
+                batch_totals["batches"] += 1
+                batch_totals["cycles"] += len(payloads)
+                batch_totals["points"] += points
+                LOGGER.debug("Beginning write to influx ({0} cycles, {1} points, {2} bytes)"
+                             .format(len(payloads), points, len(data)))
+                write_start = time.perf_counter()
+                try:
+                    await client.write(database, data, args["precision"])
+                except Exception:
+                    cumulative_errors["influx"] += 1
+                    exc = sys.exc_info()
+                    LOGGER.error(format_error(exc, message="Caught influx exception",
+                                              message_before=True))
+                    if spool is not None and spool.append(data, args["precision"]):
+                        LOGGER.info("Failed write spooled to disk")
+                        await spool.sync()
+                else:
+                    cumulative_errors["influx"] = 0
+                if internal_stats is not None:
+                    internal_stats.write_latency = time.perf_counter() - write_start
+                    internal_stats.batch_points = points
+                    internal_stats.write_totals = getattr(client, "totals", None)
+        nursery.cancel_scope.cancel()
+    await client.aclose()
+    if spool is not None:
+        spool.close()
+    if batch_totals["batches"]:
+        LOGGER.info("Wrote {0} batches to {1}, averaging {2:.1f} cycles and {3:.0f} points per "
+                    "batch".format(batch_totals["batches"], database,
+                                   batch_totals["cycles"] / batch_totals["batches"],
+                                   batch_totals["points"] / batch_totals["batches"]))
+    if getattr(client, "totals", None):
+        LOGGER.info("Sent {packets} packets ({bytes} bytes), dropped {dropped}"
+                    .format(**client.totals))
+
+
+async def receive_batch(metrics_receive_channel, args):
+    """Receives payloads until the batch is full, the flush delay passes or the channel closes
+
+    Returns the payloads and their total point count, no payloads means the channel has closed
+    """
+    try:
+        payloads = [await metrics_receive_channel.receive()]
+    except trio.EndOfChannel:
+        return [], 0
+    points = payloads[0].count(b"\n")
+    with trio.move_on_after(args["batch_delay"]):
+        while len(payloads) < args["batch_cycles"] and points < args["batch_points"]:
             try:
-                await trio.to_thread.run_sync(
-                    functools.partial(client.write_points, data, database=database)
-                )
-            except Exception:
-                cumulative_errors["influx"] += 1
-                exc = sys.exc_info()
-                LOGGER.error(format_error(exc, message="Caught influx exception",
-                                          message_before=True))
-            else:
-                cumulative_errors["influx"] = 0
+                data = await metrics_receive_channel.receive()
+            except trio.EndOfChannel:
+                # flush what we have, the next receive will also hit the end of the channel
+                break
+            payloads.append(data)
+            points += data.count(b"\n")
+    return payloads, points
+
+
+async def spool_replay(client, database, spool):
+    """Replays spooled batches oldest first once influx accepts writes again"""
+    backoff = BaseStat.collect_interval
+    replaying = False
+    while True:
+        await spool.sync()
+        record = spool.read()
+        if record is None:
+            if replaying:
+                LOGGER.info("Spool replay complete")
+                replaying = False
+            await trio.sleep(BaseStat.collect_interval)
+            continue
+        try:
+            await client.write(database, *record)
+        except Exception:
+            exc = sys.exc_info()
+            LOGGER.debug(format_error(exc, message="Spool replay failed, retrying in {0}s"
+                                      .format(backoff), message_before=True))
+            await trio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        else:
+            if not replaying:
+                LOGGER.info("Replaying {0} bytes of spooled data".format(spool.size()))
+                replaying = True
+            spool.commit()
+            backoff = BaseStat.collect_interval
+            # let the live writes and stats collection run between records
+            await trio.sleep(0)
 
 #
 # metrics collection
 #
 
-async def stats_handler(args, exit_event, stats_objects, metrics_send_channel, cumulative_errors):
-    """Handles the collections of stats"""
+async def stats_handler(args, exit_event, stats_objects, metrics_send_channel, cumulative_errors,
+                        spool, internal_stats, raw_send_channel=None):
+    """Handles the collections of stats
+
+    With aggregation, the aggregated data is sent to metrics_send_channel at the end of each
+    window, and the raw data of each cycle to raw_send_channel (if raw data is forwarded)
+    """
     collect_interval = args["collect_interval"]
     error_limit = args["error_limit"]
-    target_time = math.ceil(time.time() + 1)
+    policy = None
+    if args["emission_policies"]:
+        policy = EmissionPolicy(args["emission_policies"],
+                                round(args["keyframe_interval"] * 10 ** 9)
+                                // LineSerializer.divisors[args["precision"]])
+    serializer = LineSerializer(args["precision"], args["wide_rows"], policy)
+    aggregator = raw_serializer = None
+    if args["aggregate_window"] is not None:
+        aggregator = Aggregator(round(args["aggregate_window"] * 10 ** 9),
+                                args["aggregate_functions"])
+        raw_serializer = LineSerializer(args["precision"], args["wide_rows"])
+    interval_ns = round(collect_interval * 10 ** 9)
+    target_ns = next_target_ns(interval_ns)
+    target_time = target_ns / 10 ** 9
     BaseStat.set_time(target_time)
     while True:
         try:
@@ -671,14 +3747,17 @@ async def stats_handler(args, exit_event, stats_objects, metrics_send_channel, c
                 if behind_secs > collect_interval * 5:
                     LOGGER.critical("Running behind by more than {0} seconds, skipping data entry"
                                     .format(collect_interval * 5))
-                    target_time = math.ceil(time.time() + 1)
+                    target_ns = next_target_ns(interval_ns)
+                    target_time = target_ns / 10 ** 9
                     BaseStat.set_time(target_time)
             await sleep_until(target_time - collect_interval)
+            if internal_stats is not None:
+                internal_stats.loop_lag = time.time() - (target_time - collect_interval)
             LOGGER.debug("Before stats collect, currently have {0:.3f}s until iter should finish"
                          .format(delta_current_time(target_time)))
-            current_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(target_time))
             with trio.move_on_after(collect_interval * 2) as cancel_scope:
-                await collect_stats(stats_objects, target_time)
+                await collect_stats(stats_objects, target_time, internal_stats,
+                                    target_ns // interval_ns)
             if cancel_scope.cancelled_caught:
                 LOGGER.error("Collect took >2 collect_intervals, cancelled remaining collects")
                 cumulative_errors["stats"] += 1
@@ -692,23 +3771,26 @@ async def stats_handler(args, exit_event, stats_objects, metrics_send_channel, c
                             error_info,
                             message="Error in stats collect for {0} ({1})".format(name, action),
                             message_before=True))
-            write_data = []
-            for name, stat_entry in stats_objects.items():
-                result = stat_entry["result"]
-                if result is not None:
-                    if isinstance(result, dict):
-                        format_dataset = format_measurements(result, current_time, name)
-                        if format_dataset is not None:
-                            write_data.append(format_dataset)
-                    elif isinstance(result, list):
-                        for dataset in result:
-                            format_dataset = format_measurements(dataset, current_time, name)
-                            if format_dataset is not None:
-                                write_data.append(format_dataset)
-            if not args["dry_run"]:
-                await metrics_send_channel.send(write_data)
+            results = [(name, stat_entry["result"]) for name, stat_entry in stats_objects.items()]
+            if aggregator is None:
+                write_data = serializer.serialize(results, serializer.timestamp(target_ns))
             else:
-                print(write_data)
+                write_data = await aggregate(aggregator, serializer, raw_serializer,
+                                             raw_send_channel, results, target_ns)
+            if internal_stats is not None:
+                internal_results = [("Internal", internal_stats.measurements(
+                    stats_objects, serializer,
+                    metrics_send_channel.statistics().current_buffer_used
+                ))]
+                if aggregator is None:
+                    write_data += serializer.serialize(internal_results,
+                                                       serializer.timestamp(target_ns))
+                else:
+                    write_data += await aggregate(aggregator, serializer, raw_serializer,
+                                                  raw_send_channel, internal_results, target_ns)
+            if write_data:
+                await send_write_data(args, metrics_send_channel, spool, write_data,
+                                      serializer.precision)
         except Exception:
             exc = sys.exc_info()
             LOGGER.error(format_error(exc, message="Caught exception", message_before=True))
@@ -716,59 +3798,188 @@ async def stats_handler(args, exit_event, stats_objects, metrics_send_channel, c
         finally:
             if start_error_count == cumulative_errors["stats"]:
                 cumulative_errors["stats"] = 0
-            target_time += collect_interval
+            target_ns += interval_ns
+            target_time = target_ns / 10 ** 9
             BaseStat.set_time(target_time)
+    if aggregator is not None:
+        # write the partial window rather than losing it
+        flushed = aggregator.flush()
+        if flushed is not None:
+            await send_write_data(args, metrics_send_channel, spool, serializer.serialize(
+                flushed[0], serializer.timestamp(flushed[1])), serializer.precision)
+        if raw_send_channel is not None:
+            await raw_send_channel.aclose()
     current_buffer_usage = metrics_send_channel.statistics().current_buffer_used
     while current_buffer_usage > 0:
         LOGGER.info("Waiting for influx writes, {0} in queue".format(current_buffer_usage))
         await trio.sleep(0.5)
         current_buffer_usage = metrics_send_channel.statistics().current_buffer_used
+    for name, stat_entry in stats_objects.items():
+        if stat_entry["overruns"] or stat_entry["timeouts"]:
+            LOGGER.info("{0} overran the target time {1} times and timed out {2} times"
+                        .format(name, stat_entry["overruns"], stat_entry["timeouts"]))
     # closing it causes influx_write to also exit
     await metrics_send_channel.aclose()
 
 
-async def collect_stats(stats_objects, target_time):
-    """Asynchronously fetches stats"""
+async def aggregate(aggregator, serializer, raw_serializer, raw_send_channel, results,
+                    target_ns):
+    """Adds results to the aggregator, forwarding them as raw data if enabled
+
+    Returns the serialized aggregates if a window has finished, otherwise b""
+    """
+    if raw_send_channel is not None:
+        raw_data = raw_serializer.serialize(results, raw_serializer.timestamp(target_ns))
+        try:
+            raw_send_channel.send_nowait(raw_data)
+        except trio.WouldBlock:
+            LOGGER.warning("Raw data write queue full, dropping raw data")
+    # counts are only for the aggregates written this cycle
+    serializer.counts.clear()
+    flushed = aggregator.add(results, target_ns)
+    if flushed is None:
+        return b""
+    return serializer.serialize(flushed[0], serializer.timestamp(flushed[1]))
+
+
+async def send_write_data(args, metrics_send_channel, spool, write_data, precision):
+    """Sends serialized data to influx_write (or prints it for a dry run)"""
+    if args["dry_run"]:
+        print(write_data.decode(), end="")
+    elif spool is None:
+        await metrics_send_channel.send(write_data)
+    else:
+        # spill to disk rather than holding up collection when influx is backed up
+        try:
+            metrics_send_channel.send_nowait(write_data)
+        except trio.WouldBlock:
+            LOGGER.warning("Influx write queue full, spooling data to disk")
+            spool.append(write_data, precision)
+
+
+async def collect_stats(stats_objects, target_time, internal_stats, cycle=0):
+    """Asynchronously fetches the stats which are due this cycle
+
+    cycle is the index of the collect cycle since the epoch, so stats with the same
+    interval are collected on the same cycles
+    """
     async with trio.open_nursery() as nursery:
         for name, stat_entry in stats_objects.items():
-            nursery.start_soon(execute_collect, name, stat_entry, target_time)
+            stat_entry["due"] = cycle % stat_entry["every"] == 0
+            if stat_entry["due"]:
+                nursery.start_soon(execute_collect, name, stat_entry, target_time,
+                                   internal_stats)
+            else:
+                stat_entry["errors"] = {}
+                stat_entry["result"] = None
+                stat_entry["timing"] = {}
 
 
-async def execute_collect(name, stat_entry, target_time):
+async def execute_collect(name, stat_entry, target_time, internal_stats):
     """Executes collection of stats for a given object"""
     stat_object = stat_entry["obj"]
     stat_entry["errors"] = {}
     stat_entry["result"] = None
-    start_time = getattr(stat_object, "time_needed", 0.2)
+    stat_entry["timing"] = {}
+    start_time = getattr(stat_object, "time_needed", BaseStat.default_time_needed())
     mode = "poll"
     if stat_entry["continuous"]:
+        if internal_stats is not None:
+            phase_start = internal_stats.phase_start()
         try:
             LOGGER.debug("Starting {0} for {1}".format(mode, name))
             await stat_object.poll_stats()
-        except (Exception, trio.MultiError):
+        except (Exception, BaseExceptionGroup) as error:
+            if contains_cancelled(error):
+                raise
             stat_entry["errors"][mode] = sys.exc_info()
+        if internal_stats is not None:
+            internal_stats.phase_end(stat_entry, mode, phase_start)
     mode = "push"
     await sleep_until(target_time - start_time)
-    try:
-        LOGGER.debug("Starting {0} for {1}".format(mode, name))
-        stat_entry["result"] = await stat_object.get_stats()
-    except (Exception, trio.MultiError):
-        stat_entry["errors"][mode] = sys.exc_info()
+    if internal_stats is not None:
+        phase_start = internal_stats.phase_start()
+    thread_cpu = []
+    timeout = getattr(stat_object, "timeout", None)
+    if timeout is None:
+        timeout = BaseStat.default_timeout(start_time)
+    skipped = stat_entry["blocking"] and stat_entry["busy"]
+    if skipped:
+        LOGGER.debug("{0} is still running from an earlier cycle, skipped".format(name))
+    with trio.move_on_after(timeout) as cancel_scope:
+        try:
+            LOGGER.debug("Starting {0} for {1}".format(mode, name))
+            if not stat_entry["blocking"]:
+                stat_entry["result"] = await stat_object.get_stats()
+            elif not skipped:
+                stat_entry["result"] = await run_blocking(stat_entry, thread_cpu)
+        except (Exception, BaseExceptionGroup) as error:
+            if contains_cancelled(error):
+                raise
+            stat_entry["errors"][mode] = sys.exc_info()
+    slack = delta_current_time(target_time)
+    if cancel_scope.cancelled_caught or skipped:
+        stat_entry["timeouts"] += 1
+        stat_entry["timeout_streak"] += 1
+        if stat_entry["timeout_streak"] == 1:
+            LOGGER.warning("{0} timed out, get_stats took longer than {1:.2f}s"
+                           .format(name, timeout))
+    else:
+        if stat_entry["timeout_streak"]:
+            LOGGER.info("{0} recovered after {1} timed out collections"
+                        .format(name, stat_entry["timeout_streak"]))
+            stat_entry["timeout_streak"] = 0
+        if slack < 0:
+            stat_entry["overruns"] += 1
+            LOGGER.debug("{0} overran the target time by {1:.3f}s".format(name, -slack))
+    if internal_stats is not None:
+        internal_stats.phase_end(stat_entry, "get", phase_start)
+        if thread_cpu:
+            stat_entry["timing"]["get_cpu"] = thread_cpu[0]
+        stat_entry["timing"]["time_needed"] = start_time
+        # time left before the target time, negative if the stat overran its budget
+        stat_entry["timing"]["slack"] = slack
 
 
-def format_measurements(dataset, current_time, name):
-    """Takes a measurement dict and formats it for influxdb"""
-    if "measurement" not in dataset:
-        LOGGER.error("No measurement found for {0}".format(name))
-        return None
-    measurement = dataset.pop("measurement")
-    if measurement is None:
-        return None
-    tags = dataset.pop("tags", {})
-    if not dataset:
-        return None
-    return dict(measurement=measurement, time=current_time,
-                fields=dataset, tags=tags)
+async def run_blocking(stat_entry, thread_cpu):
+    """Runs a blocking get_stats on the collector thread pool
+
+    If the collection times out the thread is abandoned, and the stat is skipped until it
+    finishes. The attributes of the stat are then restored to before the abandoned collection,
+    so the deltas of the next collection are from the last sample whose results were used
+    (stats keep their last sample in attributes get_stats rebinds, eg counters_persistent and
+    last_end_time). The CPU time used by the thread is appended to thread_cpu
+    """
+    stat_object = stat_entry["obj"]
+    saved = dict(vars(stat_object))
+    state = dict(started=False, abandoned=False)
+    def run_thread():
+        with stat_entry["lock"]:
+            state["started"] = True
+        start = time.thread_time()
+        try:
+            return stat_object.get_stats()
+        finally:
+            thread_cpu.append(time.thread_time() - start)
+            with stat_entry["lock"]:
+                if state["abandoned"]:
+                    vars(stat_object).update(saved)
+                stat_entry["busy"] = False
+    stat_entry["busy"] = True
+    try:
+        return await trio.to_thread.run_sync(run_thread, limiter=stat_entry["limiter"],
+                                             cancellable=True)
+    except trio.Cancelled:
+        with stat_entry["lock"]:
+            if state["started"] and stat_entry["busy"]:
+                state["abandoned"] = True
+            else:
+                # the thread never started (waiting for the limiter), or finished as the
+                # collection timed out, either way its results are dropped
+                vars(stat_object).update(saved)
+                stat_entry["busy"] = False
+        raise
+
 
 #
 # config handling
@@ -793,9 +4004,35 @@ def initial_argparse():
                       help="Port for influxdb. Default is 8086")],
         ["database", dict(cmd_name="database", default="system_stats", type=str,
                           help="Database name for influxdb. Default is system_stats")],
-        ["collect_interval", dict(cmd_name="collect-interval", default=1, type=int,
+        ["transport", dict(cmd_name="transport", default="http", type=str,
+                           help="Transport for writes to influx, http or udp. With udp, "
+                           "writes are fire and forget to the influx UDP listener on host and "
+                           "port, which must be configured with the database and precision. "
+                           "Writes never block, but points can be lost and gzip is not used. "
+                           "Default is http")],
+        ["udp_mtu", dict(cmd_name="udp-mtu", default=1500, type=int,
+                         help="MTU of the path to influx with the udp transport, points are "
+                         "packed into datagrams which fit it. Default is 1500")],
+        ["relay", dict(cmd_name="relay", default=None, type=[None, str],
+                       help="Sends the stats to a relay (another instance with relay-listen "
+                       "set) as host:port, instead of writing them to influx. The influx "
+                       "options are then only used by the relay. Default is disabled")],
+        ["relay_protocol", dict(cmd_name="relay-protocol", default="tcp", type=str,
+                                help="Protocol for sending to the relay, tcp or udp. Writes "
+                                "over tcp are acknowledged by the relay so failed writes can be "
+                                "spooled, udp writes are fire and forget. Default is tcp")],
+        ["relay_listen", dict(cmd_name="relay-listen", default=None, type=[None, str],
+                              help="Runs as a relay, receiving stats from agents on the "
+                              "specified [host:]port (tcp and udp) and writing them to influx "
+                              "along with the local stats, batched and spooled. Default is "
+                              "disabled")],
+        ["collect_interval", dict(cmd_name="collect-interval", default=1.0, type=float,
                                   help="Sets how often the stats are collected and saved, "
-                                  "in seconds. Default is 1, must be a non zero integer")],
+                                  "in seconds. Can be fractional (eg 0.25) for sub-second "
+                                  "collection. Default is 1, must be non zero")],
+        ["precision", dict(cmd_name="precision", default=None, type=[None, str],
+                           help="Timestamp precision written to influx, one of s, ms, u or n. "
+                           "Default is s for whole second collect intervals, otherwise ms")],
         ["include_disks", dict(cmd_name="include-disks", default=[], nargs="*", type=str,
                                help="Disks to include for disk IO monitoring. The disks specified "
                                "can be regular expressions, but they don't need to be as you can "
@@ -828,6 +4065,145 @@ def initial_argparse():
                                      "exclude the specified mountpoints from monitoring. It "
                                      "cannot be used at the same time as include-mountpoints. "
                                      "Default is exclude no mountpoints (ie include all).")],
+        ["include_nics", dict(cmd_name="include-nics", default=[], nargs="*", type=str,
+                              help="Nics to include for network IO monitoring, as regular "
+                              "expressions (eg eth\\d+). Passing this option will cause only "
+                              "the specified nics to be monitored. It cannot be used at the "
+                              "same time as exclude-nics. Default is in exclude-nics")],
+        ["exclude_nics", dict(cmd_name="exclude-nics", default=[], nargs="*", type=str,
+                              help="Nics to exclude from network IO monitoring, as regular "
+                              "expressions (eg veth.* cali.*). It cannot be used at the same "
+                              "time as include-nics. Default is exclude no nics (ie include "
+                              "all)")],
+        ["virtual_nics_total", dict(cmd_name="virtual-nics-total", default=False, type=bool,
+                                    action="store_true",
+                                    help="Also records the total network IO of all virtual "
+                                    "nics (eg veth, bridge and tunnel nics, other than lo) "
+                                    "as the nic virtual_total, including nics which are "
+                                    "excluded. With exclude-nics this replaces the series of "
+                                    "each short lived container nic with one series")],
+        ["top_processes", dict(cmd_name="top-processes", default=0, type=int,
+                               help="Records the top N processes by CPU usage, RSS and IO in "
+                               "the process measurement, tagged by the metric and rank (eg "
+                               "top=cpu,rank=1) so the number of series stays bounded. "
+                               "Default is 0 (disabled)")],
+        ["cgroups", dict(cmd_name="cgroups", default=False, type=bool, action="store_true",
+                         help="Records CPU, memory, IO and pressure stats for each cgroup (eg "
+                         "container or systemd unit) in the cgroup v2 tree, in the cgroup "
+                         "measurement. Requires cgroup v2")],
+        ["include_cgroups", dict(cmd_name="include-cgroups", default=[], nargs="*", type=str,
+                                 help="Cgroups to record, as regular expressions matching "
+                                 "their path in the cgroup tree (eg "
+                                 "system.slice/docker-.*\\.scope). Passing this option will "
+                                 "cause only the specified cgroups to be recorded. It cannot be "
+                                 "used at the same time as exclude-cgroups. Default is in "
+                                 "exclude-cgroups")],
+        ["exclude_cgroups", dict(cmd_name="exclude-cgroups", default=[], nargs="*", type=str,
+                                 help="Cgroups to exclude, as regular expressions matching "
+                                 "their path in the cgroup tree. It cannot be used at the same "
+                                 "time as include-cgroups. Default is exclude no cgroups")],
+        ["cgroup_max_depth", dict(cmd_name="cgroup-max-depth", default=2, type=int,
+                                  help="Maximum depth in the cgroup tree to record cgroups "
+                                  "from, eg 2 records system.slice and system.slice/ssh.service. "
+                                  "Default is 2")],
+        ["cgroup_max", dict(cmd_name="cgroup-max", default=256, type=int,
+                            help="Maximum number of cgroups to record, further cgroups are "
+                            "skipped to bound the number of series. Default is 256")],
+        ["socket_max", dict(cmd_name="socket-max", default=100000, type=int,
+                            help="Maximum number of TCP sockets to count by state each "
+                            "collection. Past this the counts are scaled to the totals in "
+                            "/proc/net/sockstat (the fraction counted is written as sampled), "
+                            "which bounds the cost on hosts with very many connections. "
+                            "0 disables the socket state counts. Default is 100000")],
+        ["stat_intervals", dict(cmd_name="stat-intervals", default=[], nargs="*", type=str,
+                                help="Collects the specified stats less often than every "
+                                "collect interval, as name=seconds (eg Disk=60 GPU=10). "
+                                "The names are the stat/plugin names shown in the logs. "
+                                "Intervals are rounded to a multiple of the collect interval. "
+                                "Overrides the interval attribute of plugins")],
+        ["collector_threads", dict(cmd_name="collector-threads", default=4, type=int,
+                                   help="Number of worker threads for stats which block (eg "
+                                   "NVML, psutil and plugins with a non async get_stats), "
+                                   "so they don't hold up the other stats. Default is 4")],
+        ["isolated_plugins", dict(cmd_name="isolated-plugins", default=[], nargs="*", type=str,
+                                  help="Plugins (file names without .py) to run in worker "
+                                  "processes instead of the main process. Useful for plugins "
+                                  "which use a lot of CPU or could crash. The classes are "
+                                  "spread over a pool of isolated-workers workers, which are "
+                                  "restarted if they exit or hang")],
+        ["isolated_workers", dict(cmd_name="isolated-workers", default=2, type=int,
+                                  help="Number of worker processes in the pool which runs the "
+                                  "isolated plugins. Classes sharing a worker are run one at a "
+                                  "time, and are restarted together if one crashes or hangs. "
+                                  "Default is 2")],
+        ["wide_rows", dict(cmd_name="wide-rows", default=False, type=bool, action="store_true",
+                           help="Writes per CPU, per disk and per nic stats as a single row for "
+                           "each measurement, with the cpu/device appended to the field names "
+                           "(eg util_17) instead of as a tag. Reduces the number of series and "
+                           "the size of writes on large hosts. The grafana dashboard must be "
+                           "configured for wide rows by the installer")],
+        ["emission_policies", dict(cmd_name="emission-policies", default=[], nargs="*",
+                                   type=str, help="Fields to write only when they change, as "
+                                   "measurement.field=rule (eg memory.total=change). The "
+                                   "field can be * for all fields of the measurement. The rule "
+                                   "is change, keyframe (only written on keyframes), a number "
+                                   "(absolute deadband, eg nvidia.power_draw=5) or a percentage "
+                                   "(relative deadband, eg memory.used=1%%). Reduces write "
+                                   "volume and storage for slowly changing fields")],
+        ["keyframe_interval", dict(cmd_name="keyframe-interval", default=60.0, type=float,
+                                   help="Maximum time in seconds between writes of fields with "
+                                   "an emission policy, so the latest value is always recent "
+                                   "enough for dashboards. Default is 60")],
+        ["aggregate_window", dict(cmd_name="aggregate-window", default=None,
+                                  type=[None, float],
+                                  help="Aggregates the stats over windows of this many seconds "
+                                  "before writing them (eg 10 or 60), so stats can be collected "
+                                  "often without storing every sample. Must be a multiple of the "
+                                  "collect interval. The mean is written under the original "
+                                  "field name, the other functions as field_function (eg "
+                                  "util_max). Default is disabled")],
+        ["aggregate_functions", dict(cmd_name="aggregate-functions",
+                                     default=["mean", "min", "max", "last", "p95"], nargs="*",
+                                     type=str, help="Functions to aggregate numeric fields "
+                                     "with, from mean, min, max, last and percentiles as pNN "
+                                     "(eg p99). Default is mean min max last p95")],
+        ["raw_database", dict(cmd_name="raw-database", default=None, type=[None, str],
+                              help="With aggregation, also writes the unaggregated stats to "
+                              "this database (eg one with a short retention policy). Raw data "
+                              "is not spooled. Default is disabled")],
+        ["gzip", dict(cmd_name="gzip", default=False, type=bool, action="store_true",
+                      help="Gzip compresses writes to influx. Reduces network usage at the "
+                      "cost of some CPU time")],
+        ["write_timeout", dict(cmd_name="write-timeout", default=10, type=int,
+                               help="Timeout in seconds for each write to influx, including "
+                               "connecting. Default is 10")],
+        ["batch_cycles", dict(cmd_name="batch-cycles", default=1, type=int,
+                              help="Maximum number of collect cycles to combine into a single "
+                              "influx write. Default is 1 (write every cycle)")],
+        ["batch_points", dict(cmd_name="batch-points", default=5000, type=int,
+                              help="Writes a batch once it contains at least this many points, "
+                              "even if batch-cycles has not been reached. Default is 5000")],
+        ["batch_delay", dict(cmd_name="batch-delay", default=10.0, type=float,
+                             help="Maximum time in seconds to hold a batch before writing it, "
+                             "can be less than a second (eg 0.5). Default is 10")],
+        ["spool_dir", dict(cmd_name="spool-dir", default=None, type=[None, str],
+                           help="Enables spooling writes which failed (eg influx is down) to "
+                           "disk in the specified directory. Spooled data is replayed in time "
+                           "order once influx accepts writes again, including after a restart. "
+                           "By default spooling is disabled and failed writes are dropped.")],
+        ["spool_max_size", dict(cmd_name="spool-max-size", default=256, type=int,
+                                help="Maximum size of the spool in MiB. The oldest data is "
+                                "dropped when it is exceeded. Default is 256")],
+        ["spool_compress", dict(cmd_name="spool-compress", default=False, type=bool,
+                                action="store_true", help="Compresses spooled data with zlib")],
+        ["spool_fsync_interval", dict(cmd_name="spool-fsync-interval", default=5, type=int,
+                                      help="Maximum time in seconds between fsyncs of the "
+                                      "spool, fsyncs are batched to this interval. Default is 5")],
+        ["internal_metrics", dict(cmd_name="internal-metrics", default=False, type=bool,
+                                  action="store_true",
+                                  help="Records the agent's own overhead (timing of each stat "
+                                  "class, points, bytes, write latency, loop lag) in the "
+                                  "smi_internal measurement")],
         ["error_limit", dict(cmd_name="max-consecutive-errors", default=0, type=int,
                              help="Sets the max limit for consecutive errors, which the the  "
                              "program will exit at if reached. An error can occur once per save "
@@ -896,6 +4272,20 @@ def initial_argparse():
         args["mountpoint_filters"] = [args["include_mountpoints"], "include"]
     else:
         args["mountpoint_filters"] = [args["exclude_mountpoints"], "exclude"]
+    if args["include_nics"] and args["exclude_nics"]:
+        critical_exit((TypeError, None, None),
+                      message="Nic includes and excludes cannot be specified together")
+    if args["include_nics"]:
+        args["nic_filters"] = [args["include_nics"], "include"]
+    else:
+        args["nic_filters"] = [args["exclude_nics"], "exclude"]
+    if args["include_cgroups"] and args["exclude_cgroups"]:
+        critical_exit((TypeError, None, None),
+                      message="Cgroup includes and excludes cannot be specified together")
+    if args["include_cgroups"]:
+        args["cgroup_filters"] = [args["include_cgroups"], "include"]
+    else:
+        args["cgroup_filters"] = [args["exclude_cgroups"], "exclude"]
     if args["quiet"]:
         logging.disable(logging.CRITICAL)
     if args["log_stdout"]:
@@ -906,7 +4296,94 @@ def initial_argparse():
         ROOT_LOGGER.addHandler(create_sublogger(logging.DEBUG, args["logfile_path"]))
     if args["collect_interval"] <= 0:
         critical_exit((TypeError, None, None),
-                      message="Collect interval must be a non zero positive integer")
+                      message="Collect interval must be a non zero positive number")
+    stat_intervals = {}
+    for item in args["stat_intervals"]:
+        name, _, interval = item.partition("=")
+        try:
+            stat_intervals[name] = float(interval)
+        except ValueError:
+            critical_exit((TypeError, None, None),
+                          message="Stat intervals must be specified as name=seconds")
+        if stat_intervals[name] <= 0:
+            critical_exit((TypeError, None, None),
+                          message="Stat intervals must be non zero positive numbers")
+    args["stat_intervals"] = stat_intervals
+    try:
+        args["emission_policies"] = EmissionPolicy.parse_rules(args["emission_policies"])
+    except ValueError:
+        critical_exit((TypeError, None, None),
+                      message="Emission policies must be specified as measurement.field=rule, "
+                      "with a rule of change, keyframe, a number or a percentage")
+    if args["aggregate_window"] is not None:
+        window_ns = round(args["aggregate_window"] * 10 ** 9)
+        if window_ns <= 0 or window_ns % round(args["collect_interval"] * 10 ** 9):
+            critical_exit((TypeError, None, None),
+                          message="Aggregate window must be a multiple of the collect interval")
+        if not args["aggregate_functions"]:
+            critical_exit((TypeError, None, None),
+                          message="At least one aggregate function must be specified")
+        for function in args["aggregate_functions"]:
+            if not Aggregator.valid_function(function):
+                critical_exit((TypeError, None, None),
+                              message="Invalid aggregate function {0}".format(function))
+    if args["keyframe_interval"] <= 0:
+        critical_exit((TypeError, None, None),
+                      message="Keyframe interval must be a non zero positive number")
+    if args["precision"] is None:
+        args["precision"] = "s" if args["collect_interval"] % 1 == 0 else "ms"
+    if args["precision"] not in LineSerializer.divisors:
+        critical_exit((TypeError, None, None),
+                      message="Precision must be one of {0}"
+                      .format(", ".join(LineSerializer.divisors.keys())))
+    if round(args["collect_interval"] * 10 ** 9) % LineSerializer.divisors[args["precision"]]:
+        critical_exit((TypeError, None, None),
+                      message="Precision {0} is too coarse for the collect interval"
+                      .format(args["precision"]))
+    if args["batch_delay"] <= 0:
+        critical_exit((TypeError, None, None),
+                      message="Batch delay must be a non zero positive number")
+    for key in ("write_timeout", "batch_cycles", "batch_points", "collector_threads",
+                "isolated_workers", "cgroup_max_depth", "cgroup_max"):
+        if args[key] <= 0:
+            critical_exit((TypeError, None, None),
+                          message="{0} must be a non zero positive integer"
+                          .format(cmd_args[key]["cmd_name"].capitalize()))
+    if args["transport"] not in ("http", "udp"):
+        critical_exit((TypeError, None, None), message="Transport must be http or udp")
+    if args["transport"] == "udp":
+        if args["raw_database"] is not None:
+            critical_exit((TypeError, None, None),
+                          message="Raw database cannot be used with the udp transport")
+        if args["udp_mtu"] < 576:
+            critical_exit((TypeError, None, None), message="UDP MTU must be at least 576")
+    if args["relay"] is not None and args["raw_database"] is not None:
+        critical_exit((TypeError, None, None),
+                      message="Raw database cannot be used when sending to a relay")
+    if args["relay_protocol"] not in ("tcp", "udp"):
+        critical_exit((TypeError, None, None), message="Relay protocol must be tcp or udp")
+    for key in ("relay", "relay_listen"):
+        if args[key] is None:
+            continue
+        host, _, port = args[key].rpartition(":")
+        if key == "relay" and not host:
+            critical_exit((TypeError, None, None), message="Relay must be specified as host:port")
+        try:
+            args[key] = (host.strip("[]"), int(port))
+        except ValueError:
+            critical_exit((TypeError, None, None),
+                          message="Invalid port for {0}".format(cmd_args[key]["cmd_name"]))
+    if args["spool_dir"] is not None:
+        args["spool_dir"] = os.path.expanduser(args["spool_dir"])
+    if args["top_processes"] < 0:
+        critical_exit((TypeError, None, None),
+                      message="Top processes must be a positive integer or 0")
+    if args["socket_max"] < 0:
+        critical_exit((TypeError, None, None),
+                      message="Socket max must be a positive integer or 0")
+    if args["spool_max_size"] <= 0:
+        critical_exit((TypeError, None, None),
+                      message="Spool max size must be a non zero positive integer")
     if args["pidfile"] is not None:
         args["pidfile"] = os.path.expanduser(args["pidfile"])
         open(args["pidfile"], "w").write(str(os.getpid()))
@@ -935,6 +4412,9 @@ def parse_config_file(args, cmd_args, specifed):
     args_new = args_new_formatted
     for key, value in args_new.items():
         allowed_type = cmd_args[key]["type"]
+        value_type = allowed_type[1] if isinstance(allowed_type, list) else allowed_type
+        if value_type is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
         error = ""
         if isinstance(allowed_type, list):
             if (value is not None) and (not isinstance(value, allowed_type[1])):
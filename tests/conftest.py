@@ -0,0 +1,11 @@
+"""Shared setup for the tests, run with python -m pytest from the repository root"""
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import system_metrics_influx as smi  # pylint: disable=wrong-import-position
+
+# LOGGER is normally set up when the agent is run as a script
+smi.LOGGER = logging.getLogger("system_metrics_influx")
@@ -0,0 +1,66 @@
+"""Tests for the quantile estimator and the aggregation windows"""
+import random
+
+from common_lib import Point
+import system_metrics_influx as smi
+
+
+def test_quantile_exact_for_small_samples():
+    estimator = smi.QuantileEstimator(0.95)
+    assert estimator.value() is None
+    for value in range(1, 21):
+        estimator.add(value)
+    assert estimator.value() == 19
+
+
+def test_quantile_estimate():
+    generator = random.Random(1)
+    values = [generator.uniform(0, 1000) for _ in range(20000)]
+    for quantile in (0.5, 0.95, 0.99):
+        estimator = smi.QuantileEstimator(quantile)
+        for value in values:
+            estimator.add(value)
+        exact = sorted(values)[int(quantile * len(values))]
+        assert abs(estimator.value() - exact) < 10
+
+
+def test_quantile_skewed_estimate():
+    generator = random.Random(2)
+    values = [generator.expovariate(1) for _ in range(20000)]
+    estimator = smi.QuantileEstimator(0.95)
+    for value in values:
+        estimator.add(value)
+    exact = sorted(values)[int(0.95 * len(values))]
+    assert abs(estimator.value() - exact) / exact < 0.05
+
+
+def test_field_aggregate():
+    aggregate = smi.FieldAggregate(4, [0.5])
+    for value in (2, 9, 1):
+        aggregate.add(value)
+    assert aggregate.results("a", ("mean", "min", "max", "last", "p50")) == {
+        "a": 4, "a_min": 1, "a_max": 9, "a_last": 1, "a_p50": 2}
+    aggregate.add(1.5)
+    assert aggregate.results("a", ("mean",)) == {"a": 3.5}
+
+
+def test_aggregator_windows():
+    aggregator = smi.Aggregator(10, ("mean", "max"))
+    point = Point("m", ("a",), {"t": "x"})
+    point.values[0] = 1
+    assert aggregator.add([("Test", [point]), ("None", None)], 21) is None
+    point.values[0] = 3
+    assert aggregator.add([("Test", [point]),
+                           ("Other", {"measurement": "n", "s": "str"})], 29) is None
+    results, start = aggregator.add([("Test", {"measurement": "m", "a": 5})], 30)
+    assert start == 20
+    assert results == [("Test", [{"measurement": "m", "a": 2, "a_max": 3, "tags": {"t": "x"}}]),
+                       ("Other", [{"measurement": "n", "s": "str"}])]
+    assert aggregator.flush() == ([("Test", [{"measurement": "m", "a": 5, "a_max": 5}])], 30)
+    assert aggregator.flush() is None
+
+
+def test_valid_function():
+    assert smi.Aggregator.valid_function("p99.9")
+    assert not smi.Aggregator.valid_function("p100")
+    assert not smi.Aggregator.valid_function("median")
@@ -0,0 +1,130 @@
+"""Tests for CgroupStats and DirectoryWatcher against a fake cgroup v2 tree"""
+import os
+import shutil
+
+import pytest
+import trio
+
+import benchmark
+import system_metrics_influx as smi
+
+# the collection time of the cgroups
+CLOCK = [100.0]
+UNITS = ["system.slice/unit1.service", "system.slice/unit2.service", "system.slice/unit3.service"]
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """A fake cgroup tree with system.slice and 3 units, returns its directory"""
+    benchmark.build_fake_cgroups(str(tmp_path), len(UNITS))
+    monkeypatch.setattr(smi.ProcFile, "root", str(tmp_path))
+    monkeypatch.setattr(smi.CgroupStats, "current_time", staticmethod(lambda: CLOCK[0]))
+    return str(tmp_path / "sys" / "fs" / "cgroup")
+
+
+def create_stat(filters=(), filter_mode="exclude", max_cgroups=256):
+    stat = smi.CgroupStats(list(filters), filter_mode, 2, max_cgroups)
+    trio.run(stat.async_init)
+    return stat
+
+
+def add_unit(tree, path, usage_usec=0):
+    """Creates a cgroup with only cpu.stat and memory.current"""
+    os.makedirs(os.path.join(tree, path))
+    write_usage(tree, path, usage_usec)
+    with open(os.path.join(tree, path, "memory.current"), "w") as out_file:
+        out_file.write("4096\n")
+
+
+def write_usage(tree, path, usage_usec):
+    with open(os.path.join(tree, path, "cpu.stat"), "w") as out_file:
+        out_file.write("usage_usec {0}\nuser_usec 0\nsystem_usec 0\nthrottled_usec 0\n"
+                       .format(usage_usec))
+
+
+def recorded(stat):
+    """Returns the cgroups recorded by a collection 1s after the last"""
+    CLOCK[0] += 1
+    return sorted(point.tags["cgroup"] for point in stat.get_stats())
+
+
+def test_scan(tree):
+    stat = create_stat()
+    assert sorted(stat.cgroups) == ["system.slice"] + UNITS
+    assert recorded(stat) == ["system.slice"] + UNITS
+
+
+def test_rates(tree):
+    stat = create_stat()
+    path = UNITS[0]
+    write_usage(tree, path, 7713062 + 500000)
+    CLOCK[0] += 1
+    point = next(point for point in stat.get_stats() if point.tags["cgroup"] == path)
+    values = dict(zip(point.keys, point.values))
+    # 0.5s of CPU time over 1s
+    assert values["cpu"] == 50.0
+    assert values["memory"] == 1048576
+    assert values["read_bytes"] == 0
+
+
+def test_watcher_adds_and_removes(tree):
+    stat = create_stat()
+    if stat.watcher is None:
+        pytest.skip("inotify is unavailable")
+    add_unit(tree, "system.slice/new.service")
+    # a new cgroup is recorded from the collection after it is found
+    assert "system.slice/new.service" not in recorded(stat)
+    assert "system.slice/new.service" in recorded(stat)
+    shutil.rmtree(os.path.join(tree, UNITS[0]))
+    assert UNITS[0] not in recorded(stat)
+    assert UNITS[0] not in stat.cgroups
+
+
+def test_rescan_fallback(tree, monkeypatch):
+    monkeypatch.setattr(smi.DirectoryWatcher, "open", classmethod(lambda cls: None))
+    monkeypatch.setattr(smi.CgroupStats, "rescan_interval", 0)
+    stat = create_stat()
+    assert stat.watcher is None
+    add_unit(tree, "system.slice/new.service")
+    shutil.rmtree(os.path.join(tree, UNITS[0]))
+    recorded(stat)
+    cgroups = recorded(stat)
+    assert "system.slice/new.service" in cgroups and UNITS[0] not in cgroups
+
+
+def test_limit(tree):
+    stat = create_stat(max_cgroups=2)
+    assert len(stat.cgroups) == 2 and len(stat.skipped) == 2
+    # removing a recorded cgroup records a skipped one in its place
+    removed = sorted(stat.cgroups)[-1]
+    stat.remove(removed)
+    assert len(stat.cgroups) == 2 and len(stat.skipped) == 1
+    assert removed not in stat.cgroups
+
+
+def test_filters(tree):
+    stat = create_stat([r"system\.slice/unit[12]\.service"])
+    assert sorted(stat.cgroups) == ["system.slice", UNITS[2]]
+    stat = create_stat([r"system\.slice/.*"], "include")
+    assert sorted(stat.cgroups) == UNITS
+
+
+def test_directory_watcher(tmp_path):
+    watcher = smi.DirectoryWatcher.open()
+    if watcher is None:
+        pytest.skip("inotify is unavailable")
+    try:
+        os.makedirs(tmp_path / "a")
+        watcher.add(str(tmp_path), "")
+        watcher.add(str(tmp_path / "a"), "a")
+        os.makedirs(tmp_path / "a" / "b")
+        (tmp_path / "file").write_text("")
+        os.rmdir(tmp_path / "a" / "b")
+        assert watcher.read() == [("a", "b", True), ("a", "b", False)]
+        os.rmdir(tmp_path / "a")
+        # the watch of the removed directory is dropped
+        assert watcher.read() == [("", "a", False)]
+        assert list(watcher.watches.values()) == [""]
+        assert watcher.read() == []
+    finally:
+        watcher.close()
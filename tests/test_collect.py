@@ -0,0 +1,99 @@
+"""Tests for execute_collect, running stats with timeouts"""
+import os
+import threading
+import time
+
+import trio
+
+from common_lib import BaseStat
+import system_metrics_influx as smi
+
+
+class SlowStat(BaseStat):
+    """A stat which takes longer than its timeout"""
+    name = "Slow"
+    timeout = 0.05
+
+    async def get_stats(self):
+        await trio.sleep(1)
+        return {"measurement": "slow", "value": 1}
+
+
+def collect(stat_object):
+    """Runs one collection of a stat, returning its stat entry"""
+    entry = smi.create_stat_entries([stat_object])[stat_object.name]
+    trio.run(smi.execute_collect, stat_object.name, entry, smi.BaseStat.current_time(), None)
+    return entry
+
+
+def test_timeout_is_not_an_error():
+    BaseStat.collect_interval = 1
+    entry = collect(SlowStat())
+    assert entry["result"] is None
+    assert entry["errors"] == {}
+    assert entry["timeouts"] == 1
+
+
+def test_hung_mount_quarantined(monkeypatch):
+    BaseStat.collect_interval = 1
+    release = threading.Event()
+    statvfs = os.statvfs
+
+    def hanging_statvfs(path):
+        if path == "/hung":
+            release.wait(10)
+        return statvfs("/")
+
+    monkeypatch.setattr(smi.os, "statvfs", hanging_statvfs)
+    stat = smi.DiskStorageStats([], "exclude")
+    stat.read_mountpoints = lambda: ["/ok", "/hung", "/ok2"]
+    try:
+        entry = collect(stat)
+    finally:
+        release.set()
+    assert entry["errors"] == {}
+    assert [point["tags"]["disk"] for point in entry["result"]] == ["/ok", "/ok2"]
+    assert list(stat.quarantined) == ["/hung"]
+
+
+class CounterStat(BaseStat):
+    """A blocking stat writing the rate of a counter, which can be made to hang"""
+    name = "Counter"
+    timeout = 0.1
+
+    def __init__(self):
+        self.counter = 0
+        self.hang = None
+        self.counter_persistent = 0
+
+    def get_stats(self):
+        counter = self.counter
+        if self.hang is not None:
+            self.hang.wait(10)
+        delta = counter - self.counter_persistent
+        self.counter_persistent = counter
+        return {"measurement": "counter", "delta": delta}
+
+
+def test_abandoned_collection_state_discarded():
+    BaseStat.collect_interval = 1
+    stat = CounterStat()
+    entry = smi.create_stat_entries([stat])[stat.name]
+
+    def run(counter):
+        stat.counter = counter
+        trio.run(smi.execute_collect, stat.name, entry, smi.BaseStat.current_time(), None)
+        return entry["result"]
+
+    assert run(10) == {"measurement": "counter", "delta": 10}
+    stat.hang = threading.Event()
+    assert run(15) is None
+    assert entry["busy"]
+    # the abandoned collection finishes after its results were dropped
+    stat.hang.set()
+    for _ in range(100):
+        if not entry["busy"]:
+            break
+        time.sleep(0.01)
+    stat.hang = None
+    assert run(20) == {"measurement": "counter", "delta": 10}
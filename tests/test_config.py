@@ -0,0 +1,41 @@
+"""Tests for parsing the command line and config file options"""
+import logging
+import os
+import sys
+
+import system_metrics_influx as smi
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "data", "example_config.yaml")
+
+
+def parse_config(tmp_path, monkeypatch, replacements):
+    """Returns the args parsed from the example config with (old, new) lines replaced"""
+    with open(EXAMPLE_CONFIG) as in_file:
+        config = in_file.read()
+    for old, new in replacements:
+        assert old in config
+        config = config.replace(old, new)
+    path = tmp_path / "config.yaml"
+    path.write_text(config)
+    monkeypatch.setattr(smi, "ROOT_LOGGER", logging.getLogger("smi_test_root"), raising=False)
+    monkeypatch.setattr(sys, "argv", ["system_metrics_influx.py", "--config-file", str(path)])
+    return smi.initial_argparse()
+
+
+def test_example_config(tmp_path, monkeypatch):
+    args = parse_config(tmp_path, monkeypatch, [])
+    assert args["aggregate_window"] is None
+
+
+def test_int_for_float_option(tmp_path, monkeypatch):
+    # the example values of optional float options are ints in yaml
+    args = parse_config(tmp_path, monkeypatch,
+                        [("aggregate-window: null", "aggregate-window: 10")])
+    assert args["aggregate_window"] == 10.0
+    assert isinstance(args["aggregate_window"], float)
+
+
+def test_sub_second_batch_delay(tmp_path, monkeypatch):
+    args = parse_config(tmp_path, monkeypatch, [("batch-delay: 10", "batch-delay: 0.25")])
+    assert args["batch_delay"] == 0.25
@@ -0,0 +1,47 @@
+"""Tests for the per cpu /proc/stat parsing of CPUStats, with and without numpy"""
+import os
+
+import pytest
+
+import system_metrics_influx as smi
+
+CPU_IDS = (0, 1, 2, 3, 5, 8, 9, 12, 13, 17, 20, 21, 24, 30, 31, 32, 40, 63)
+
+
+def write_proc_stat(root, cycle):
+    """Writes a /proc/stat with times which advance differently for each cpu with cycle"""
+    lines = ["cpu  {0} 150 1120 {1} 520 0 17 0 0 0".format(4705 + cycle * 90, 16250 + cycle)]
+    for cpu_id in CPU_IDS:
+        busy = cycle * (cpu_id % 7 + 1)
+        lines.append("cpu{0} {1} 15 {2} {3} {4} 3 1 0 {5} 0".format(
+            cpu_id, 400 + busy, 100 + cycle, 1600 + cycle * (cpu_id % 3 + 1), 50 + cycle % 2,
+            cycle))
+    lines += ["intr 114930548 113199788 3 0", "ctxt 1990473", "btime 1062191376"]
+    with open(os.path.join(root, "proc", "stat"), "w") as out_file:
+        out_file.write("\n".join(lines) + "\n")
+
+
+def read_cycles(root, monkeypatch, numpy_module):
+    """Returns the cpu ids, and the per cpu utilisation over two cycles"""
+    monkeypatch.setattr(smi, "numpy", numpy_module)
+    monkeypatch.setattr(smi, "load_numpy", lambda: numpy_module is not None)
+    write_proc_stat(root, 0)
+    stat = smi.CPUStats()
+    results = [stat.cpu_ids]
+    for cycle in (1, 2):
+        write_proc_stat(root, cycle)
+        results.append(stat.read_times())
+    return results
+
+
+def test_numpy_and_array_paths_match(tmp_path, monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    os.makedirs(tmp_path / "proc")
+    monkeypatch.setattr(smi.ProcFile, "root", str(tmp_path))
+    with_array = read_cycles(str(tmp_path), monkeypatch, None)
+    with_numpy = read_cycles(str(tmp_path), monkeypatch, numpy)
+    assert with_array[0] == list(CPU_IDS)
+    assert with_numpy == with_array
+    utilisation = with_array[2][1]
+    assert len(utilisation) == len(CPU_IDS) and len(set(utilisation)) > 1
+    assert all(0 <= value <= 100 for value in utilisation)
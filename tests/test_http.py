@@ -0,0 +1,89 @@
+"""Tests for the HTTP framing of HTTPConnection and the InfluxHTTPClient connection pool"""
+import functools
+
+import trio
+import trio.testing
+
+import system_metrics_influx as smi
+
+REQUEST = b"POST /write HTTP/1.1\r\nContent-Length: 1\r\n\r\n"
+
+
+async def respond(response, head=REQUEST):
+    """Returns the (status, body, keep_alive) of a request answered with response"""
+    client, server = trio.testing.memory_stream_pair()
+    await server.send_all(response)
+    with trio.fail_after(5):
+        return await smi.HTTPConnection(client).request(head, b"x")
+
+
+def test_no_content_keeps_connection():
+    # InfluxDB (Go's net/http) sends 204s without a Content-Length
+    result = trio.run(respond, b"HTTP/1.1 204 No Content\r\nDate: now\r\n\r\n")
+    assert result == (204, b"", True)
+
+
+def test_content_length():
+    result = trio.run(respond, b"HTTP/1.1 400 Bad Request\r\nContent-Length: 5\r\n\r\nerror")
+    assert result == (400, b"error", True)
+
+
+def test_chunked():
+    result = trio.run(respond, b"HTTP/1.1 500 Error\r\nTransfer-Encoding: chunked\r\n\r\n"
+                      b"3\r\nabc\r\n2;ext=1\r\nde\r\n0\r\nTrailer: x\r\n\r\n")
+    assert result == (500, b"abcde", True)
+
+
+def test_interim_response_skipped():
+    result = trio.run(respond, b"HTTP/1.1 100 Continue\r\n\r\n"
+                      b"HTTP/1.1 204 No Content\r\n\r\n")
+    assert result == (204, b"", True)
+
+
+def test_head_request_has_no_body():
+    result = trio.run(respond, b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n",
+                      b"HEAD /ping HTTP/1.1\r\n\r\n")
+    assert result == (200, b"", True)
+
+
+def test_unframed_body_closes_connection():
+    result = trio.run(respond, b"HTTP/1.1 200 OK\r\n\r\n")
+    assert result[2] is False
+
+
+def test_connection_close():
+    result = trio.run(respond, b"HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n")
+    assert result == (204, b"", False)
+
+
+def test_pool_reuses_connection():
+    connections = []
+
+    async def handler(stream):
+        connections.append(stream)
+        connection = smi.HTTPConnection(stream)
+        try:
+            while True:
+                head = await connection.receive_until(b"\r\n\r\n")
+                length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+                await connection.receive_exactly(length)
+                await stream.send_all(b"HTTP/1.1 204 No Content\r\n"
+                                      b"X-Influxdb-Version: 1.8.10\r\n\r\n")
+        except trio.BrokenResourceError:
+            pass
+
+    async def main():
+        with trio.fail_after(5):
+            async with trio.open_nursery() as nursery:
+                listeners = await nursery.start(functools.partial(trio.serve_tcp, handler, 0,
+                                                                  host="127.0.0.1"))
+                port = listeners[0].socket.getsockname()[1]
+                client = smi.InfluxHTTPClient("127.0.0.1", port, "root", "root")
+                for index in range(5):
+                    await client.write("db", "m a={0}i".format(index).encode(), "s")
+                assert len(client.idle) == 1
+                await client.aclose()
+                nursery.cancel_scope.cancel()
+
+    trio.run(main)
+    assert len(connections) == 1
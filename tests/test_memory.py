@@ -0,0 +1,34 @@
+"""Allocation regression tests for serializing reused Points (tracemalloc)"""
+import benchmark
+import system_metrics_influx as smi
+
+
+def test_point_cycle_allocations():
+    points = benchmark.synthetic_points(benchmark.synthetic_results(64, 16, 8, 8))
+    serializer = smi.LineSerializer()
+
+    def cycle():
+        return serializer.serialize(benchmark.update_points(points), 1700000000)
+
+    # the first cycle fills the caches (line prefixes and keys)
+    size = len(cycle())
+    samples = [benchmark.trace_cycle(cycle) for _ in range(5)]
+    # a cycle only allocates the lines and the payload, and keeps nothing
+    assert max(peak for peak, _ in samples) < 5 * size
+    assert max(retained for _, retained in samples) < 1024
+
+
+def test_points_allocate_less_than_dicts():
+    results = benchmark.synthetic_results(64, 16, 8, 8)
+    points = benchmark.synthetic_points(results)
+    serializer = smi.LineSerializer()
+
+    def dict_cycle():
+        return serializer.serialize(benchmark.copy_results(results), 1)
+
+    def point_cycle():
+        return serializer.serialize(benchmark.update_points(points), 1)
+
+    dict_cycle()
+    point_cycle()
+    assert benchmark.trace_cycle(point_cycle)[0] < benchmark.trace_cycle(dict_cycle)[0] * 0.75
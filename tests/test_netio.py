@@ -0,0 +1,83 @@
+"""Tests for NetIOStats: per nic state, the filter cache and the virtual nic total"""
+import os
+
+import trio
+
+import system_metrics_influx as smi
+
+
+class FakeHost:
+    """A fake /proc/net/dev and /sys/class/net, with a clock for the collection times"""
+    def __init__(self, root):
+        self.root = root
+        self.time = 100.0
+        os.makedirs(os.path.join(root, "proc", "net"))
+        os.makedirs(os.path.join(root, "sys", "class", "net"))
+
+    def write(self, counters):
+        """Writes /proc/net/dev for {nic: (rx bytes, tx bytes)}, with links for the nics"""
+        lines = ["Inter-|   Receive |  Transmit", " face |bytes    packets|bytes    packets"]
+        for nic, (rx_bytes, tx_bytes) in counters.items():
+            lines.append("{0:>6}: {1} 10 0 0 0 0 0 0 {2} 20 0 0 0 0 0 0"
+                         .format(nic, rx_bytes, tx_bytes))
+            link = os.path.join(self.root, "sys", "class", "net", nic)
+            if not os.path.lexists(link):
+                kind = "virtual" if nic.startswith("veth") or nic == "lo" else "pci0000:00"
+                os.symlink("../../devices/{0}/net/{1}".format(kind, nic), link)
+        with open(os.path.join(self.root, "proc", "net", "dev"), "w") as out_file:
+            out_file.write("\n".join(lines) + "\n")
+
+    def collect(self, stat, counters):
+        """Returns {nic: (tx bytes, rx bytes) rates} of a collection 1s after the last"""
+        self.write(counters)
+        self.time += 1
+        points = trio.run(stat.get_stats)
+        return {point.tags["nic"]: tuple(point.values[:2]) for point in points}
+
+
+def create_stat(tmp_path, monkeypatch, counters, filters=(), virtual_total=False):
+    monkeypatch.setattr(smi.ProcFile, "root", str(tmp_path))
+    host = FakeHost(str(tmp_path))
+    monkeypatch.setattr(smi.NetIOStats, "current_time", staticmethod(lambda: host.time))
+    host.write(counters)
+    stat = smi.NetIOStats(list(filters), "exclude", virtual_total)
+    trio.run(stat.init_fetch)
+    return host, stat
+
+
+def test_rates_and_nics_coming_and_going(tmp_path, monkeypatch):
+    host, stat = create_stat(tmp_path, monkeypatch, {"eth0": (0, 0), "veth1": (0, 0)})
+    assert host.collect(stat, {"eth0": (100, 50), "veth1": (10, 0)}) == {
+        "eth0": (50, 100), "veth1": (0, 10)}
+    # a new nic is recorded from the collection after it appears
+    assert host.collect(stat, {"eth0": (300, 50), "veth2": (5, 5)}) == {"eth0": (0, 200)}
+    assert "veth1" not in stat.points and "veth1" not in stat.virtual_nics
+    assert host.collect(stat, {"eth0": (300, 50), "veth2": (15, 25)}) == {
+        "eth0": (0, 0), "veth2": (20, 10)}
+
+
+def test_virtual_total(tmp_path, monkeypatch):
+    counters = {"lo": (0, 0), "eth0": (0, 0), "veth1": (0, 0), "veth2": (0, 0)}
+    host, stat = create_stat(tmp_path, monkeypatch, counters, filters=["veth.*"],
+                             virtual_total=True)
+    values = stat.total_point.values
+    rates = host.collect(stat, {"lo": (1000, 1000), "eth0": (10, 10), "veth1": (30, 20),
+                                "veth2": (5, 1)})
+    # the excluded veth nics are only written in the total, which excludes lo and eth0
+    assert rates == {"lo": (1000, 1000), "eth0": (10, 10), "virtual_total": (21, 35)}
+    rates = host.collect(stat, {"lo": (1000, 1000), "eth0": (10, 10), "veth1": (40, 20),
+                                "veth2": (5, 1)})
+    assert rates["virtual_total"] == (0, 10)
+    # the Point is reused, its values are updated in place
+    assert stat.total_point.values is values
+
+
+def test_filter_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(smi.NetIOStats, "filter_cache_size", 2)
+    _, stat = create_stat(tmp_path, monkeypatch, {}, filters=["veth.*"])
+    assert stat.check_disk_valid("eth0")
+    assert not stat.check_disk_valid("veth1")
+    assert stat.check_disk_valid("eth0")
+    assert not stat.check_disk_valid("veth2")
+    # veth1 was the least recently used
+    assert list(stat.filed_disks) == ["eth0", "veth2"]
@@ -0,0 +1,168 @@
+"""Tests for the isolated plugin worker pool"""
+import os
+import pickle
+import subprocess
+import sys
+import textwrap
+
+import pytest
+import trio
+import trio.testing
+
+from common_lib import BaseStat, FramedStream
+import system_metrics_influx as smi
+
+PLUGIN = textwrap.dedent('''
+    import os
+    import time
+
+    class Counter:
+        name = "Counter"
+        def __init__(self):
+            self.count = 0
+        def get_stats(self):
+            self.count += 1
+            return {"measurement": "counter", "pid": os.getpid(), "count": self.count}
+
+    class Hang:
+        name = "Hang"
+        def get_stats(self):
+            time.sleep(60)
+
+    class Crash:
+        name = "Crash"
+        def get_stats(self):
+            os._exit(3)
+
+    class BadInit:
+        name = "BadInit"
+        def __init__(self):
+            raise RuntimeError("bad init")
+
+    ACTIVATED_METRICS = [Counter, Hang, Crash, BadInit]
+''')
+
+
+@pytest.fixture(name="pool")
+def fixture_pool(tmp_path, monkeypatch):
+    """Returns a function creating a worker hosting the named classes of the test plugin"""
+    (tmp_path / "isolated_test_plugin.py").write_text(PLUGIN)
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+    monkeypatch.setattr(smi.PluginWorkerProcess, "worker_path",
+                        os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                     "plugin_worker.py"))
+    BaseStat.collect_interval = 1
+    workers = []
+
+    async def create(*names):
+        worker = smi.PluginWorkerProcess(0)
+        workers.append(worker)
+        descriptions = await smi.PluginWorkerProcess.describe("isolated_test_plugin")
+        stats = {}
+        for index, description in enumerate(descriptions):
+            if description["name"] in names:
+                stats[description["name"]] = smi.PluginWorker(worker, "isolated_test_plugin",
+                                                              index, description)
+        return worker, stats
+
+    yield create
+    for worker in workers:
+        if worker.process is not None:
+            worker.process.kill()
+
+
+def test_classes_share_a_worker(pool):
+    async def main():
+        worker, stats = await pool("Counter", "BadInit")
+        await stats["Counter"].async_init()
+        with pytest.raises(smi.PluginWorkerError, match="bad init"):
+            await stats["BadInit"].async_init()
+        first = await stats["Counter"].get_stats()
+        second = await stats["Counter"].get_stats()
+        assert first["pid"] == second["pid"] == worker.process.pid
+        assert second["count"] == 2
+
+    trio.run(main)
+
+
+def test_hung_worker_killed_and_restarted(pool, monkeypatch):
+    monkeypatch.setattr(smi.PluginWorkerProcess, "max_timeouts", 2)
+
+    async def main():
+        worker, stats = await pool("Counter", "Hang")
+        for stat in stats.values():
+            await stat.async_init()
+        pid = (await stats["Counter"].get_stats())["pid"]
+        for _ in range(2):
+            with trio.move_on_after(0.2):
+                await stats["Hang"].get_stats()
+        assert worker.process is None
+        # waiting to restart
+        assert await stats["Counter"].get_stats() is None
+        worker.restart_time = 0
+        result = await stats["Counter"].get_stats()
+        assert result["pid"] != pid
+        assert result["count"] == 1
+
+    trio.run(main)
+
+
+def test_crashed_worker_restarted(pool):
+    async def main():
+        worker, stats = await pool("Counter", "Crash")
+        for stat in stats.values():
+            await stat.async_init()
+        with pytest.raises(smi.PluginWorkerError, match="exited"):
+            await stats["Crash"].get_stats()
+        assert worker.process is None
+        worker.restart_time = 0
+        assert (await stats["Counter"].get_stats())["count"] == 1
+
+    trio.run(main)
+
+
+def test_failed_start_reaps_worker(pool, monkeypatch):
+    async def main():
+        worker, stats = await pool("Counter")
+        processes = []
+
+        async def spawn_exiting(*_):
+            # a worker which exits before initialising
+            process = await trio.lowlevel.open_process(
+                [sys.executable, "-c", "pass"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            processes.append(process)
+            return process, FramedStream(process.stdin, process.stdout)
+
+        monkeypatch.setattr(worker, "spawn", spawn_exiting)
+        with pytest.raises(EOFError):
+            await stats["Counter"].async_init()
+        assert worker.process is None
+        worker.restart_time = 0
+        with pytest.raises(smi.PluginWorkerError, match="failed to start"):
+            await stats["Counter"].get_stats()
+        # the failed restart is backed off
+        assert worker.restart_time > 0
+        assert await stats["Counter"].get_stats() is None
+        assert len(processes) == 2
+        assert all(process.returncode is not None for process in processes)
+
+    trio.run(main)
+
+
+def test_receive_cancelled_mid_frame():
+    async def run():
+        send_stream, receive_stream = trio.testing.memory_stream_one_way_pair()
+        framed = FramedStream(send_stream, receive_stream)
+        payload = pickle.dumps({"value": 1})
+        frame = FramedStream.header.pack(len(payload), 7, FramedStream.RESULT) + payload
+        await send_stream.send_all(frame[:FramedStream.header.size + 2])
+        with trio.move_on_after(0.05) as cancel_scope:
+            await framed.receive()
+        assert cancel_scope.cancelled_caught
+        await send_stream.send_all(frame[FramedStream.header.size + 2:])
+        await framed.send(8, FramedStream.RESULT, "next")
+        with trio.fail_after(5):
+            assert await framed.receive() == (7, FramedStream.RESULT, {"value": 1})
+            assert await framed.receive() == (8, FramedStream.RESULT, "next")
+    trio.run(run)
@@ -0,0 +1,49 @@
+"""Tests for the incremental /proc scan of ProcessStats"""
+import os
+import shutil
+
+import benchmark
+import system_metrics_influx as smi
+
+
+def test_new_and_exited_processes_seen_every_scan(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    benchmark.build_fake_processes(root, 100)
+    monkeypatch.setattr(smi.ProcFile, "root", root)
+    monkeypatch.setattr(smi.ProcessStats, "scan_reads", 10)
+    stat = smi.ProcessStats(3)
+    # every process is hot on the first scan, and idle after the second
+    for now in range(1, 4):
+        stat.scan(now)
+    # the pass over the known processes is incomplete
+    assert stat.queue
+    os.makedirs(os.path.join(root, "proc", "4321"))
+    benchmark.write_fake_process(root, 4321, 0)
+    shutil.rmtree(os.path.join(root, "proc", "50"))
+    stat.scan(4)
+    assert "4321" in stat.processes and "50" not in stat.processes
+    assert stat.processes["4321"][stat.RSS] == 4321 * smi.PAGE_SIZE
+
+
+def test_exec_renames_process(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    benchmark.build_fake_processes(root, 10)
+    monkeypatch.setattr(smi.ProcFile, "root", root)
+    stat = smi.ProcessStats(3)
+    stat.scan(1)
+    entry = stat.processes["7"]
+    stat.read_cmdline(entry)
+    assert (entry[stat.NAME], entry[stat.CMDLINE]) == ("worker-7", "/usr/bin/worker --id 7")
+    # exec keeps the pid and start time, but changes the name and cmdline
+    path = os.path.join(root, "proc", "7")
+    with open(os.path.join(path, "stat")) as in_file:
+        data = in_file.read()
+    with open(os.path.join(path, "stat"), "w") as out_file:
+        out_file.write(data.replace("(worker-7)", "(python3)"))
+    with open(os.path.join(path, "cmdline"), "w") as out_file:
+        out_file.write("python3\0script.py\0")
+    for now in (2, 3):
+        stat.scan(now)
+    assert stat.processes["7"] is entry
+    stat.read_cmdline(entry)
+    assert (entry[stat.NAME], entry[stat.CMDLINE]) == ("python3", "python3 script.py")
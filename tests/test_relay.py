@@ -0,0 +1,102 @@
+"""Tests for the relay framing, RelayClient and RelayServer"""
+import functools
+import zlib
+
+import pytest
+import trio
+
+import system_metrics_influx as smi
+
+
+def decode(frame):
+    """Returns (precision, line protocol) of a frame"""
+    size, precision, flags = smi.RelayProtocol.decode_header(
+        frame[:smi.RelayProtocol.header.size])
+    payload = frame[smi.RelayProtocol.header.size:]
+    assert size == len(payload)
+    return precision, smi.RelayProtocol.decode_payload(payload, flags)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_frame_round_trip(compress):
+    data = b"m a=1i 1\n" * 100
+    frame = smi.RelayProtocol.encode(data, "ms", compress)
+    assert (len(frame) < len(data)) == compress
+    assert decode(frame) == ("ms", data)
+
+
+def test_invalid_frames():
+    with pytest.raises(ValueError):
+        smi.RelayProtocol.decode_header(smi.RelayProtocol.header.pack(1, 4, 0))
+    with pytest.raises(ValueError):
+        smi.RelayProtocol.decode_header(smi.RelayProtocol.header.pack(
+            smi.RelayProtocol.max_payload_size + 1, 0, 0))
+    with pytest.raises(zlib.error):
+        smi.RelayProtocol.decode_payload(b"not zlib", smi.RelayProtocol.flag_compressed)
+
+
+def test_convert_precision():
+    server = smi.RelayServer({"precision": "s"}, None, None)
+    assert server.convert_precision(b"m a=1i 1500\nn b=2i 2999", "ms") == b"m a=1i 1\nn b=2i 2"
+    server = smi.RelayServer({"precision": "ms"}, None, None)
+    assert server.convert_precision(b"m a=1i 2\n", "s") == b"m a=1i 2000"
+
+
+async def relay_tcp(writes):
+    """Writes (data, precision) pairs through a RelayClient to a RelayServer over TCP
+
+    Returns the data queued by the relay, the errors raised by the writes and the totals
+    """
+    args = {"precision": "s", "dry_run": False}
+    send_channel, receive_channel = trio.open_memory_channel(len(writes))
+    server = smi.RelayServer(args, send_channel, None)
+    errors = []
+    with trio.fail_after(10):
+        async with trio.open_nursery() as nursery:
+            listeners = await nursery.start(functools.partial(
+                trio.serve_tcp, server.handle_connection, 0, host="127.0.0.1"))
+            port = listeners[0].socket.getsockname()[1]
+            client = smi.RelayClient("127.0.0.1", port, compress=True)
+            for data, precision in writes:
+                try:
+                    await client.write("db", data, precision)
+                except smi.InfluxWriteError as error:
+                    errors.append(str(error))
+            await client.aclose()
+            nursery.cancel_scope.cancel()
+    received = []
+    while True:
+        try:
+            received.append(receive_channel.receive_nowait())
+        except trio.WouldBlock:
+            return received, errors, server.totals
+
+
+def test_relay_tcp():
+    received, errors, totals = trio.run(relay_tcp, [(b"m a=1i 1\n", "s"),
+                                                    (b"m a=2i 2000", "ms")])
+    assert received == [b"m a=1i 1\n", b"m a=2i 2\n"]
+    assert errors == []
+    assert totals["connections"] == 1 and totals["frames"] == 2
+
+
+async def relay_raw(frame):
+    """Sends a raw frame to a RelayServer over TCP, returning the ack and the server totals"""
+    server = smi.RelayServer({"precision": "s", "dry_run": False}, None, None)
+    with trio.fail_after(10):
+        async with trio.open_nursery() as nursery:
+            listeners = await nursery.start(functools.partial(
+                trio.serve_tcp, server.handle_connection, 0, host="127.0.0.1"))
+            port = listeners[0].socket.getsockname()[1]
+            async with await trio.open_tcp_stream("127.0.0.1", port) as stream:
+                await stream.send_all(frame)
+                ack = await stream.receive_some(1)
+            nursery.cancel_scope.cancel()
+    return ack, server.totals
+
+
+def test_relay_tcp_invalid_frame():
+    frame = smi.RelayProtocol.header.pack(8, 3, smi.RelayProtocol.flag_compressed) + b"not zlib"
+    ack, totals = trio.run(relay_raw, frame)
+    assert ack == smi.RelayProtocol.ack_error
+    assert totals["errors"] == 1 and totals["frames"] == 0
@@ -0,0 +1,88 @@
+"""Tests for LineSerializer"""
+from common_lib import Point
+import system_metrics_influx as smi
+
+
+def serialize(results, **kwargs):
+    """Serializes results with a new serializer at timestamp 1, returning the lines"""
+    return smi.LineSerializer(**kwargs).serialize(results, 1).decode().splitlines()
+
+
+def test_field_types():
+    lines = serialize([("Test", {"measurement": "m", "int": 3, "float": 1.5, "bool": True,
+                                 "str": "a \"b\"", "none": None})])
+    assert lines == ["m int=3i,float=1.5,bool=true,str=\"a \\\"b\\\"\" 1"]
+
+
+def test_tags_sorted_and_escaped():
+    lines = serialize([("Test", {"measurement": "my m", "tags": {"z": "a,b", "a": "x=y"},
+                                 "field key": 1})])
+    assert lines == ["my\\ m,a=x\\=y,z=a\\,b field\\ key=1i 1"]
+
+
+def test_newlines_dropped_from_tags_and_keys():
+    lines = serialize([("Test", {"measurement": "m", "tags": {"t": "a\nb"}, "f\nk": 1})])
+    assert lines == ["m,t=ab fk=1i 1"]
+
+
+def test_non_finite_floats_skipped():
+    lines = serialize([("Test", [{"measurement": "m", "a": float("nan"), "b": 2.0},
+                                 {"measurement": "n", "a": float("inf")}])])
+    assert lines == ["m b=2.0 1"]
+
+
+def test_point_non_finite_floats_skipped():
+    point = Point("m", ("a", "b"), {"t": "x"})
+    point.values = [float("-inf"), 2]
+    empty = Point("n", ("a",))
+    empty.values = [float("nan")]
+    assert serialize([("Test", [point, empty])]) == ["m,t=x b=2i 1"]
+
+
+def test_point_reused_across_cycles():
+    serializer = smi.LineSerializer()
+    point = Point("m", ("a",))
+    point.values[0] = 1
+    assert serializer.serialize([("Test", [point])], 1) == b"m a=1i 1\n"
+    point.values[0] = 2
+    assert serializer.serialize([("Test", [point])], 2) == b"m a=2i 2\n"
+
+
+def test_counts():
+    serializer = smi.LineSerializer()
+    serializer.serialize([("A", {"measurement": "m", "a": 1}), ("B", None)], 1)
+    assert serializer.counts == {"A": (1, len("m a=1i 1\n")), "B": (0, 0)}
+
+
+def test_wide_rows():
+    results = [{"measurement": "cpu", "tags": {"cpu": index}, "util": float(index)}
+               for index in range(2)]
+    assert serialize([("CPU", results)], wide=True) == ["cpu util_0=0.0,util_1=1.0 1"]
+
+
+def test_wide_rows_emission_policy():
+    policy = smi.EmissionPolicy({"cpu": {"util": ("change", None)}}, 100)
+    serializer = smi.LineSerializer(wide=True, policy=policy)
+
+    def cycle(timestamp, values):
+        results = [{"measurement": "cpu", "tags": {"cpu": index}, "util": value}
+                   for index, value in enumerate(values)]
+        return serializer.serialize([("CPU", results)], timestamp).decode().splitlines()
+
+    assert cycle(1, [1.0, 2.0]) == ["cpu util_0=1.0,util_1=2.0 1"]
+    assert cycle(2, [1.0, 3.0]) == ["cpu util_1=3.0 2"]
+    assert cycle(3, [1.0, 3.0]) == []
+
+
+def test_emission_policy_evicts_least_recently_seen(monkeypatch):
+    monkeypatch.setattr(smi.EmissionPolicy, "max_series", 2)
+    policy = smi.EmissionPolicy({"m": {"a": ("change", None)}}, 100)
+    rules = policy.measurement_rules("m")
+    assert policy.should_write(rules, "m,h=1", "a", 1, 1)
+    assert policy.should_write(rules, "m,h=2", "a", 1, 1)
+    assert not policy.should_write(rules, "m,h=1", "a", 1, 2)
+    # a new series evicts h=2, the least recently seen, rather than every series
+    assert policy.should_write(rules, "m,h=3", "a", 1, 3)
+    assert not policy.should_write(rules, "m,h=1", "a", 1, 4)
+    assert not policy.should_write(rules, "m,h=3", "a", 1, 4)
+    assert policy.should_write(rules, "m,h=2", "a", 1, 4)
@@ -0,0 +1,125 @@
+"""Tests for the socket state counts of SocketStats, from netlink and /proc/net/tcp"""
+import os
+import socket
+import struct
+
+import pytest
+
+import benchmark
+import system_metrics_influx as smi
+
+ESTABLISHED = 1
+
+
+class FakeSockDiag:
+    """A netlink socket answering sock_diag dumps from a table of socket states per family
+
+    Each recv returns at most per_recv messages, as the kernel splits dumps over several
+    datagrams
+    """
+    header = struct.Struct("=IHHII")
+    per_recv = 3
+
+    def __init__(self, tables, requests):
+        self.tables = tables
+        self.requests = requests
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def sendto(self, request, address):
+        fields = smi.SocketStats.request.unpack(request)
+        family, states = fields[5], fields[9]
+        self.requests.append((family, states))
+        for state in self.tables[family]:
+            if states & (1 << state):
+                # nlmsghdr, then inet_diag_msg (family, state, ...) padded to 72 bytes
+                self.messages.append(self.header.pack(88, smi.SocketStats.SOCK_DIAG_BY_FAMILY,
+                                                      2, 1, 0)
+                                     + struct.pack("=BB70x", family, state))
+        self.messages.append(self.header.pack(20, smi.SocketStats.NLMSG_DONE, 2, 1, 0)
+                             + bytes(4))
+
+    def recv_into(self, buffer):
+        data = b"".join(self.messages[:self.per_recv])
+        del self.messages[:self.per_recv]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+@pytest.fixture
+def proc_root(tmp_path, monkeypatch):
+    """A fake /proc/net with sockstat totals of 30 TCP sockets (4 TIME_WAIT)"""
+    os.makedirs(tmp_path / "proc" / "net")
+    (tmp_path / "proc" / "net" / "sockstat").write_text(
+        "sockets: used 100\nTCP: inuse 20 orphan 0 tw 4 alloc 20 mem 1\n")
+    (tmp_path / "proc" / "net" / "sockstat6").write_text("TCP6: inuse 10\n")
+    monkeypatch.setattr(smi.ProcFile, "root", str(tmp_path))
+    return tmp_path
+
+
+def netlink_stat(max_sockets, tables, requests):
+    """Returns a SocketStats counting states from the fake sock_diag tables"""
+    stat = smi.SocketStats(max_sockets)
+    stat.use_netlink = True
+    stat.open_sock_diag = lambda: FakeSockDiag(tables, requests)
+    return stat
+
+
+# listening sockets are dumped first
+TABLES = {socket.AF_INET: [smi.SocketStats.LISTEN] * 2 + [ESTABLISHED] * 18,
+          socket.AF_INET6: [smi.SocketStats.LISTEN] * 3 + [ESTABLISHED] * 7}
+
+
+def test_netlink_counts(proc_root):
+    requests = []
+    counts, sampled = netlink_stat(1000, TABLES, requests).count_states()
+    assert counts[smi.SocketStats.LISTEN] == 5
+    assert counts[ESTABLISHED] == 25
+    assert sampled == 1.0
+    assert requests == [(socket.AF_INET, 0xfff), (socket.AF_INET6, 0xfff)]
+
+
+def test_netlink_limit_keeps_ipv6_listen_exact(proc_root):
+    requests = []
+    counts, sampled = netlink_stat(12, TABLES, requests).count_states()
+    # the IPv4 dump uses up the limit, then only the IPv6 listening sockets are dumped
+    assert requests == [(socket.AF_INET, 0xfff), (socket.AF_INET6, 1 << smi.SocketStats.LISTEN)]
+    assert counts[smi.SocketStats.LISTEN] == 5
+    # the 10 established counted are scaled to the 30 in use less the 5 listening
+    assert counts[ESTABLISHED] == 25
+    assert counts[smi.SocketStats.TIME_WAIT] == 4
+    assert sampled == 0.4
+
+
+def test_proc_counts(proc_root):
+    benchmark.write_fake_tcp_table(str(proc_root / "proc" / "net" / "tcp"), 1000)
+    benchmark.write_fake_tcp_table(str(proc_root / "proc" / "net" / "tcp6"), 500)
+    stat = smi.SocketStats(100000)
+    stat.use_netlink = False
+    counts, sampled = stat.count_states()
+    assert sampled == 1.0
+    assert counts[smi.SocketStats.LISTEN] == 15
+    assert sum(counts) == 1500
+    # 2 in 10 of the sockets past the listening ones are TIME_WAIT
+    assert counts[smi.SocketStats.TIME_WAIT] == 198 + 100
+
+
+def test_proc_limit_keeps_ipv6_listen_exact(proc_root, monkeypatch):
+    benchmark.write_fake_tcp_table(str(proc_root / "proc" / "net" / "tcp"), 20000)
+    benchmark.write_fake_tcp_table(str(proc_root / "proc" / "net" / "tcp6"), 20000)
+    (proc_root / "proc" / "net" / "sockstat").write_text(
+        "TCP: inuse 24000 orphan 0 tw 8000 alloc 24000 mem 1\n")
+    (proc_root / "proc" / "net" / "sockstat6").write_text("TCP6: inuse 8000\n")
+    monkeypatch.setattr(smi.SocketStats, "proc_chunk_size", 4096)
+    stat = smi.SocketStats(5000 * smi.SocketStats.proc_cost)
+    stat.use_netlink = False
+    counts, sampled = stat.count_states()
+    # the IPv4 table uses up the limit, then only the IPv6 listening sockets are counted
+    assert counts[smi.SocketStats.LISTEN] == 400
+    assert counts[smi.SocketStats.TIME_WAIT] == 8000
+    assert 0 < sampled < 1.0
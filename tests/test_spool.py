@@ -0,0 +1,83 @@
+"""Tests for the on-disk Spool"""
+import os
+
+import pytest
+
+import system_metrics_influx as smi
+
+
+def drain(spool):
+    """Reads and commits every record in the spool"""
+    records = []
+    while True:
+        record = spool.read()
+        if record is None:
+            return records
+        spool.commit()
+        records.append(record)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_replay_in_order(tmp_path, compress):
+    spool = smi.Spool(str(tmp_path), 1024 ** 2, compress=compress)
+    for index in range(3):
+        assert spool.append("m a={0}i {0}\n".format(index).encode(), "s")
+    assert drain(spool) == [("m a={0}i {0}\n".format(index).encode(), "s")
+                            for index in range(3)]
+    assert spool.read() is None
+
+
+def test_record_only_consumed_on_commit(tmp_path):
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    spool.append(b"first", "ms")
+    spool.append(b"second", "ms")
+    assert spool.read() == (b"first", "ms")
+    # not committed, so the same record is returned again
+    assert spool.read() == (b"first", "ms")
+    spool.commit()
+    assert spool.read() == (b"second", "ms")
+
+
+def test_replayed_after_restart(tmp_path):
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    spool.append(b"kept", "u")
+    spool.close()
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    assert spool.size() > 0
+    assert drain(spool) == [(b"kept", "u")]
+
+
+def test_corrupt_record_discards_rest_of_segment(tmp_path):
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    spool.append(b"good", "s")
+    spool.append(b"corrupted", "s")
+    spool.close()
+    path = spool.segment_path(0)
+    with open(path, "r+b") as segment:
+        segment.seek(os.path.getsize(path) - 1)
+        segment.write(b"X")
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    assert drain(spool) == [(b"good", "s")]
+    assert not os.path.exists(path)
+
+
+def test_truncated_record_discarded(tmp_path):
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    spool.append(b"good", "s")
+    spool.append(b"truncated", "s")
+    spool.close()
+    path = spool.segment_path(0)
+    os.truncate(path, os.path.getsize(path) - 3)
+    spool = smi.Spool(str(tmp_path), 1024 ** 2)
+    assert drain(spool) == [(b"good", "s")]
+
+
+def test_oldest_segments_dropped_over_budget(tmp_path):
+    spool = smi.Spool(str(tmp_path), 256 * 1024)
+    record = b"x" * 1024
+    for _ in range(600):
+        spool.append(record, "s")
+    assert spool.size() <= 256 * 1024 + spool.segment_size
+    records = drain(spool)
+    assert 0 < len(records) < 600
+    assert all(data == record for data, _ in records)
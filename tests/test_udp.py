@@ -0,0 +1,44 @@
+"""Tests for the UDP packing of InfluxUDPClient"""
+import socket
+
+import trio
+
+import system_metrics_influx as smi
+
+
+def test_split_lines():
+    data = b"aaaa\nbbbb\ncc\n"
+    assert list(smi.split_lines(data, 10)) == [b"aaaa\nbbbb\n", b"cc\n"]
+    assert list(smi.split_lines(data, 100)) == [data]
+    assert list(smi.split_lines(b"", 10)) == []
+
+
+def test_split_long_line():
+    data = b"a\n" + b"b" * 20 + b"\nc\n"
+    assert list(smi.split_lines(data, 10)) == [b"a\n", b"b" * 20 + b"\n", b"c\n"]
+
+
+def test_split_unterminated_line():
+    assert list(smi.split_lines(b"a\n" + b"b" * 20, 10)) == [b"a\n", b"b" * 20]
+
+
+async def send_udp(data, mtu):
+    """Writes data with an InfluxUDPClient, returning the datagrams received and its totals"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        client = smi.InfluxUDPClient("127.0.0.1", receiver.getsockname()[1], mtu)
+        await client.write("db", data, "s")
+        await client.aclose()
+        datagrams = [receiver.recv(65536) for _ in range(client.totals["packets"])]
+    return datagrams, client.totals
+
+
+def test_udp_datagrams_fit_mtu():
+    lines = [b"m,host=h value=%di %d\n" % (index, index) for index in range(100)]
+    datagrams, totals = trio.run(send_udp, b"".join(lines), 128)
+    # 28 bytes of IPv4 and UDP headers
+    assert all(len(datagram) <= 100 for datagram in datagrams)
+    assert all(datagram.endswith(b"\n") for datagram in datagrams)
+    assert b"".join(datagrams) == b"".join(lines)
+    assert totals == dict(packets=len(datagrams), bytes=sum(map(len, datagrams)), dropped=0)